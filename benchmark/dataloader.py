@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+#
+#   Benchmark the throughput of a lightnet data pipeline
+#   Copyright EAVISE
+#
+"""
+Run a dataset through a :class:`lightnet.data.DataLoader` for a range of worker counts and batch sizes and report how many images per second it delivers.
+Besides the total throughput, this script also reports the time spent decoding images, in each transform of the :class:`~lightnet.data.transform.Compose` pipelines and collating the batches.
+The transform timings come from the profiling mode of :class:`~lightnet.data.transform.Compose`.
+
+By default, a :class:`~lightnet.models.DarknetDataset` is created on synthetic images in a temporary folder.
+You can benchmark your own pipeline by passing a ``file.py:function`` factory, which gets called without arguments and should return a lightnet dataset.
+
+Usage:
+    python benchmark/dataloader.py -w 0 2 4 -b 1 8 32 -o report.json
+    python benchmark/dataloader.py --factory my_project.py:get_dataset --collate brambox
+"""
+import argparse
+import collections
+import importlib.util
+import itertools
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+import torch
+from PIL import Image
+import lightnet as ln
+
+_stats = collections.defaultdict(lambda: [0.0, 0])
+_lock = threading.Lock()
+_load_image = ln.models.BramboxDataset._load_image
+
+
+def _record(key, duration):
+    with _lock:
+        stat = _stats[key]
+        stat[0] += duration
+        stat[1] += 1
+
+
+def _pop_stats():
+    """ Get the timings of this process since the previous call and reset them. """
+    with _lock:
+        stats = {key: tuple(value) for key, value in _stats.items()}
+        _stats.clear()
+    return stats
+
+
+def _timed_load_image(self, index, decode=True):
+    """ Load and decode an image, so that decoding does not get attributed to the first transform. """
+    start = time.perf_counter()
+    img = _load_image(self, index, decode=True)
+    _record('decode', time.perf_counter() - start)
+    return img
+
+
+def instrument(worker_id=None):
+    """ Patch the image loading with a timed version. |br|
+    This is also used as ``worker_init_fn``, so that it works with the *spawn* and *forkserver* start methods.
+    """
+    ln.models.BramboxDataset._load_image = _timed_load_image
+    _pop_stats()
+
+
+class TimedCollate:
+    """ Wrap a collate function to time it and to send the timings of the (worker) process along with the batch. """
+    def __init__(self, collate_fn):
+        self.collate_fn = collate_fn
+
+    def __call__(self, batch):
+        start = time.perf_counter()
+        batch = self.collate_fn(batch)
+        _record('collate', time.perf_counter() - start)
+        return batch, _pop_stats()
+
+
+def synthetic_dataset(folder, num_images=256, image_size=(640, 480), boxes=5, io_workers=0):
+    """ Create a DarknetDataset from random JPEG images and annotations in a folder. """
+    rng = np.random.default_rng(0)
+    width, height = image_size
+    paths = []
+    for i in range(num_images):
+        path = os.path.join(folder, f'{i:06d}.jpg')
+        Image.fromarray(rng.integers(256, size=(height, width, 3), dtype=np.uint8)).save(path, quality=90)
+        with open(os.path.splitext(path)[0]+'.txt', 'w') as f:
+            for _ in range(boxes):
+                w, h = rng.uniform(0.05, 0.5, 2)
+                x, y = rng.uniform(w/2, 1-w/2), rng.uniform(h/2, 1-h/2)
+                f.write(f'{rng.integers(2)} {x:.6f} {y:.6f} {w:.6f} {h:.6f}\n')
+        paths.append(path)
+
+    data_file = os.path.join(folder, 'data.txt')
+    with open(data_file, 'w') as f:
+        f.write('\n'.join(paths))
+
+    return ln.models.DarknetDataset(data_file, ['a', 'b'], input_dimension=(416, 416), io_workers=io_workers)
+
+
+def load_factory(spec):
+    """ Load a ``file.py:function`` dataset factory. """
+    path, _, name = spec.rpartition(':')
+    module_spec = importlib.util.spec_from_file_location('dataset_factory', path)
+    module = importlib.util.module_from_spec(module_spec)
+    module_spec.loader.exec_module(module)
+    return getattr(module, name)()
+
+
+def benchmark(dataset, workers, batch_size, num_batches=50, warmup=5, collate_fn=ln.data.brambox_collate):
+    """ Run a dataset through a DataLoader and return a report of the timings.
+
+    Args:
+        dataset (lightnet.data.Dataset): Dataset to benchmark
+        workers (int): Number of DataLoader worker processes
+        batch_size (int): Batch size
+        num_batches (int, optional): Number of batches to measure; Default **50**
+        warmup (int, optional): Number of batches to run before measuring, which also hides the worker startup time; Default **5**
+        collate_fn (callable, optional): Collate function; Default :func:`lightnet.data.brambox_collate`
+
+    Returns:
+        dict: Throughput and timings of this configuration
+    """
+    instrument()
+    pipelines = [tf for tf in (getattr(dataset, 'transform', None), getattr(dataset, 'anno_transform', None)) if isinstance(tf, ln.data.transform.Compose)]
+    for pipeline in pipelines:
+        pipeline.start_profiling(workers)
+
+    loader = ln.data.DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=True,
+        num_workers=workers,
+        collate_fn=TimedCollate(collate_fn),
+        worker_init_fn=instrument if workers > 0 else None,
+        persistent_workers=workers > 0,
+    )
+
+    batches = itertools.chain.from_iterable(itertools.repeat(loader))
+    for _ in range(warmup):
+        next(batches)
+    for pipeline in pipelines:
+        pipeline.reset_profiling()
+
+    stats = collections.defaultdict(lambda: [0.0, 0])
+    images = 0
+    start = time.perf_counter()
+    for _ in range(num_batches):
+        (data, _), batch_stats = next(batches)
+        images += len(data)
+        for key, (duration, count) in batch_stats.items():
+            stats[key][0] += duration
+            stats[key][1] += count
+    duration = time.perf_counter() - start
+    del batches
+
+    for pipeline in pipelines:
+        for name, stat in pipeline.profiling_stats().items():
+            stats[f'transform/{name}'][0] += stat['time']
+            stats[f'transform/{name}'][1] += stat['calls']
+        pipeline.stop_profiling()
+
+    return {
+        'workers': workers,
+        'batch_size': batch_size,
+        'batches': num_batches,
+        'images': images,
+        'seconds': duration,
+        'images_per_second': images / duration,
+        'timings': {
+            key: {'total_seconds': total, 'calls': count, 'mean_ms': 1000 * total / max(count, 1)}
+            for key, (total, count) in sorted(stats.items())
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the throughput of a lightnet data pipeline')
+    parser.add_argument('-w', '--workers', type=int, nargs='+', default=[0, 2, 4], help='DataLoader worker counts')
+    parser.add_argument('-b', '--batch-sizes', type=int, nargs='+', default=[1, 8, 32], help='Batch sizes')
+    parser.add_argument('-n', '--num-batches', type=int, default=50, help='Number of batches to measure per configuration')
+    parser.add_argument('--warmup', type=int, default=5, help='Number of batches to skip per configuration')
+    parser.add_argument('--io-workers', type=int, default=0, help='Number of image loading threads of the synthetic dataset')
+    parser.add_argument('--num-images', type=int, default=256, help='Number of synthetic images')
+    parser.add_argument('--image-size', type=int, nargs=2, default=[640, 480], help='Width and height of the synthetic images')
+    parser.add_argument('--factory', help='file.py:function that returns the dataset to benchmark (default: synthetic DarknetDataset)')
+    parser.add_argument('--collate', choices=['brambox', 'default'], default='brambox', help='Collate function')
+    parser.add_argument('-o', '--output', help='Write the JSON report to this file instead of stdout')
+    args = parser.parse_args()
+
+    torch.set_num_threads(1)
+    collate_fn = ln.data.brambox_collate if args.collate == 'brambox' else torch.utils.data.dataloader.default_collate
+
+    with tempfile.TemporaryDirectory() as folder:
+        if args.factory is not None:
+            dataset = load_factory(args.factory)
+        else:
+            dataset = synthetic_dataset(folder, args.num_images, args.image_size, io_workers=args.io_workers)
+
+        results = []
+        for workers, batch_size in itertools.product(args.workers, args.batch_sizes):
+            result = benchmark(dataset, workers, batch_size, args.num_batches, args.warmup, collate_fn)
+            print(f'workers={workers:<3d} batch_size={batch_size:<4d} {result["images_per_second"]:9.1f} img/s', file=sys.stderr)
+            results.append(result)
+
+    report = json.dumps({
+        'dataset': args.factory or 'synthetic',
+        'torch': torch.__version__,
+        'lightnet': ln.__version__,
+        'cpu_count': os.cpu_count(),
+        'results': results,
+    }, indent=2)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+#
+#   Per-layer profile of a network
+#   Copyright EAVISE
+#
+"""
+Profile the layers of a network with :func:`lightnet.network.profile` and print a table of the time, FLOPs, parameters and activation memory per layer.
+The profile can be saved as JSON and two saved profiles (eg. of different model variants) can be compared layer by layer.
+
+Usage:
+    python benchmark/layer_profile.py -n Darknet53 -s 416 --sort time --top 20 -o darknet53.json
+    python benchmark/layer_profile.py -n CornernetSqueeze -s 512 --channels-last -o cornernet_cl.json
+    python benchmark/layer_profile.py --compare darknet53.json darknet53_fused.json
+"""
+import argparse
+import sys
+import torch
+import lightnet as ln
+
+
+def compare(before, after, key='time'):
+    """ Table with the difference between two profiles, for the layers that exist in both. """
+    rows = []
+    for layer in after:
+        try:
+            old = before[layer['name']][key]
+        except KeyError:
+            continue
+        new = layer[key]
+        rows.append((layer['name'], old, new, new - old, 100 * (new - old) / old if old else 0.0))
+    rows.append(('Total', before.total[key], after.total[key], after.total[key] - before.total[key], 100 * (after.total[key] - before.total[key]) / (before.total[key] or 1)))
+
+    scale = 1000 if key.startswith('time') else 1
+    width = max(len(row[0]) for row in rows)
+    lines = [f'{"Layer":<{width}}  {"Before":>14}  {"After":>14}  {"Delta":>14}  {"%":>7}']
+    for name, old, new, delta, rel in rows:
+        lines.append(f'{name:<{width}}  {old * scale:14.3f}  {new * scale:14.3f}  {delta * scale:+14.3f}  {rel:+7.1f}')
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-layer profile of a network')
+    parser.add_argument('-n', '--network', default='TinyYoloV2', help='Lightnet model name')
+    parser.add_argument('-c', '--classes', type=int, default=20, help='Number of classes')
+    parser.add_argument('-s', '--size', type=int, default=416, help='Input size of the network')
+    parser.add_argument('-b', '--batch', type=int, default=1, help='Batch size')
+    parser.add_argument('-w', '--warmup', type=int, default=5, help='Number of warm-up iterations')
+    parser.add_argument('-i', '--iterations', type=int, default=20, help='Number of timed iterations')
+    parser.add_argument('--fuse', action='store_true', help='Fuse BatchNorm layers into the convolutions')
+    parser.add_argument('--channels-last', action='store_true', help='Run the network in channels_last memory format')
+    parser.add_argument('--sort', default=None, help='Sort the table by this key (eg. time, flops, params, activation_bytes)')
+    parser.add_argument('--top', type=int, default=None, help='Only show the first TOP layers of the table')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', help='Device to run on')
+    parser.add_argument('--threads', type=int, default=None, help='Number of PyTorch threads')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='Compare two saved JSON profiles instead of profiling a network')
+    parser.add_argument('--key', default='time', help='Key to compare (eg. time, time_min, flops, activation_bytes)')
+    parser.add_argument('-o', '--output', help='Save the profile as JSON')
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        before, after = (ln.network.NetworkProfile.from_json(path) for path in args.compare)
+        print(compare(before, after, args.key))
+        return
+
+    ln.logger.setConsoleLevel('ERROR')
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    network = getattr(ln.models, args.network)(args.classes).to(args.device).eval()
+    if args.fuse:
+        network.fuse()
+    example = torch.rand(args.batch, 3, args.size, args.size, device=args.device)
+    if args.channels_last:
+        network.to_channels_last()
+
+    prof = ln.network.profile(network, example, warmup=args.warmup, iterations=args.iterations)
+    prof.meta.update(network=args.network, fuse=args.fuse, channels_last=args.channels_last, threads=torch.get_num_threads(), lightnet=ln.__version__)
+    print(prof.table(sort=args.sort, top=args.top))
+
+    if args.output is not None:
+        prof.to_json(args.output)
+        print(f'Saved profile to {args.output}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
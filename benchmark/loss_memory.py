@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+#
+#   Benchmark the peak memory of the RegionLoss target building
+#   Copyright EAVISE
+#
+"""
+Measure the peak memory needed to compute the IOU reductions of :class:`~lightnet.network.loss.RegionLoss`,
+by comparing the full ``nGT x (nA*nH*nW)`` IOU matrix with the chunked :func:`~lightnet.network.loss._regionloss.bbox_max_ious`.
+It also measures an entire :class:`~lightnet.network.loss.MultiScaleRegionLoss` forward pass for a YoloV3 network.
+
+On CUDA, the peak memory is measured with :func:`torch.cuda.max_memory_allocated`.
+On CPU, every measurement runs in a fresh process and reports the increase of its maximal resident set size.
+
+Usage:
+    python benchmark/loss_memory.py -s 416 1024 -g 30 300 -o report.json
+    python benchmark/loss_memory.py --device cuda
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import resource
+import sys
+import time
+import torch
+import lightnet as ln
+from lightnet.network.loss._regionloss import bbox_ious, bbox_max_ious, bbox_pair_ious
+
+VARIANTS = ('full', 'chunked', 'loss')
+STRIDE = ln.models.YoloV3.stride
+ANCHORS = [   # Default YoloV3 anchors, in output dimensions (we do not build the network, as its freed weights would hide the RSS increase)
+    [(a[0] / s, a[1] / s) for a in anchors]
+    for anchors, s in zip([[(116, 90), (156, 198), (373, 326)], [(30, 61), (62, 45), (59, 119)], [(10, 13), (16, 30), (33, 23)]], STRIDE)
+]
+
+
+def create_inputs(size, num_gt, batch, device):
+    """ Create random YoloV3 output and ground truth boxes in pixel coordinates. """
+    output = [torch.randn(batch, len(a)*85, size // s, size // s, device=device) for a, s in zip(ANCHORS, STRIDE)]
+
+    gen = torch.Generator().manual_seed(0)
+    wh = torch.rand(batch, num_gt, 2, generator=gen) * (size / 4) + 8
+    xy = torch.rand(batch, num_gt, 2, generator=gen) * (size - wh) + wh / 2
+    return output, torch.cat([xy, wh], -1).to(device)
+
+
+def run(variant, size, num_gt, batch, device):
+    """ Run one variant and return (peak bytes, seconds). """
+    device = torch.device(device)
+    output, gt = create_inputs(size, num_gt, batch, device)
+    stride = STRIDE[-1]
+    nA = len(ANCHORS[-1])
+    nH, nW = output[-1].shape[-2:]
+    pred_boxes = torch.rand(batch, nA*nH*nW, 4, device=device) * torch.tensor([nW, nH, 5, 5], device=device)
+    gt_grid = gt / stride
+    cells = torch.randint(nA*nH*nW, (batch, num_gt), device=device)
+
+    if variant == 'loss':
+        loss = ln.network.loss.MultiScaleRegionLoss(80, ANCHORS, STRIDE)
+        target = torch.zeros(batch, num_gt, 5, device=device)
+        target[..., 1:] = gt / size
+
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats(device)
+        baseline = torch.cuda.memory_allocated(device)
+    else:
+        baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    start = time.perf_counter()
+    if variant == 'full':
+        ious = bbox_ious(gt_grid, pred_boxes)
+        max_iou = ious.max(1)[0]
+        cell_iou = ious.gather(2, cells[..., None])
+        del ious, max_iou, cell_iou
+    elif variant == 'chunked':
+        max_iou = bbox_max_ious(gt_grid, pred_boxes)
+        cell_iou = bbox_pair_ious(gt_grid, pred_boxes.gather(1, cells[..., None].expand(-1, -1, 4)))
+        del max_iou, cell_iou
+    else:
+        loss(output, target, seen=0)
+
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated(device) - baseline
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - baseline
+
+    return peak, time.perf_counter() - start
+
+
+def run_isolated(args):
+    """ Run a measurement in a fresh process, so the CPU resident set size high-water mark is not shared between measurements. """
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(1) as pool:
+        return pool.apply(run, args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the peak memory of the RegionLoss target building')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=[416, 608, 1024], help='Network input sizes')
+    parser.add_argument('-g', '--num-gt', type=int, nargs='+', default=[30, 300], help='Number of ground truth boxes per image')
+    parser.add_argument('-b', '--batch', type=int, default=8, help='Batch size')
+    parser.add_argument('-v', '--variants', nargs='+', choices=VARIANTS, default=list(VARIANTS), help='Variants to measure')
+    parser.add_argument('--device', default='cpu', help='Device to run on')
+    parser.add_argument('-o', '--output', help='Write the JSON report to this file instead of stdout')
+    args = parser.parse_args()
+
+    results = []
+    for size, num_gt, variant in itertools.product(args.sizes, args.num_gt, args.variants):
+        peak, duration = run_isolated((variant, size, num_gt, args.batch, args.device))
+        print(f'size={size:<5d} gt={num_gt:<4d} {variant:<8s} {peak / 2**20:9.1f} MiB {1000 * duration:9.1f} ms', file=sys.stderr)
+        results.append({
+            'size': size,
+            'num_gt': num_gt,
+            'batch': args.batch,
+            'variant': variant,
+            'peak_bytes': peak,
+            'seconds': duration,
+        })
+
+    report = json.dumps({
+        'device': args.device,
+        'torch': torch.__version__,
+        'lightnet': ln.__version__,
+        'results': results,
+    }, indent=2)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+#
+#   Load generator for the dynamic batching predictor
+#   Copyright EAVISE
+#
+"""
+Send single images to a :class:`lightnet.inference.Predictor` and measure the throughput and latency for different batching policies.
+
+There are two load patterns:
+
+- ``closed``: A number of clients each send a request and wait for the answer before sending the next one (like synchronous RPC handlers).
+- ``open``: Requests arrive at a fixed average rate (Poisson process), regardless of how fast they are handled.
+  If the rate is higher than the throughput, the latency keeps growing.
+
+A ``max_batch_size`` of 1 is the baseline of running every request on its own.
+
+Usage:
+    python benchmark/predictor.py -n YoloV2 -b 1 4 8 --mode closed --clients 16
+    python benchmark/predictor.py -n TinyYoloV2 -b 1 8 --mode open --rate 40 --duration 20 -o report.json
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+import numpy as np
+import torch
+import lightnet as ln
+
+
+def get_predictor(args, network, max_batch_size):
+    pre = ln.data.transform.Compose([
+        ln.data.transform.Letterbox((args.size, args.size)),
+        lambda img: torch.from_numpy(img).permute(2, 0, 1).float().div_(255),
+    ])
+    post = ln.data.transform.Compose([
+        ln.data.transform.GetDarknetBoxes(args.conf_thresh, network.stride, network.anchors),
+        ln.data.transform.NMS(0.45),
+        ln.data.transform.TensorToBrambox(list(map(str, range(network.num_classes)))),
+    ])
+    predictor = ln.inference.Predictor(network, pre, post, max_batch_size=max_batch_size, max_latency=args.max_latency, device=args.device)
+    predictor.post.append(ln.data.transform.ReverseLetterbox((args.size, args.size), predictor.image_size))
+    return predictor
+
+
+def run_closed(predictor, images, clients, duration):
+    latencies = []
+    lock = threading.Lock()
+    end = time.perf_counter() + duration
+
+    def client(idx):
+        i = idx
+        while time.perf_counter() < end:
+            start = time.perf_counter()
+            predictor.predict(images[i % len(images)])
+            with lock:
+                latencies.append(time.perf_counter() - start)
+            i += clients
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies, time.perf_counter() - start
+
+
+def run_open(predictor, images, rate, duration, seed=0):
+    rng = np.random.default_rng(seed)
+    latencies = []
+    lock = threading.Lock()
+    futures = []
+
+    def done(submitted):
+        def callback(_):
+            with lock:
+                latencies.append(time.perf_counter() - submitted)
+        return callback
+
+    start = time.perf_counter()
+    next_time = start
+    i = 0
+    while next_time < start + duration:
+        delay = next_time - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        future = predictor.submit(images[i % len(images)])
+        future.add_done_callback(done(time.perf_counter()))
+        futures.append(future)
+        next_time += rng.exponential(1 / rate)
+        i += 1
+
+    for future in futures:
+        future.result()
+    return latencies, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark dynamic batching of single image requests')
+    parser.add_argument('-n', '--network', default='TinyYoloV2', help='Lightnet model name')
+    parser.add_argument('-c', '--classes', type=int, default=20, help='Number of classes')
+    parser.add_argument('-s', '--size', type=int, default=416, help='Input size of the network')
+    parser.add_argument('-b', '--batch-sizes', type=int, nargs='+', default=[1, 4, 8], help='Values of max_batch_size to test')
+    parser.add_argument('-l', '--max-latency', type=float, default=0.01, help='Maximal time to wait for a batch to fill up (seconds)')
+    parser.add_argument('--mode', choices=['closed', 'open'], default='closed', help='Load pattern')
+    parser.add_argument('--clients', type=int, default=16, help='Number of concurrent clients (closed mode)')
+    parser.add_argument('--rate', type=float, default=20, help='Requests per second (open mode)')
+    parser.add_argument('--duration', type=float, default=10, help='Duration of each run (seconds)')
+    parser.add_argument('--image-size', type=int, nargs=2, default=(640, 480), metavar=('WIDTH', 'HEIGHT'), help='Size of the random request images')
+    parser.add_argument('--conf-thresh', type=float, default=0.5, help='Confidence threshold')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', help='Device to run on')
+    parser.add_argument('--threads', type=int, default=None, help='Number of PyTorch threads')
+    parser.add_argument('-o', '--output', help='Write the JSON report to this file instead of stdout')
+    args = parser.parse_args()
+
+    ln.logger.setConsoleLevel('ERROR')
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    network = getattr(ln.models, args.network)(args.classes).to(args.device).eval()
+    rng = np.random.default_rng(0)
+    images = [rng.integers(0, 256, (args.image_size[1], args.image_size[0], 3), dtype=np.uint8) for _ in range(16)]
+
+    results = []
+    for max_batch_size in args.batch_sizes:
+        with get_predictor(args, network, max_batch_size) as predictor:
+            predictor.predict(images[0])    # Warmup
+            predictor.num_batches = predictor.num_images = 0
+            if args.mode == 'closed':
+                latencies, elapsed = run_closed(predictor, images, args.clients, args.duration)
+            else:
+                latencies, elapsed = run_open(predictor, images, args.rate, args.duration)
+
+        latencies = np.asarray(latencies) * 1000
+        result = {
+            'max_batch_size': max_batch_size,
+            'requests': len(latencies),
+            'throughput': len(latencies) / elapsed,
+            'mean_batch_size': predictor.mean_batch_size,
+            'latency_ms': {
+                'mean': float(latencies.mean()),
+                'p50': float(np.percentile(latencies, 50)),
+                'p90': float(np.percentile(latencies, 90)),
+                'p99': float(np.percentile(latencies, 99)),
+            },
+        }
+        results.append(result)
+        print(
+            f'max_batch_size {max_batch_size:3d}: {result["throughput"]:7.1f} img/s  '
+            f'batch {result["mean_batch_size"]:5.2f}  '
+            f'latency p50 {result["latency_ms"]["p50"]:7.1f}ms  p99 {result["latency_ms"]["p99"]:7.1f}ms',
+            file=sys.stderr,
+        )
+
+    report = json.dumps({
+        'network': args.network,
+        'size': args.size,
+        'device': args.device,
+        'threads': torch.get_num_threads(),
+        'mode': args.mode,
+        'clients': args.clients if args.mode == 'closed' else None,
+        'rate': args.rate if args.mode == 'open' else None,
+        'max_latency': args.max_latency,
+        'torch': torch.__version__,
+        'lightnet': ln.__version__,
+        'results': results,
+    }, indent=2)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+#
+#   Benchmark int8 post-training quantization
+#   Copyright EAVISE
+#
+"""
+Quantize networks with :func:`lightnet.network.quantize` and compare them with their fp32 (and batchnorm fused) versions.
+For each network, this script reports the latency per batch and the following accuracy measures of the int8 network:
+
+- ``relative_error``: Relative L2 error of the raw network output(s), compared to fp32
+- ``agreement_ap``: Average precision of the int8 detections, when using the fp32 detections as ground truth
+- ``ap_fp32`` and ``ap_int8``: Average precision on the annotations, if a dataset factory is given
+
+By default, the networks are randomly initialized and calibrated on random images,
+which gives a good indication of the latency, but not of the accuracy drop on real data.
+Pass trained weights and a ``file.py:function`` factory, which returns a :class:`lightnet.data.Dataset` with annotations,
+to measure the actual accuracy delta.
+
+Usage:
+    python benchmark/quantize.py -n TinyYoloV2 TinyYoloV3 MobileYoloV2 -o report.json
+    python benchmark/quantize.py -n TinyYoloV2 --weights weights.pt --factory my_project.py:get_test_dataset --classes 20
+"""
+import argparse
+import importlib.util
+import itertools
+import json
+import statistics
+import sys
+import time
+import warnings
+import pandas as pd
+import torch
+import brambox as bb
+import lightnet as ln
+
+
+def load_factory(spec):
+    """ Load a ``file.py:function`` dataset factory. """
+    path, _, name = spec.rpartition(':')
+    module_spec = importlib.util.spec_from_file_location('dataset_factory', path)
+    module = importlib.util.module_from_spec(module_spec)
+    module_spec.loader.exec_module(module)
+    return getattr(module, name)()
+
+
+def get_postprocessing(network, conf_thresh, nms_thresh):
+    if isinstance(network.stride, (list, tuple)):
+        boxes = ln.data.transform.GetMultiScaleDarknetBoxes(conf_thresh, network.stride, network.anchors)
+    else:
+        boxes = ln.data.transform.GetDarknetBoxes(conf_thresh, network.stride, network.anchors)
+
+    return ln.data.transform.Compose([
+        boxes,
+        ln.data.transform.NMS(nms_thresh),
+        ln.data.transform.TensorToBrambox(list(map(str, range(network.num_classes)))),
+    ])
+
+
+def latency(network, batch, repeat, warmup=2):
+    """ Median time in seconds to run a batch through the network. """
+    times = []
+    with torch.no_grad():
+        for i in range(warmup + repeat):
+            start = time.perf_counter()
+            network(batch)
+            if i >= warmup:
+                times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def run_detections(network, batches, post):
+    """ Run batches through a network and return the raw outputs and a brambox detection dataframe. """
+    outputs, dets = [], []
+    with torch.no_grad():
+        for i, (data, _) in enumerate(batches):
+            output = network(data)
+            outputs.append(output if isinstance(output, (list, tuple)) else [output])
+            det = post(output)
+            det['image'] = pd.Categorical(det['image'].astype(int) + i * len(data))
+            dets.append(det)
+    return outputs, bb.util.concat(dets, ignore_index=True)
+
+
+def average_precision(det, anno):
+    if len(anno) == 0:
+        return None
+    if len(det) == 0:
+        return 0.0
+    return float(bb.stat.ap(bb.stat.pr(det, anno, 0.5, ignore=False)))
+
+
+def benchmark(name, args, calibration, evaluation):
+    network = getattr(ln.models, name)(args.classes).eval()
+    if args.weights is not None:
+        network.load(args.weights, strict=False)
+
+    qnetwork = ln.network.quantize(network, calibration, backend=args.backend)
+    fused = ln.models.__dict__[name](args.classes).eval()
+    fused.load_state_dict(network.state_dict())
+    fused.fuse()
+
+    batch = evaluation[0][0]
+    result = {
+        'network': name,
+        'latency_ms': {
+            'fp32': 1000 * latency(network, batch, args.repeat),
+            'fp32_fused': 1000 * latency(fused, batch, args.repeat),
+            'int8': 1000 * latency(qnetwork, batch, args.repeat),
+        },
+    }
+
+    post = get_postprocessing(network, args.conf_thresh, args.nms_thresh)
+    out_fp32, det_fp32 = run_detections(network, evaluation, post)
+    out_int8, det_int8 = run_detections(qnetwork, evaluation, post)
+    errors = [float((q - f).norm() / f.norm()) for fo, qo in zip(out_fp32, out_int8) for f, q in zip(fo, qo)]
+    result['relative_error'] = statistics.mean(errors)
+
+    pseudo_anno = det_fp32.drop(columns=['confidence']).assign(ignore=False)
+    result['agreement_ap'] = average_precision(det_int8, pseudo_anno)
+    result['detections'] = {'fp32': len(det_fp32), 'int8': len(det_int8)}
+
+    if args.factory is not None:
+        anno = bb.util.concat([a.assign(image=pd.Categorical(a['batch_number'].astype(int) + i * len(d))) for i, (d, a) in enumerate(evaluation)], ignore_index=True)
+        anno['class_label'] = anno['class_label'].astype(str)
+        result['ap_fp32'] = average_precision(det_fp32, anno)
+        result['ap_int8'] = average_precision(det_int8, anno)
+
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark int8 post-training quantization of lightnet networks')
+    parser.add_argument('-n', '--networks', nargs='+', default=['TinyYoloV2', 'TinyYoloV3', 'MobileYoloV2'], help='Lightnet model names')
+    parser.add_argument('-c', '--classes', type=int, default=20, help='Number of classes')
+    parser.add_argument('-s', '--size', type=int, default=416, help='Input size for random images')
+    parser.add_argument('-b', '--batch-size', type=int, default=1, help='Batch size')
+    parser.add_argument('--weights', help='Weight file to load in the networks (only makes sense for a single network)')
+    parser.add_argument('--factory', help='file.py:function that returns an annotated dataset (default: random images)')
+    parser.add_argument('--calibration-batches', type=int, default=8, help='Number of batches for calibration')
+    parser.add_argument('--eval-batches', type=int, default=8, help='Number of batches for the accuracy measures')
+    parser.add_argument('--repeat', type=int, default=10, help='Number of runs to measure the latency')
+    parser.add_argument('--threads', type=int, default=None, help='Number of PyTorch threads')
+    parser.add_argument('--backend', default='x86', help='Quantized engine')
+    parser.add_argument('--conf-thresh', type=float, default=0.25, help='Confidence threshold')
+    parser.add_argument('--nms-thresh', type=float, default=0.45, help='NMS threshold')
+    parser.add_argument('-o', '--output', help='Write the JSON report to this file instead of stdout')
+    args = parser.parse_args()
+
+    warnings.filterwarnings('ignore', module='torch.ao.quantization')
+    ln.logger.setConsoleLevel('ERROR')
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    if args.factory is not None:
+        dataset = load_factory(args.factory)
+        loader = ln.data.DataLoader(dataset, batch_size=args.batch_size, collate_fn=ln.data.brambox_collate)
+        batches = itertools.chain.from_iterable(itertools.repeat(loader))
+        calibration = [b[0] for b in itertools.islice(batches, args.calibration_batches)]
+        evaluation = list(itertools.islice(iter(loader), args.eval_batches))
+    else:
+        gen = torch.Generator().manual_seed(0)
+        shape = (args.batch_size, 3, args.size, args.size)
+        calibration = [torch.rand(shape, generator=gen) for _ in range(args.calibration_batches)]
+        evaluation = [(torch.rand(shape, generator=gen), None) for _ in range(args.eval_batches)]
+
+    results = []
+    for name in args.networks:
+        result = benchmark(name, args, calibration, evaluation)
+        lat = result['latency_ms']
+        print(f'{name:<15s} fp32 {lat["fp32"]:8.1f}ms  fused {lat["fp32_fused"]:8.1f}ms  int8 {lat["int8"]:8.1f}ms  rel. error {result["relative_error"]:.4f}', file=sys.stderr)
+        results.append(result)
+
+    report = json.dumps({
+        'dataset': args.factory or 'random',
+        'backend': args.backend,
+        'threads': torch.get_num_threads(),
+        'torch': torch.__version__,
+        'lightnet': ln.__version__,
+        'results': results,
+    }, indent=2)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+#
+#   Benchmark the cold-start of networks
+#   Copyright EAVISE
+#
+"""
+Measure how long it takes to create a network and load its weights from a PyTorch file, for every bundled model.
+Every measurement runs in a fresh Python process, which reports the time to import PyTorch and Lightnet (including the model),
+the time to build the network, the time to load the weights and the increase of the peak resident memory (RSS) while loading.
+
+The following load paths are compared:
+
+- ``copy``: ``network.load(path, mmap=False)`` which reads the complete file in memory and then copies it into the parameters
+- ``mmap``: ``network.load(path)`` which memory-maps the file and copies the tensors straight from the mapping into the parameters
+- ``assign``: ``network.load(path, assign=True)`` which uses the memory-mapped tensors as parameters, without copying
+
+Note that the weights file is in the page cache after the first run, so this measures a warm start of the process and not a cold disk read.
+
+Usage:
+    python benchmark/startup.py -o report.json
+    python benchmark/startup.py -n YoloV3 Darknet53 -r 5
+"""
+import argparse
+import inspect
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+MODES = {
+    'copy': {'mmap': False},
+    'mmap': {},
+    'assign': {'assign': True},
+}
+
+
+def child(network, classes, path, mode):
+    """ Run a single measurement and print it as JSON. """
+    start = time.perf_counter()
+    import torch
+    import_torch = time.perf_counter() - start
+
+    start = time.perf_counter()
+    import lightnet as ln
+    getattr(ln.models, network)
+    import_lightnet = time.perf_counter() - start
+    ln.logger.setConsoleLevel('ERROR')
+
+    start = time.perf_counter()
+    net = getattr(ln.models, network)(classes).eval()
+    build = time.perf_counter() - start
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    net.load(path, **MODES[mode])
+    load = time.perf_counter() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+
+    # Touch the weights, so that lazily mapped pages are included in the first forward time
+    start = time.perf_counter()
+    with torch.no_grad():
+        sum(float(p.sum()) for p in net.parameters())
+    touch = time.perf_counter() - start
+
+    print(json.dumps({
+        'import_torch': import_torch,
+        'import_lightnet': import_lightnet,
+        'build': build,
+        'load': load,
+        'touch': touch,
+        'rss_mb': rss / 1024,
+    }))
+
+
+def model_names():
+    import torch
+    import lightnet as ln
+    return [
+        name for name in dir(ln.models)
+        if inspect.isclass(getattr(ln.models, name)) and issubclass(getattr(ln.models, name), torch.nn.Module)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark network creation and weight loading time')
+    parser.add_argument('-n', '--networks', nargs='+', default=None, help='Lightnet model names; Default all models')
+    parser.add_argument('-c', '--classes', type=int, default=20, help='Number of classes')
+    parser.add_argument('-m', '--modes', nargs='+', default=list(MODES), choices=list(MODES), help='Load paths to compare')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Number of processes per measurement (the median is reported)')
+    parser.add_argument('-o', '--output', help='Write the JSON report to this file instead of stdout')
+    parser.add_argument('--child', nargs=4, metavar=('NETWORK', 'CLASSES', 'PATH', 'MODE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        network, classes, path, mode = args.child
+        child(network, int(classes), path, mode)
+        return
+
+    import torch
+    import lightnet as ln
+    ln.logger.setConsoleLevel('ERROR')
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for network in args.networks or model_names():
+            try:
+                net = getattr(ln.models, network)(args.classes)
+            except Exception as err:
+                print(f'{network:24s} skipped [{err}]', file=sys.stderr)
+                continue
+            path = os.path.join(tmp, f'{network}.pt')
+            net.save(path)
+            size = os.path.getsize(path) / 2**20
+            del net
+
+            results[network] = {'file_mb': size}
+            for mode in args.modes:
+                runs = []
+                for _ in range(args.repeat):
+                    out = subprocess.run(
+                        [sys.executable, __file__, '--child', network, str(args.classes), path, mode],
+                        check=True, capture_output=True, text=True,
+                    )
+                    runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+                results[network][mode] = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+
+            line = '  '.join(
+                f'{mode} {results[network][mode]["load"] * 1000:7.1f}ms/{results[network][mode]["rss_mb"]:6.1f}MB'
+                for mode in args.modes
+            )
+            first = results[network][args.modes[0]]
+            print(f'{network:24s} {size:7.1f}MB  import {first["import_lightnet"] * 1000:6.1f}ms  {line}', file=sys.stderr)
+
+    report = json.dumps({
+        'classes': args.classes,
+        'repeat': args.repeat,
+        'torch': torch.__version__,
+        'lightnet': ln.__version__,
+        'results': results,
+    }, indent=2)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
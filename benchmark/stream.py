@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+#
+#   Benchmark pipelined video inference
+#   Copyright EAVISE
+#
+"""
+Compare running decode, pre-processing, network and post-processing one after another for every frame,
+with running them concurrently in a :class:`lightnet.inference.StreamPipeline`.
+
+Frames come from a video file, camera or folder of images (``--source``),
+or from a synthetic source that spends ``--decode-time`` seconds on every frame to mimic video decoding.
+
+Usage:
+    python benchmark/stream.py -n YoloV2 --frames 200 --decode-time 0.01
+    python benchmark/stream.py -n TinyYoloV2 --source video.mp4 --batch-size 4 -o report.json
+"""
+import argparse
+import itertools
+import json
+import sys
+import time
+import numpy as np
+import torch
+import lightnet as ln
+
+
+def synthetic_frames(num, width, height, decode_time):
+    rng = np.random.default_rng(0)
+    frames = [rng.integers(0, 256, (height, width, 3), dtype=np.uint8) for _ in range(8)]
+    for i in range(num):
+        time.sleep(decode_time)
+        yield frames[i % len(frames)].copy()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark pipelined inference on a stream of frames')
+    parser.add_argument('-n', '--network', default='TinyYoloV2', help='Lightnet model name')
+    parser.add_argument('-c', '--classes', type=int, default=20, help='Number of classes')
+    parser.add_argument('-s', '--size', type=int, default=416, help='Input size of the network')
+    parser.add_argument('--source', default=None, help='Video file, camera index or folder of images; Default synthetic frames')
+    parser.add_argument('--frames', type=int, default=100, help='Number of frames to process')
+    parser.add_argument('--image-size', type=int, nargs=2, default=(1280, 720), metavar=('WIDTH', 'HEIGHT'), help='Size of the synthetic frames')
+    parser.add_argument('--decode-time', type=float, default=0.005, help='Time to "decode" a synthetic frame (seconds)')
+    parser.add_argument('-b', '--batch-size', type=int, default=1, help='Batch size of the pipeline')
+    parser.add_argument('-w', '--workers', type=int, default=2, help='Number of pre-processing threads')
+    parser.add_argument('-q', '--queue-size', type=int, default=4, help='Size of the queues between the stages')
+    parser.add_argument('--conf-thresh', type=float, default=0.5, help='Confidence threshold')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', help='Device to run on')
+    parser.add_argument('--threads', type=int, default=None, help='Number of PyTorch threads')
+    parser.add_argument('-o', '--output', help='Write the JSON report to this file instead of stdout')
+    args = parser.parse_args()
+
+    ln.logger.setConsoleLevel('ERROR')
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    def frames():
+        if args.source is None:
+            return synthetic_frames(args.frames, *args.image_size, args.decode_time)
+        source = int(args.source) if args.source.isdigit() else args.source
+        return itertools.islice(ln.inference.read_frames(source), args.frames)
+
+    network = getattr(ln.models, args.network)(args.classes).to(args.device).eval()
+    pre = ln.data.transform.Compose([
+        ln.data.transform.Letterbox((args.size, args.size)),
+        lambda img: torch.from_numpy(img).permute(2, 0, 1).float().div_(255),
+    ])
+    pipeline = ln.inference.StreamPipeline(
+        network, pre, None,
+        batch_size=args.batch_size, workers=args.workers, queue_size=args.queue_size, device=args.device,
+    )
+    pipeline.post = ln.data.transform.Compose([
+        ln.data.transform.GetDarknetBoxes(args.conf_thresh, network.stride, network.anchors),
+        ln.data.transform.NMS(0.45),
+        ln.data.transform.TensorToBrambox(list(map(str, range(network.num_classes)))),
+        ln.data.transform.ReverseLetterbox((args.size, args.size), pipeline.image_size),
+    ])
+
+    # Warmup
+    with torch.no_grad():
+        network(torch.rand(args.batch_size, 3, args.size, args.size, device=args.device))
+
+    # Sequential
+    start = time.perf_counter()
+    num_sequential = 0
+    with torch.no_grad():
+        for frame in frames():
+            data = pre(frame)[None].to(args.device)
+            pipeline.post(network(data))
+            num_sequential += 1
+    sequential = time.perf_counter() - start
+
+    # Pipelined
+    start = time.perf_counter()
+    num_pipelined = sum(1 for _ in pipeline(frames()))
+    pipelined = time.perf_counter() - start
+
+    stages = {
+        stage: {key: value * 1000 for key, value in stats.items()}
+        for stage, stats in pipeline.statistics().items()
+    }
+    print(f'sequential: {num_sequential / sequential:7.1f} fps', file=sys.stderr)
+    print(f'pipelined:  {num_pipelined / pipelined:7.1f} fps', file=sys.stderr)
+    for stage, stats in stages.items():
+        print(f'  {stage:8s} mean {stats["mean"]:7.1f}ms  p99 {stats["p99"]:7.1f}ms', file=sys.stderr)
+
+    report = json.dumps({
+        'network': args.network,
+        'size': args.size,
+        'device': args.device,
+        'threads': torch.get_num_threads(),
+        'source': args.source,
+        'batch_size': args.batch_size,
+        'workers': args.workers,
+        'queue_size': args.queue_size,
+        'torch': torch.__version__,
+        'lightnet': ln.__version__,
+        'sequential_fps': num_sequential / sequential,
+        'pipelined_fps': num_pipelined / pipelined,
+        'stage_latency_ms': stages,
+    }, indent=2)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,14 +3,20 @@
 #   Copyright EAVISE
 #
 
-__all__ = ['data', 'engine', 'models', 'network', 'prune']
+__all__ = ['data', 'engine', 'inference', 'models', 'network', 'prune']
 
 
+import importlib
 from .version import __version__
 from .log import *
 
-from . import data
-from . import engine
-from . import models
-from . import network
-from . import prune
+
+def __getattr__(name):
+    """ Import the subpackages when they are first used, which keeps ``import lightnet`` fast. """
+    if name in __all__:
+        return importlib.import_module(f'.{name}', __name__)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
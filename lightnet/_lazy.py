@@ -0,0 +1,60 @@
+#
+#   Lazy loading of modules
+#   Copyright EAVISE
+#
+import importlib
+import importlib.util
+
+__all__ = ['LazyModule', 'lazy_import']
+
+
+class LazyModule:
+    """ Stand-in for a module, which only gets imported when one of its attributes is first accessed.
+
+    Args:
+        name (str): Full name of the module (eg. 'PIL.Image')
+    """
+    def __init__(self, name):
+        object.__setattr__(self, '_lazy_name', name)
+        object.__setattr__(self, '_lazy_module', None)
+
+    def _load(self):
+        module = object.__getattribute__(self, '_lazy_module')
+        if module is None:
+            module = importlib.import_module(object.__getattribute__(self, '_lazy_name'))
+            object.__setattr__(self, '_lazy_module', module)
+        return module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        name = object.__getattribute__(self, '_lazy_name')
+        state = 'loaded' if object.__getattribute__(self, '_lazy_module') is not None else 'not loaded'
+        return f'<lazy module {name!r} ({state})>'
+
+
+def lazy_import(name):
+    """ Get a :class:`LazyModule` for an optional dependency. |br|
+    This function only checks whether the top-level package is installed, without importing it.
+
+    Args:
+        name (str): Full name of the module (eg. 'PIL.Image')
+
+    Returns:
+        LazyModule or None: Lazy module or **None** if the package is not installed
+    """
+    try:
+        spec = importlib.util.find_spec(name.partition('.')[0])
+    except (ImportError, ValueError):
+        spec = None
+
+    if spec is None:
+        return None
+    return LazyModule(name)
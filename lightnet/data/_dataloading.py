@@ -8,6 +8,7 @@ import logging
 import collections
 from functools import wraps
 import torch
+import torch.distributed as dist
 from torch.utils.data.dataset import Dataset as torchDataset
 from torch.utils.data.sampler import BatchSampler as torchBatchSampler
 from torch.utils.data.dataloader import DataLoader as torchDataLoader
@@ -79,14 +80,52 @@ class Dataset(torchDataset):
 
         return wrapper
 
+    def __getitems__(self, indices):
+        """ Get the data for multiple indices at once. |br|
+        The PyTorch dataloader calls this method with all the indices of a (mini-)batch, instead of calling ``__getitem__`` for each index separately.
+        This default implementation simply fetches each item sequentially,
+        but subclasses can override it to fetch the data of an entire batch more efficiently (eg. concurrent image loading).
+
+        Args:
+            indices (list): Indices or (input_dim, index) tuples of the items to fetch
+
+        Returns:
+            list: Data for each of the indices
+
+        Example:
+            >>> class CustomSet(ln.data.Dataset):
+            ...     def __len__(self):
+            ...         return 10
+            ...     @ln.data.Dataset.resize_getitem
+            ...     def __getitem__(self, index):
+            ...         return index, self.input_dim
+            >>> data = CustomSet((200,200))
+            >>> data.__getitems__([0, 1])
+            [(0, (200, 200)), (1, (200, 200))]
+            >>> data.__getitems__([((480,320), 2), ((480,320), 3)])
+            [(2, (480, 320)), (3, (480, 320))]
+        """
+        return [self[index] for index in indices]
+
 
 class DataLoader(torchDataLoader):
     """ Lightnet dataloader that enables on the fly resizing of the images.
     See :class:`torch.utils.data.DataLoader` for more information on the arguments.
 
+    Args:
+        *args: Positional arguments for :class:`torch.utils.data.DataLoader`
+        distributed (bool, optional): Whether to shard the data over the processes of a distributed training, with a :class:`torch.utils.data.distributed.DistributedSampler`; Default **True if torch.distributed is initialized**
+        **kwargs: Keyword arguments for :class:`torch.utils.data.DataLoader`
+
     Note:
         This dataloader only works with :class:`lightnet.data.Dataset` based datasets.
 
+    Note:
+        When ``distributed`` is enabled, :func:`change_input_dim` broadcasts the new dimension of rank 0 to all other ranks,
+        so that every rank resizes to the same dimension.
+        This means that all ranks need to call this function together (eg. in a :func:`~lightnet.engine.Engine.batch_end` hook),
+        as a rank that calls it on its own blocks until the others do the same.
+
     Example:
         >>> class CustomSet(ln.data.Dataset):
         ...     def __len__(self):
@@ -118,9 +157,13 @@ class DataLoader(torchDataLoader):
         [[tensor([480, 480]), tensor([320, 320])]]
         [[tensor([480, 480]), tensor([320, 320])]]
     """
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, distributed=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.__initialized = False
+        if distributed is None:
+            distributed = dist.is_available() and dist.is_initialized()
+        self.distributed = distributed
+
         shuffle = False
         sampler = None
         batch_sampler = None
@@ -150,7 +193,9 @@ class DataLoader(torchDataLoader):
         # Use custom BatchSampler
         if batch_sampler is None:
             if sampler is None:
-                if shuffle:
+                if distributed:
+                    sampler = torch.utils.data.distributed.DistributedSampler(self.dataset, shuffle=shuffle)
+                elif shuffle:
                     sampler = torch.utils.data.sampler.RandomSampler(self.dataset)
                 else:
                     sampler = torch.utils.data.sampler.SequentialSampler(self.dataset)
@@ -181,6 +226,10 @@ class DataLoader(torchDataLoader):
         Note:
             You can set the ``random_range`` argument to **None** to set an exact size of multiply. |br|
             See the example above for how this works.
+
+        Warning:
+            If this dataloader was created with ``distributed`` enabled, all ranks must call this function together.
+            See the note of :class:`~lightnet.data.DataLoader` for more information.
         """
         if random_range is None:
             size = 1
@@ -192,10 +241,25 @@ class DataLoader(torchDataLoader):
         else:
             size = (size * multiple[0], size * multiple[1])
 
+        if self.distributed:
+            sizes = [size]
+            dist.broadcast_object_list(sizes, 0)
+            size = sizes[0]
+
         self.batch_sampler.new_input_dim = size
 
         return size
 
+    def set_epoch(self, epoch):
+        """ Set the epoch on the sampler, if it supports this (eg. :class:`torch.utils.data.distributed.DistributedSampler`). |br|
+        Distributed samplers use this number to seed their shuffling, so that every epoch gets a different order.
+
+        Args:
+            epoch (int): Epoch number
+        """
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
 
 class BatchSampler(torchBatchSampler):
     """ This batch sampler will generate mini-batches of (dim, index) tuples from another sampler.
@@ -2,27 +2,26 @@
 #   Lightnet optional dependencies
 #   Copyright EAVISE
 #
+#   The dependencies are only imported when they are first used, which keeps ``import lightnet`` fast.
+#
 import logging
+from .._lazy import lazy_import
 
 __all__ = ['pd', 'bb', 'cv2', 'Image', 'ImageOps']
 log = logging.getLogger(__name__)
 
-try:
-    import pandas as pd
-    import brambox as bb
-except ModuleNotFoundError:
+pd = lazy_import('pandas')
+bb = lazy_import('brambox')
+if pd is None or bb is None:
     log.warning('Brambox is not installed and thus all data functionality related to it cannot be used')
     pd = None
     bb = None
 
-try:
-    import cv2
-except ModuleNotFoundError:
+cv2 = lazy_import('cv2')
+if cv2 is None:
     log.warning('OpenCV is not installed and cannot be used')
-    cv2 = None
 
-try:
-    from PIL import Image, ImageOps
-except ModuleNotFoundError:
+Image = lazy_import('PIL.Image')
+ImageOps = lazy_import('PIL.ImageOps')
+if Image is None:
     log.warning('Pillow is not installed and cannot be used')
-    Image, ImageOps = None, None
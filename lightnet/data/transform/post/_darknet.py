@@ -21,6 +21,15 @@ class GetDarknetBoxes(BaseTransform):
 
     Returns:
         (Tensor [Boxes x 7]]): **[batch_num, x_tl, y_tl, x_br, y_br, confidence, class_id]** for every bounding box
+
+    Note:
+        Reduced precision network output (eg. from :class:`torch.autocast`) gets decoded in fp32,
+        as the box coordinates would otherwise lose too much precision.
+        For fp32 (or fp64) output, the boxes are decoded in-place in the output tensor.
+
+    Note:
+        Network output in the :attr:`torch.channels_last` memory format (see :func:`lightnet.network.module.Lightnet.to_channels_last`)
+        is decoded in place as well, without converting it back to a contiguous tensor first.
     """
     def __init__(self, conf_thresh, network_stride, anchors):
         super().__init__()
@@ -31,16 +40,23 @@ class GetDarknetBoxes(BaseTransform):
         self.anchors_step = torch.tensor(self.anchors.shape[1])
 
     def forward(self, network_output):
+        with torch.autocast(network_output.device.type, enabled=False):
+            return self._decode(network_output)
+
+    def _decode(self, network_output):
         device = network_output.device
+        dtype = torch.promote_types(network_output.dtype, torch.float32)
+        network_output = network_output.to(dtype)
         batch, channels, h, w = network_output.shape
         num_classes = (channels // self.num_anchors) - 5
 
         # Compute xc,yc, w,h, box_score on Tensor
-        lin_x = torch.linspace(0, w-1, w).repeat(h, 1).view(h*w).to(device)
-        lin_y = torch.linspace(0, h-1, h).view(h, 1).repeat(1, w).view(h*w).to(device)
-        anchor_w = self.anchors[:, 0].contiguous().view(1, self.num_anchors, 1).to(device)
-        anchor_h = self.anchors[:, 1].contiguous().view(1, self.num_anchors, 1).to(device)
+        lin_x = torch.linspace(0, w-1, w, dtype=dtype, device=device).repeat(h, 1).view(h*w)
+        lin_y = torch.linspace(0, h-1, h, dtype=dtype, device=device).view(h, 1).repeat(1, w).view(h*w)
+        anchor_w = self.anchors[:, 0].contiguous().view(1, self.num_anchors, 1).to(device, dtype)
+        anchor_h = self.anchors[:, 1].contiguous().view(1, self.num_anchors, 1).to(device, dtype)
 
+        # This view does not copy data for contiguous and channels_last output
         network_output = network_output.view(batch, self.num_anchors, -1, h*w)          # -1 == 5+num_classes (we can drop feature maps if 1 class)
         network_output[:, :, 0, :].sigmoid_().add_(lin_x).mul_(self.network_stride)     # X center
         network_output[:, :, 1, :].sigmoid_().add_(lin_y).mul_(self.network_stride)     # Y center
@@ -53,7 +69,7 @@ class GetDarknetBoxes(BaseTransform):
             with torch.no_grad():
                 cls_scores = torch.nn.functional.softmax(network_output[:, :, 5:, :], 2)
             cls_max, cls_max_idx = torch.max(cls_scores, 2)
-            cls_max_idx = cls_max_idx.float()
+            cls_max_idx = cls_max_idx.to(dtype)
             cls_max.mul_(network_output[:, :, 4, :])
         else:
             cls_max = network_output[:, :, 4, :]
@@ -61,7 +77,7 @@ class GetDarknetBoxes(BaseTransform):
 
         score_thresh = cls_max > self.conf_thresh
         if score_thresh.sum() == 0:
-            return torch.empty(0, 7, device=device)
+            return torch.empty(0, 7, dtype=dtype, device=device)
         else:
             # Mask select boxes > conf_thresh
             coords = network_output.transpose(2, 3)[..., 0:4]
@@ -75,7 +91,7 @@ class GetDarknetBoxes(BaseTransform):
             nums = torch.arange(1, batch+1, dtype=torch.uint8, device=batch_num.device)
             batch_num = (batch_num * nums[:, None])[batch_num] - 1
 
-            return torch.cat([batch_num[:, None].float(), coords, scores[:, None], idx[:, None]], dim=1)
+            return torch.cat([batch_num[:, None].to(dtype), coords, scores[:, None], idx[:, None]], dim=1)
 
 
 def GetBoundingBoxes(*args, **kwargs):
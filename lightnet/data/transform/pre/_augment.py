@@ -7,7 +7,7 @@ import random
 import math
 import numpy as np
 import torch
-from ..util import BaseTransform, BaseMultiTransform
+from ..util import BaseTransform, BaseMultiTransform, fill_border
 from ..._imports import cv2, Image
 
 __all__ = ['RandomFlip', 'RandomHSV', 'RandomJitter', 'RandomRotate']
@@ -249,8 +249,7 @@ class RandomJitter(BaseMultiTransform):
         self._get_params(im_w, im_h)
         crop_w = self.crop[2] - self.crop[0]
         crop_h = self.crop[3] - self.crop[1]
-        shape = np.array(img).shape
-        channels = shape[2] if len(shape) > 2 else 1
+        channels = len(img.getbands())
 
         img = img.crop((max(0, self.crop[0]), max(0, self.crop[1]), min(im_w, self.crop[2]), min(im_h, self.crop[3])))
         img_crop = Image.new(img.mode, (crop_w, crop_h), color=(int(self.fill_color*255),)*channels)
@@ -264,7 +263,7 @@ class RandomJitter(BaseMultiTransform):
 
         crop_w = self.crop[2] - self.crop[0]
         crop_h = self.crop[3] - self.crop[1]
-        img_crop = np.ones((crop_h, crop_w) + img.shape[2:], dtype=img.dtype) * int(self.fill_color*255)
+        img_crop = np.empty((crop_h, crop_w) + img.shape[2:], dtype=img.dtype)
 
         src_x1 = max(0, self.crop[0])
         src_x2 = min(self.crop[2], im_w)
@@ -274,6 +273,7 @@ class RandomJitter(BaseMultiTransform):
         dst_x2 = crop_w - max(0, self.crop[2]-im_w)
         dst_y1 = max(0, -self.crop[1])
         dst_y2 = crop_h - max(0, self.crop[3]-im_h)
+        fill_border(img_crop, (dst_x1, dst_y1, dst_x2, dst_y2), int(self.fill_color*255))
         img_crop[dst_y1:dst_y2, dst_x1:dst_x2] = img[src_y1:src_y2, src_x1:src_x2]
 
         return img_crop
@@ -284,7 +284,7 @@ class RandomJitter(BaseMultiTransform):
 
         crop_w = self.crop[2] - self.crop[0]
         crop_h = self.crop[3] - self.crop[1]
-        img_crop = torch.full((img.shape[0], crop_h, crop_w), self.fill_color, dtype=img.dtype)
+        img_crop = img.new_empty((img.shape[0], crop_h, crop_w))
 
         src_x1 = max(0, self.crop[0])
         src_x2 = min(self.crop[2], im_w)
@@ -294,6 +294,7 @@ class RandomJitter(BaseMultiTransform):
         dst_x2 = crop_w - max(0, self.crop[2]-im_w)
         dst_y1 = max(0, -self.crop[1])
         dst_y2 = crop_h - max(0, self.crop[3]-im_h)
+        fill_border(img_crop, (dst_x1, dst_y1, dst_x2, dst_y2), self.fill_color)
         img_crop[:, dst_y1:dst_y2, dst_x1:dst_x2] = img[:, src_y1:src_y2, src_x1:src_x2]
 
         return img_crop
@@ -4,10 +4,10 @@
 #
 
 import random
-import collections
+import collections.abc
 import numpy as np
 import torch
-from ..util import BaseMultiTransform
+from ..util import BaseMultiTransform, fill_border
 from ..._imports import cv2, Image, ImageOps
 
 __all__ = ['Crop', 'Letterbox', 'Pad', 'FitAnno']
@@ -146,9 +146,25 @@ class Letterbox(BaseMultiTransform):
         dataset (lightnet.data.Dataset, optional): Dataset that uses this transform; Default **None**
         fill_color (int or float, optional): Fill color to be used for padding (if int, will be divided by 255); Default **0.5**
 
+    Attributes:
+        self.out (np.ndarray or torch.Tensor): Preallocated output buffer for the next OpenCV or PyTorch image (see Note); Default **None**
+
     Note:
         Create 1 Letterbox object and use it for both image and annotation transforms.
         This object will save data from the image transform and use that on the annotation transform.
+
+    Note:
+        OpenCV and PyTorch images are rescaled directly into their place in the output image and only the borders get filled with the ``fill_color``. |br|
+        You can set the ``out`` attribute to an array or tensor of the final network size (eg. a slice of a preallocated batch tensor),
+        in which case the next image will be written in that buffer instead of allocating a new one.
+        The buffer is only used for one image, after which the attribute is reset to **None**.
+
+        >>> lb = ln.data.transform.Letterbox((416, 416))
+        >>> batch = torch.empty(4, 3, 416, 416)
+        >>> for i in range(4):
+        ...     lb.out = batch[i]
+        ...     img = lb(torch.rand(3, 300, 500))
+        ...     assert img.data_ptr() == batch[i].data_ptr()
     """
     def __init__(self, dimension=None, dataset=None, fill_color=0.5):
         super().__init__()
@@ -160,6 +176,7 @@ class Letterbox(BaseMultiTransform):
 
         self.pad = None
         self.scale = None
+        self.out = None
 
     def _get_params(self, im_w, im_h):
         if self.dataset is not None:
@@ -193,8 +210,7 @@ class Letterbox(BaseMultiTransform):
 
         # Pad
         if self.pad is not None:
-            shape = np.array(img).shape
-            channels = shape[2] if len(shape) > 2 else 1
+            channels = len(img.getbands())
             img = ImageOps.expand(img, border=self.pad, fill=(int(self.fill_color*255),)*channels)
 
         return img
@@ -202,40 +218,66 @@ class Letterbox(BaseMultiTransform):
     def _tf_cv(self, img):
         im_h, im_w = img.shape[:2]
         self._get_params(im_w, im_h)
+        if self.scale == 1 and self.pad is None and self.out is None:
+            return img
+
+        # Output
+        res_w, res_h = int(im_w*self.scale+0.5), int(im_h*self.scale+0.5)
+        pad = self.pad if self.pad is not None else (0, 0, 0, 0)
+        out = self._get_output((res_h+pad[1]+pad[3], res_w+pad[0]+pad[2]) + img.shape[2:], img.dtype)
+        region = (pad[0], pad[1], pad[0]+res_w, pad[1]+res_h)
+        if self.pad is not None:
+            fill_border(out, region, int(self.fill_color*255))
 
         # Rescale
+        dst = out[region[1]:region[3], region[0]:region[2]]
         if self.scale != 1:
-            img = cv2.resize(img, (int(im_w*self.scale+0.5), int(im_h*self.scale+0.5)), interpolation=cv2.INTER_LINEAR)
-
-        # Pad
-        if self.pad is not None:
-            channels = img.shape[2] if len(img.shape) > 2 else 1
-            img = cv2.copyMakeBorder(img, self.pad[1], self.pad[3], self.pad[0], self.pad[2], cv2.BORDER_CONSTANT, value=(int(self.fill_color*255),)*channels)
+            cv2.resize(img, (res_w, res_h), dst=dst, interpolation=cv2.INTER_LINEAR)
+        else:
+            dst[:] = img
 
-        return img
+        return out
 
     def _tf_torch(self, img):
         im_h, im_w = img.shape[-2:]
         self._get_params(im_w, im_h)
+        if self.scale == 1 and self.pad is None and self.out is None:
+            return img
 
         # Rescale
         if self.scale != 1:
-            if img.ndim == 3:
-                img = img[None, ...]
-            elif img.ndim == 2:
-                img = img[None, None, ...]
+            shape = img.shape[:-2]
+            img = img.reshape(1, -1, im_h, im_w)
             img = torch.nn.functional.interpolate(
                 img,
                 size=(int(im_h*self.scale+0.5), int(im_w*self.scale+0.5)),
                 mode='bilinear',
                 align_corners=False,
-            ).squeeze().clamp(min=0, max=255)
-
-        # Pad
+            ).clamp(min=0, max=255)
+            img = img.reshape(shape + img.shape[-2:])
+
+        # Output
+        res_h, res_w = img.shape[-2:]
+        pad = self.pad if self.pad is not None else (0, 0, 0, 0)
+        out = self._get_output(img.shape[:-2] + (res_h+pad[1]+pad[3], res_w+pad[0]+pad[2]), img.dtype, img)
+        region = (pad[0], pad[1], pad[0]+res_w, pad[1]+res_h)
         if self.pad is not None:
-            img = torch.nn.functional.pad(img, (self.pad[0], self.pad[2], self.pad[1], self.pad[3]), value=self.fill_color)
+            fill_border(out, region, self.fill_color)
 
-        return img
+        out[..., region[1]:region[3], region[0]:region[2]] = img
+        return out
+
+    def _get_output(self, shape, dtype, tensor=None):
+        """ Get the preallocated output buffer or allocate a new one. """
+        out, self.out = self.out, None
+        if out is None:
+            if tensor is not None:
+                return tensor.new_empty(shape)
+            return np.empty(shape, dtype=dtype)
+
+        if tuple(out.shape) != tuple(shape) or out.dtype != dtype:
+            raise ValueError(f'Output buffer does not match the letterboxed image [{tuple(out.shape)}, {out.dtype} != {tuple(shape)}, {dtype}]')
+        return out
 
     def _tf_anno(self, anno):
         anno = anno.copy()
@@ -315,8 +357,7 @@ class Pad(BaseMultiTransform):
 
         # Pad
         if self.pad is not None:
-            shape = np.array(img).shape
-            channels = shape[2] if len(shape) > 2 else 1
+            channels = len(img.getbands())
             img = ImageOps.expand(img, border=self.pad, fill=(int(self.fill_color*255),)*channels)
 
         return img
@@ -419,7 +460,7 @@ class FitAnno(BaseMultiTransform):
         with np.errstate(divide='ignore', invalid='ignore'):
             # Filter
             if self.filter:
-                if isinstance(self.filter_threshold, collections.Sequence):
+                if isinstance(self.filter_threshold, collections.abc.Sequence):
                     mask = (
                         ((crop_width / anno.width.values) >= self.filter_threshold[0])
                         & ((crop_height / anno.height.values) >= self.filter_threshold[1])
@@ -4,6 +4,8 @@
 #   Copyright EAVISE
 #
 
+import os
+import time
 import logging
 from abc import ABC, abstractmethod
 import numpy as np
@@ -227,8 +229,24 @@ class Compose(list):
         True
         >>> 'RandomCrop' in pipeline
         False
+
+        Profiling:
+
+        >>> pipeline = ln.data.transform.Compose([
+        ...     ln.data.transform.RandomHSV(hue=1, saturation=2, value=2),
+        ...     ln.data.transform.Letterbox(dimension=(416, 416)),
+        ... ])
+        >>> pipeline.start_profiling(num_workers=4)
+        >>> img = pipeline(torch.rand(3, 480, 640))
+        >>> stats = pipeline.profiling_stats()
+        >>> stats['letterbox']['calls']
+        1
+        >>> stats['letterbox']['time'] > 0
+        True
     """
     multi_tf = (BaseMultiTransform,)
+    __profile = None
+    __profile_view = (None, None)
 
     def __call__(self, data):
         """ Run your data through the transformation pipeline.
@@ -236,6 +254,10 @@ class Compose(list):
         Args:
             data: The data to modify. If it is a tuple, only the first item will be transformed, unless the transform is an instance of self.multi_tf.
         """
+        stats = self._profile_stats()
+        if stats is not None:
+            return self._call_profiled(data, stats)
+
         if isinstance(data, tuple) and any(isinstance(d, pd.DataFrame) for d in data):
             for tf in self:
                 if isinstance(tf, self.multi_tf):
@@ -248,6 +270,110 @@ class Compose(list):
 
         return data
 
+    def _call_profiled(self, data, stats):
+        """ Same as ``__call__``, but keeps track of the number of calls and the time spent in each transform. """
+        multi = isinstance(data, tuple) and any(isinstance(d, pd.DataFrame) for d in data)
+        for i, tf in enumerate(self):
+            start = time.perf_counter()
+            if not multi:
+                data = tf(data)
+            elif isinstance(tf, self.multi_tf):
+                data = tuple(tf(d) for d in data)
+            else:
+                data = tuple(d if isinstance(d, pd.DataFrame) else tf(d) for d in data)
+            stats[i, 0] += 1
+            stats[i, 1] += time.perf_counter() - start
+
+        return data
+
+    def start_profiling(self, num_workers=0):
+        """ Start keeping track of the number of calls and the time spent in each transform of this pipeline.
+
+        The statistics are stored in shared memory, with a separate row for each :class:`~torch.utils.data.DataLoader` worker process.
+        This means the statistics get aggregated over all workers and can be queried from the main process at any time,
+        while the workers never need to synchronize with each other.
+        Profiling only adds a few timer calls per transform, so it is cheap enough to always leave on.
+
+        Args:
+            num_workers (int, optional): Number of dataloader workers that will use this pipeline; Default **0**
+
+        Note:
+            You need to start profiling before creating the dataloader workers, so that they share the statistics with the main process. |br|
+            The statistics are tracked per index in the pipeline, so you should call this method again after adding or removing transforms.
+            Until then, profiling is disabled for this pipeline.
+
+        Warning:
+            If there are more workers than ``num_workers``, some workers will share a row, which might result in slightly inaccurate statistics.
+        """
+        stats = torch.zeros((num_workers + 1, len(self), 2), dtype=torch.float64).share_memory_()
+        self.__profile = (stats, tuple(_get_name(tf) for tf in self))
+        self.__profile_view = (None, None)
+
+    def stop_profiling(self):
+        """ Stop profiling this pipeline and discard the gathered statistics. """
+        self.__profile = None
+        self.__profile_view = (None, None)
+
+    def reset_profiling(self):
+        """ Reset the gathered profiling statistics to zero, without stopping the profiling. """
+        if self.__profile is not None:
+            self.__profile[0].zero_()
+
+    def profiling_stats(self, per_worker=False):
+        """ Get the profiling statistics of this pipeline.
+
+        Args:
+            per_worker (boolean, optional): Whether to return the statistics of each worker separately; Default **False**
+
+        Returns:
+            dict or list: ``{name: {'calls': int, 'time': float}}`` dictionary (or list of dictionaries per worker, the first being the main process).
+            The transforms are named like in :meth:`~lightnet.data.transform.Compose.__getitem__` and the time is the total wall time in seconds.
+
+        Note:
+            If multiple transforms in this pipeline have the same name, their statistics get summed.
+        """
+        if self.__profile is None:
+            return [] if per_worker else {}
+
+        stats, names = self.__profile
+        stats = stats.tolist() if per_worker else [stats.sum(0).tolist()]
+        result = []
+        for worker in stats:
+            worker_stats = {}
+            for name, (calls, duration) in zip(names, worker):
+                if name in worker_stats:
+                    worker_stats[name]['calls'] += int(calls)
+                    worker_stats[name]['time'] += duration
+                else:
+                    worker_stats[name] = {'calls': int(calls), 'time': duration}
+            result.append(worker_stats)
+
+        return result if per_worker else result[0]
+
+    def _profile_stats(self):
+        """ Get the NumPy view of the profiling row of the current process, or None if profiling is disabled. """
+        if self.__profile is None:
+            return None
+
+        # The pipeline might have changed since profiling started, so we always check the length
+        stats = self.__profile[0]
+        if stats.shape[1] != len(self):
+            return None
+
+        pid, view = self.__profile_view
+        if pid != os.getpid():
+            worker = torch.utils.data.get_worker_info()
+            row = 0 if worker is None else (worker.id + 1) % stats.shape[0]
+            view = stats[row].numpy()
+            self.__profile_view = (os.getpid(), view)
+
+        return view
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_Compose__profile_view', None)
+        return state
+
     def __getitem__(self, index):
         """ Get a specific item from the transformation list.
 
@@ -259,7 +385,7 @@ class Compose(list):
         """
         if isinstance(index, str):
             index = index.lower()
-            keys = tuple(tf.__class__.__name__.lower() if tf.__class__.__name__ != 'function' else tf.__name__.lower() for tf in self)
+            keys = tuple(_get_name(tf) for tf in self)
             if index not in keys:
                 raise KeyError(f'[{index}] not found in transforms')
 
@@ -273,7 +399,7 @@ class Compose(list):
         For classes, we use `tf.__class__.__name__.lower()`, otherwise we use `tf.__name__.lower()`.
         """
         if isinstance(key, str):
-            keys = tuple(tf.__class__.__name__.lower() if tf.__class__.__name__ != 'function' else tf.__name__.lower() for tf in self)
+            keys = tuple(_get_name(tf) for tf in self)
             return key.lower() in keys
         else:
             return super().__getitem__(index)
@@ -305,3 +431,43 @@ class Compose(list):
 
     def __rmul__(self, other):
         return Compose(other.__mul__(self))
+
+
+def _get_name(tf):
+    """ Name of a transformation, as used by :class:`~lightnet.data.transform.Compose`. """
+    return tf.__class__.__name__.lower() if tf.__class__.__name__ != 'function' else tf.__name__.lower()
+
+
+def fill_border(img, region, value):
+    """ Fill everything outside of a region of an image with a certain value.
+    This function works in-place on both NumPy arrays (HW[C]) and PyTorch tensors ([C]HW).
+
+    Args:
+        img (np.ndarray or torch.Tensor): Image to fill
+        region (tuple): (x1, y1, x2, y2) region that should not be filled
+        value (Number): value to fill the image with
+
+    Returns:
+        np.ndarray or torch.Tensor: The image that was passed to this function
+
+    Note:
+        This function allows to fill only the borders of a preallocated output image,
+        instead of filling the entire image before copying another image in the region.
+    """
+    if isinstance(img, torch.Tensor):
+        h, w = img.shape[-2:]
+        dims = (Ellipsis,)
+    else:
+        h, w = img.shape[:2]
+        dims = ()
+
+    x1, y1, x2, y2 = region
+    if x1 >= x2 or y1 >= y2:
+        img[dims + (slice(None), slice(None))] = value
+        return img
+
+    img[dims + (slice(0, y1), slice(None))] = value
+    img[dims + (slice(y2, h), slice(None))] = value
+    img[dims + (slice(y1, y2), slice(0, x1))] = value
+    img[dims + (slice(y1, y2), slice(x2, w))] = value
+    return img
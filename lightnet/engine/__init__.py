@@ -3,6 +3,10 @@ Lightnet Engine Module |br|
 This module contains classes and functions to manage the training of your networks.
 """
 
+from ._checkpoint import *
+from ._distributed import *
 from ._engine import *
+from ._evaluator import *
 from ._parameter import *
 from ._scheduler import *
+from ._timer import *
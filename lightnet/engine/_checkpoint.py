@@ -0,0 +1,132 @@
+#
+#   Asynchronous checkpoint writing
+#   Copyright EAVISE
+#
+import copy
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import torch
+
+__all__ = ['AsyncCheckpointer']
+log = logging.getLogger(__name__)
+
+
+class AsyncCheckpointer:
+    """ Save checkpoints on a background thread, so that training does not stall while writing them to disk. |br|
+    When saving, the state is first copied to CPU memory, so that it can safely be modified afterwards.
+    The serialization then happens on a background thread, which writes to a temporary file and atomically renames it,
+    so that you never end up with partially written checkpoints.
+
+    Args:
+        max_in_flight (int, optional): Maximum number of checkpoints that are waiting to be written; Default **1**
+
+    Note:
+        When there are already ``max_in_flight`` checkpoints waiting to be written,
+        :func:`save` blocks until one of them is finished.
+        This bounds the amount of CPU memory used by the snapshots.
+
+    Note:
+        Errors that happen while writing a checkpoint are raised on the next call to :func:`save` or :func:`flush`.
+
+    Example:
+        >>> checkpointer = ln.engine.AsyncCheckpointer()
+        >>> network = ln.models.YoloV2(20)
+        >>> network.save('weights.pt', checkpointer=checkpointer)    # doctest: +SKIP
+        >>> # Continue training...
+        >>> checkpointer.flush()                                     # doctest: +SKIP
+    """
+    def __init__(self, max_in_flight=1):
+        if max_in_flight < 1:
+            raise ValueError('max_in_flight should be at least 1')
+
+        self.max_in_flight = max_in_flight
+        self.__executor = ThreadPoolExecutor(1, thread_name_prefix='lightnet-checkpoint')
+        self.__slots = threading.BoundedSemaphore(max_in_flight)
+        self.__pending = []
+        self.__lock = threading.Lock()
+
+    def save(self, state, filename):
+        """ Snapshot a state and write it to a file in the background.
+
+        Args:
+            state (dict): State to save with :func:`torch.save`
+            filename (str or path): File to write the state to
+        """
+        self.__raise_errors()
+        self.__slots.acquire()
+        try:
+            state = _snapshot(state)
+            future = self.__executor.submit(self.__write, state, os.fspath(filename))
+        except BaseException:
+            self.__slots.release()
+            raise
+
+        with self.__lock:
+            self.__pending.append(future)
+
+    def flush(self):
+        """ Wait until all pending checkpoints are written and raise any error that happened while writing them. """
+        with self.__lock:
+            pending = list(self.__pending)
+
+        for future in pending:
+            future.exception()
+
+        self.__raise_errors()
+
+    def close(self):
+        """ Flush all pending checkpoints and stop the background thread. """
+        try:
+            self.flush()
+        finally:
+            self.__executor.shutdown()
+
+    @property
+    def in_flight(self):
+        """ Number of checkpoints that are not yet written. """
+        with self.__lock:
+            return sum(not future.done() for future in self.__pending)
+
+    def __write(self, state, filename):
+        try:
+            tmp = f'{filename}.tmp'
+            torch.save(state, tmp)
+            os.replace(tmp, filename)
+            log.debug(f'Saved checkpoint {filename}')
+        finally:
+            self.__slots.release()
+
+    def __raise_errors(self):
+        with self.__lock:
+            done = [future for future in self.__pending if future.done()]
+            self.__pending = [future for future in self.__pending if not future.done()]
+
+        for future in done:
+            if future.exception() is not None:
+                raise future.exception()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(max_in_flight={self.max_in_flight}, in_flight={self.in_flight})'
+
+
+def _snapshot(state):
+    """ Copy a (nested) state to CPU memory, so that it is not affected by further modifications. """
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    elif isinstance(state, dict):
+        copied = copy.copy(state)     # Keeps the type and attributes (eg. _metadata of module state dicts)
+        for k, v in state.items():
+            copied[k] = _snapshot(v)
+        return copied
+    elif isinstance(state, (list, tuple)) and not hasattr(state, '_fields'):
+        return type(state)(_snapshot(v) for v in state)
+    else:
+        return copy.deepcopy(state)
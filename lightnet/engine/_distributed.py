@@ -0,0 +1,90 @@
+#
+#   Distributed data-parallel helpers
+#   Copyright EAVISE
+#
+import logging
+import socket
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+__all__ = ['launch', 'get_rank', 'get_world_size']
+log = logging.getLogger(__name__)
+
+
+def launch(fn, world_size, *args, backend='gloo', init_method=None):
+    """ Launch a function in multiple processes, which are set up for distributed training. |br|
+    Each process initializes the default :mod:`torch.distributed` process group and then calls ``fn(rank, *args)``.
+
+    Args:
+        fn (callable): Function to run in each process (should be picklable, eg. a module level function)
+        world_size (int): Number of processes to launch
+        *args: Extra arguments that are passed to the function
+        backend (str, optional): :mod:`torch.distributed` backend; Default **gloo**
+        init_method (str, optional): URL to initialize the process group; Default **tcp on a free local port**
+
+    Note:
+        When using the *nccl* backend, each process sets its default CUDA device to ``cuda:<rank>``.
+
+    Example:
+        >>> def train(rank, params_file):   # doctest: +SKIP
+        ...     params = ln.engine.HyperParameters.from_file(params_file)
+        ...     engine = CustomEngine(params, ln.data.DataLoader(params.dataset, batch_size=8, shuffle=True))
+        ...     engine()
+        >>> ln.engine.launch(train, 4, 'params.py')  # doctest: +SKIP
+    """
+    if init_method is None:
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            init_method = f'tcp://127.0.0.1:{s.getsockname()[1]}'
+
+    mp.spawn(_run, args=(fn, world_size, backend, init_method, args), nprocs=world_size, join=True)
+
+
+def _run(rank, fn, world_size, backend, init_method, args):
+    if backend == 'nccl':
+        torch.cuda.set_device(rank)
+
+    dist.init_process_group(backend, init_method=init_method, rank=rank, world_size=world_size)
+    try:
+        fn(rank, *args)
+    finally:
+        dist.destroy_process_group()
+
+
+def get_rank():
+    """ Get the rank of this process, which is **0** if we are not running distributed. """
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank()
+    return 0
+
+
+def get_world_size():
+    """ Get the number of distributed processes, which is **1** if we are not running distributed. """
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_world_size()
+    return 1
+
+
+def _broadcast_module(module, src=0):
+    """ Broadcast the parameters and buffers of a module from one rank to all the others. """
+    for tensor in list(module.parameters()) + list(module.buffers()):
+        dist.broadcast(tensor.data, src)
+
+
+def _all_reduce_gradients(parameters):
+    """ Average the gradients of parameters across all ranks. |br|
+    The gradients are flattened into one buffer per dtype and device, in order to reduce the number of collective calls.
+    """
+    groups = {}
+    for p in parameters:
+        if p.grad is not None:
+            groups.setdefault((p.grad.dtype, p.grad.device), []).append(p.grad)
+
+    world_size = dist.get_world_size()
+    for grads in groups.values():
+        flat = torch.cat([g.reshape(-1) for g in grads])
+        dist.all_reduce(flat)
+        flat /= world_size
+        for g, reduced in zip(grads, flat.split([g.numel() for g in grads])):
+            g.copy_(reduced.view_as(g))
@@ -6,8 +6,12 @@
 import logging
 import signal
 from abc import ABC, abstractmethod
+import torch
 
 import lightnet as ln
+from ._checkpoint import AsyncCheckpointer
+from ._timer import PhaseTimer
+from ._distributed import get_rank, get_world_size, _all_reduce_gradients, _broadcast_module
 
 __all__ = ['Engine']
 log = logging.getLogger(__name__)
@@ -44,6 +48,13 @@ class Engine(ABC):
         self.params: HyperParameter object
         self.dataloader: Dataloader object
         self.sigint: Boolean value indicating whether a SIGINT (CTRL+C) was send; Default **False**
+        self.mixed_precision: Whether to run :func:`process_batch` with automatic mixed precision; Default **False**
+        self.amp_dtype: Reduced precision dtype used when running with mixed precision; Default **torch.float16 on GPU, torch.bfloat16 on CPU**
+        self.grad_scaler: :class:`torch.amp.GradScaler` used when running with mixed precision (only enabled for float16)
+        self.checkpointer: :class:`~lightnet.engine.AsyncCheckpointer` to save backups in the background, which gets flushed when the engine stops
+        self.timer: :class:`~lightnet.engine.PhaseTimer` which measures the time spent in each phase of the training loop
+        self.timer_log_interval: Number of batches between logging the timings of the training loop or **None** to disable logging; Default **None**
+        self.evaluator: Optional :class:`~lightnet.engine.EvaluationWorker` whose results get passed to :func:`evaluated`; Default **None**
         self.*: All values that were passed with the init function and all values from the :class:`~lightnet.engine.HyperParameters` can be accessed in this class
 
     Note:
@@ -85,6 +96,80 @@ class Engine(ABC):
         ...             self.batch_start(self.backup_rate)(backup)
         ...
         >>> # Create TrainingEngine object and run it
+
+    Note:
+        You can enable automatic mixed precision by setting a ``mixed_precision`` attribute to **True** on your engine or hyperparameters.
+        The engine then runs :func:`process_batch` inside of a :class:`torch.autocast` context
+        and creates a :class:`torch.amp.GradScaler` (when using float16) to prevent gradients from underflowing.
+        In order for this to work, you should use the :func:`backward` and :func:`step` methods of the engine,
+        instead of calling ``loss.backward()`` and ``optimizer.step()`` yourself:
+
+        >>> class TrainingEngine(ln.engine.Engine):
+        ...     def process_batch(self, data):
+        ...         data, target = data
+        ...         output = self.network(data)                                     # Runs with autocast
+        ...         loss = self.loss(output, target) / self.batch_subdivisions
+        ...         self.backward(loss)                                             # Scales the loss
+        ...
+        ...     def train_batch(self):
+        ...         self.step(self.optim, max_grad_norm=10)                         # Unscales gradients and skips the step on overflow
+        ...         self.optim.zero_grad()
+        ...         self.log(f'Loss scale: {self.loss_scale}')
+        >>> # Create TrainingEngine object with ``mixed_precision=True`` and run it
+
+        If you want the state of the gradient scaler to be saved with your hyperparameters (eg. to resume training),
+        you can store a ``grad_scaler`` in your :class:`~lightnet.engine.HyperParameters` and the engine will use that one.
+
+    Note:
+        The engine supports distributed data-parallel training.
+        Launch your training function with :func:`~lightnet.engine.launch` and create the engine and its :class:`~lightnet.data.DataLoader` in that function.
+        The dataloader then shards the dataset over the processes and the engine takes care of the following:
+
+        - Broadcasting the network weights of rank 0 to all other ranks when starting.
+        - Setting the epoch on the sampler of the dataloader, so that every epoch gets shuffled differently.
+        - Averaging the gradients across all ranks with :func:`sync_gradients`, which :func:`step` calls right before performing the optimizer step.
+
+        If you override :func:`step` or perform the optimizer step yourself, you need to call :func:`sync_gradients` before stepping.
+        The engine raises an error if a batch was trained without synchronizing the gradients, as the replicas would silently diverge otherwise.
+
+        Hooks that should only run in one process (eg. saving backups), can be registered with ``main_only=True``:
+
+        >>> class TrainingEngine(ln.engine.Engine):
+        ...     @ln.engine.Engine.epoch_end(main_only=True)
+        ...     def backup(self):
+        ...         pass    # This method will only be executed on rank 0
+
+    Note:
+        Saving backups can take a long time for big networks, which stalls your training.
+        You can use the ``self.checkpointer`` of the engine to write them on a background thread instead.
+        The engine waits for all pending backups to be written when it stops (including when stopping because of a SIGINT or SIGTERM).
+
+        >>> class TrainingEngine(ln.engine.Engine):
+        ...     @ln.engine.Engine.batch_end(1000)
+        ...     def backup(self):
+        ...         self.params.save(f'backup-{self.batch}.state.pt', checkpointer=self.checkpointer)
+
+    Note:
+        The engine measures how much time is spent per batch in each phase of the training loop:
+        waiting for the dataloader (*data*), :func:`process_batch`, :func:`train_batch` and running the hooks (*hooks*). |br|
+        You can get rolling statistics and the throughput in images per second from ``self.timer.stats()``,
+        eg. to export them to your metrics system in a ``batch_end`` hook.
+        Alternatively, you can set a ``timer_log_interval`` attribute to periodically log them.
+
+    Note:
+        Instead of running your validation in a hook, which blocks the training,
+        you can set an ``evaluator`` attribute with an :class:`~lightnet.engine.EvaluationWorker` and submit the weights to it in a hook.
+        The engine checks for finished evaluations after every batch and passes their results to :func:`evaluated`.
+        When the engine stops, it waits for the last submitted evaluation to finish and stops the worker.
+        If the engine stops because of an error, the worker gets terminated right away and :func:`evaluated` is not called anymore.
+
+        >>> class TrainingEngine(ln.engine.Engine):
+        ...     @ln.engine.Engine.epoch_end(main_only=True)
+        ...     def validate(self):
+        ...         self.evaluator.submit(self.network, self.batch)
+        ...
+        ...     def evaluated(self, tag, results):
+        ...         print(f'Batch {tag}: mAP {results["mAP"]:.2f}')
     """
     __init_done = False
     _required_attr = ['network', 'batch_size', 'dataloader']
@@ -117,47 +202,77 @@ class Engine(ABC):
         """ Start the training cycle. """
         self.__check_attr()
         self.start()
-
-        log.info('Start training')
-        self.network.train()
-
-        idx = 0
-        while True:
-            # Check if we need to stop training
-            if self.quit() or self.sigint:
-                log.info('Reached quitting criteria')
-                return
-
-            # Epoch Start
-            self._run_hooks(self.epoch + 1, self._epoch_start)
-
-            idx %= self.batch_subdivisions
-            loader = self.dataloader
-            for idx, data in enumerate(loader, idx+1):
-                # Batch Start
-                if (idx - 1) % self.batch_subdivisions == 0:
-                    self._run_hooks(self.batch + 1, self._batch_start)
-
-                # Forward and backward on (mini-)batches
-                self.process_batch(data)
-                if idx % self.batch_subdivisions != 0:
-                    continue
-
-                # Optimizer step
-                self.batch += 1     # Should only be called after train, but this is easier to use self.batch in function
-                self.train_batch()
-
-                # Batch End
-                self._run_hooks(self.batch, self._batch_end)
-
+        self.__setup_amp()
+        self.__setup_distributed()
+
+        failed = False
+        try:
+            log.info('Start training')
+            self.network.train()
+
+            idx = 0
+            self.timer.reset()
+            self.timer.mark()
+            while True:
                 # Check if we need to stop training
                 if self.quit() or self.sigint:
                     log.info('Reached quitting criteria')
                     return
 
-            # Epoch End
-            self.epoch += 1
-            self._run_hooks(self.epoch, self._epoch_end)
+                # Epoch Start
+                self._run_hooks(self.epoch + 1, self._epoch_start)
+                self.timer.lap('hooks')
+
+                idx %= self.batch_subdivisions
+                loader = self.dataloader
+                if hasattr(loader, 'set_epoch'):
+                    loader.set_epoch(self.epoch)
+                for idx, data in enumerate(loader, idx+1):
+                    self.timer.lap('data')
+
+                    # Batch Start
+                    if (idx - 1) % self.batch_subdivisions == 0:
+                        self._run_hooks(self.batch + 1, self._batch_start)
+                        self.timer.lap('hooks')
+
+                    # Forward and backward on (mini-)batches
+                    with self.autocast():
+                        self.process_batch(data)
+                    self.timer.lap('process_batch')
+                    if idx % self.batch_subdivisions != 0:
+                        continue
+
+                    # Optimizer step
+                    self.batch += 1     # Should only be called after train, but this is easier to use self.batch in function
+                    self.train_batch()
+                    self.timer.lap('train_batch')
+                    if self.world_size > 1 and self.__synced_batch != self.batch:
+                        raise RuntimeError(f'Gradients were not synchronized across ranks in batch {self.batch}; call sync_gradients() before the optimizer step')
+
+                    # Batch End
+                    self._run_hooks(self.batch, self._batch_end)
+                    self.timer.lap('hooks')
+                    self.timer.end_batch(self.batch_size)
+                    if self.timer_log_interval and self.batch % self.timer_log_interval == 0:
+                        self.log(f'Timings: {self.timer}')
+                    if self.evaluator is not None:
+                        for tag, results in self.evaluator.poll():
+                            self.evaluated(tag, results)
+
+                    # Check if we need to stop training
+                    if self.quit() or self.sigint:
+                        log.info('Reached quitting criteria')
+                        return
+
+                # Epoch End
+                self.epoch += 1
+                self._run_hooks(self.epoch, self._epoch_end)
+                self.timer.lap('hooks')
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            self.__shutdown(failed)
 
     def __getattr__(self, name):
         if hasattr(self.params, name):
@@ -187,6 +302,155 @@ class Engine(ABC):
         elif self.batch_size % self.mini_batch_size != 0 or self.mini_batch_size > self.batch_size:
             raise ValueError('batch_size should be a multiple of mini_batch_size')
 
+        if not hasattr(self, 'mixed_precision'):
+            self.mixed_precision = False
+        if not hasattr(self, 'checkpointer'):
+            self.checkpointer = AsyncCheckpointer()
+        if not hasattr(self, 'timer'):
+            self.timer = PhaseTimer()
+        if not hasattr(self, 'timer_log_interval'):
+            self.timer_log_interval = None
+        if not hasattr(self, 'evaluator'):
+            self.evaluator = None
+
+    def __shutdown(self, failed):
+        """ Wait for the pending checkpoints and stop the evaluation worker.
+        If training stopped because of an error, errors in here get logged instead of raised, so that they do not hide the original error.
+        """
+        error = None
+        try:
+            if self.checkpointer.in_flight:
+                log.info(f'Waiting for {self.checkpointer.in_flight} checkpoint(s) to be written')
+            self.checkpointer.flush()
+        except Exception as err:
+            if failed:
+                log.error(f'Could not write the pending checkpoints [{err}]')
+            else:
+                error = err
+                failed = True
+
+        if self.evaluator is not None:
+            if failed:
+                try:
+                    self.evaluator.close(wait=False)
+                except Exception as err:
+                    log.error(f'Evaluation worker failed [{err}]')
+            else:
+                if self.evaluator.busy:
+                    log.info('Waiting for the evaluation worker to finish')
+                for tag, results in self.evaluator.close():
+                    self.evaluated(tag, results)
+
+        if error is not None:
+            raise error
+
+    def __setup_amp(self):
+        param = next(self.network.parameters(), None)
+        self.__device_type = param.device.type if param is not None else 'cpu'
+
+        if not hasattr(self, 'amp_dtype'):
+            self.amp_dtype = torch.float16 if self.__device_type == 'cuda' else torch.bfloat16
+
+        # GradScaler is only needed for float16, as bfloat16 has the same range as float32
+        enabled = self.mixed_precision and self.amp_dtype == torch.float16
+        if not hasattr(self, 'grad_scaler'):
+            self.grad_scaler = torch.amp.GradScaler(self.__device_type, enabled=enabled)
+        elif self.grad_scaler.is_enabled() != enabled:
+            log.warning(f'grad_scaler is {"enabled" if self.grad_scaler.is_enabled() else "disabled"}, but mixed_precision={self.mixed_precision} with amp_dtype={self.amp_dtype}')
+
+        if self.mixed_precision:
+            log.info(f'Training with mixed precision [{self.amp_dtype}, device={self.__device_type}, grad_scaler={self.grad_scaler.is_enabled()}]')
+
+    def __setup_distributed(self):
+        self.rank = get_rank()
+        self.world_size = get_world_size()
+        self.__synced_batch = None
+        if self.world_size > 1:
+            log.info(f'Distributed training [rank={self.rank}, world_size={self.world_size}]')
+            _broadcast_module(self.network)
+
+    def autocast(self):
+        """ Get the autocasting context manager which the engine uses to run :func:`process_batch`. |br|
+        This is a disabled context if ``self.mixed_precision`` is **False**.
+
+        Return:
+            torch.autocast: Autocasting context manager
+        """
+        return torch.autocast(self.__device_type, dtype=self.amp_dtype, enabled=self.mixed_precision)
+
+    def backward(self, loss):
+        """ Run a backward pass of a loss, scaling it with the gradient scaler if necessary. |br|
+        The backward pass gets run outside of the autocasting context.
+
+        Args:
+            loss (torch.Tensor): Loss value to backpropagate
+
+        Note:
+            When using mini-batches, the scale stays the same for all (mini-)batches that are accumulated before :func:`step`.
+            You still need to average your loss over the mini-batches yourself (see :func:`process_batch`).
+        """
+        with torch.autocast(self.__device_type, enabled=False):
+            self.grad_scaler.scale(loss).backward()
+
+    def step(self, *optimizers, max_grad_norm=None):
+        """ Perform an optimizer step with the accumulated gradients. |br|
+        When using a gradient scaler, the gradients are first unscaled and the step gets skipped if they contain infinite or NaN values.
+        Afterwards, the scale of the gradient scaler gets updated. |br|
+        When training distributed, the gradients are first averaged across all ranks with :func:`sync_gradients`.
+
+        Args:
+            *optimizers (torch.optim.Optimizer): Optimizers to step
+            max_grad_norm (number, optional): Clip the (unscaled) gradient norm of the parameters of each optimizer to this value; Default **None**
+
+        Return:
+            Boolean: Whether the optimizer step was performed (**False** if it was skipped because of an overflow)
+
+        """
+        scale = self.grad_scaler.get_scale()
+        self.sync_gradients(*optimizers)
+
+        for optim in optimizers:
+            if max_grad_norm is not None:
+                self.grad_scaler.unscale_(optim)
+                torch.nn.utils.clip_grad_norm_([p for group in optim.param_groups for p in group['params']], max_grad_norm)
+            self.grad_scaler.step(optim)
+
+        self.grad_scaler.update()
+        if self.grad_scaler.get_scale() < scale:
+            log.debug(f'Gradient overflow detected, skipping optimizer step and reducing loss scale to {self.grad_scaler.get_scale()}')
+            return False
+
+        return True
+
+    def sync_gradients(self, *optimizers):
+        """ Average the gradients of the parameters of the optimizers across all ranks. |br|
+        This function does nothing if we are not training distributed.
+
+        Args:
+            *optimizers (torch.optim.Optimizer): Optimizers of which to synchronize the gradients
+
+        Note:
+            This function is called by :func:`step`.
+            If you override :func:`step` or step your optimizers yourself, you should call this function before stepping,
+            otherwise the engine raises a :class:`RuntimeError` at the end of :func:`train_batch`.
+
+        Warning:
+            Every rank should have computed gradients for the same parameters and all ranks must call this function together.
+        """
+        if self.world_size > 1:
+            _all_reduce_gradients([p for optim in optimizers for group in optim.param_groups for p in group['params']])
+            self.__synced_batch = self.batch
+
+    @property
+    def loss_scale(self):
+        """ Current scale of the gradient scaler, which can be logged to monitor mixed precision training. |br|
+        This is **1.0** if the gradient scaler is disabled.
+
+        Return:
+            float: Loss scale
+        """
+        return self.grad_scaler.get_scale() if self.grad_scaler.is_enabled() else 1.0
+
     def log(self, msg):
         """ Log messages about training and testing.
         This function will automatically prepend the messages with **TRAIN** or **TEST**.
@@ -204,18 +468,21 @@ class Engine(ABC):
         keys = list(hooks.keys())
         for k in keys:
             if value % k == 0:
-                for fn in hooks[k]:
+                for fn, main_only in hooks[k]:
+                    if main_only and self.rank != 0:
+                        continue
                     if hasattr(fn, '__self__'):
                         fn()
                     else:
                         fn(self)
 
     @classmethod
-    def epoch_start(cls, interval=1):
+    def epoch_start(cls, interval=1, main_only=False):
         """ Register a hook to run at the start of an epoch.
 
         Args:
             interval (int, optional): Number dictating how often to run the hook; Default **1**
+            main_only (bool, optional): Only run the hook on rank 0 when training distributed; Default **False**
 
         Note:
             The `self.epoch` attribute contains the number of processed epochs,
@@ -226,35 +493,37 @@ class Engine(ABC):
         """
         def decorator(fn):
             if interval in cls._epoch_start:
-                cls._epoch_start[interval].append(fn)
+                cls._epoch_start[interval].append((fn, main_only))
             else:
-                cls._epoch_start[interval] = [fn]
+                cls._epoch_start[interval] = [(fn, main_only)]
             return fn
 
         return decorator
 
     @classmethod
-    def epoch_end(cls, interval=1):
+    def epoch_end(cls, interval=1, main_only=False):
         """ Register a hook to run at the end of an epoch.
 
         Args:
             interval (int, optional): Number dictating how often to run the hook; Default **1**
+            main_only (bool, optional): Only run the hook on rank 0 when training distributed; Default **False**
         """
         def decorator(fn):
             if interval in cls._epoch_end:
-                cls._epoch_end[interval].append(fn)
+                cls._epoch_end[interval].append((fn, main_only))
             else:
-                cls._epoch_end[interval] = [fn]
+                cls._epoch_end[interval] = [(fn, main_only)]
             return fn
 
         return decorator
 
     @classmethod
-    def batch_start(cls, interval=1):
+    def batch_start(cls, interval=1, main_only=False):
         """ Register a hook to run at the start of a batch.
 
         Args:
             interval (int, optional): Number dictating how often to run the hook; Default **1**
+            main_only (bool, optional): Only run the hook on rank 0 when training distributed; Default **False**
 
         Note:
             The `self.batch` attribute contains the number of processed batches,
@@ -265,25 +534,26 @@ class Engine(ABC):
         """
         def decorator(fn):
             if interval in cls._batch_start:
-                cls._batch_start[interval].append(fn)
+                cls._batch_start[interval].append((fn, main_only))
             else:
-                cls._batch_start[interval] = [fn]
+                cls._batch_start[interval] = [(fn, main_only)]
             return fn
 
         return decorator
 
     @classmethod
-    def batch_end(cls, interval=1):
+    def batch_end(cls, interval=1, main_only=False):
         """ Register a hook to run at the end of a batch.
 
         Args:
             interval (int, optional): Number dictating how often to run the hook; Default **1**
+            main_only (bool, optional): Only run the hook on rank 0 when training distributed; Default **False**
         """
         def decorator(fn):
             if interval in cls._batch_end:
-                cls._batch_end[interval].append(fn)
+                cls._batch_end[interval].append((fn, main_only))
             else:
-                cls._batch_end[interval] = [fn]
+                cls._batch_end[interval] = [(fn, main_only)]
             return fn
 
         return decorator
@@ -330,6 +600,16 @@ class Engine(ABC):
         """
         pass
 
+    def evaluated(self, tag, results):
+        """ This function gets called with the results of every finished evaluation of the ``self.evaluator`` worker. |br|
+        By default, it logs the results, but you can override it to eg. keep track of the best weights or export the metrics.
+
+        Args:
+            tag: Tag that was used when submitting the weights for evaluation
+            results: Return value of the evaluation function
+        """
+        log.test(f'Evaluation {tag}: {results}')
+
     def quit(self):
         """ This function gets called after every training epoch and decides if the training cycle continues.
 
@@ -0,0 +1,195 @@
+#
+#   Background evaluation worker
+#   Copyright EAVISE
+#
+import logging
+import queue
+import traceback
+import torch
+import torch.multiprocessing as mp
+
+__all__ = ['EvaluationWorker']
+log = logging.getLogger(__name__)
+
+
+class EvaluationWorker:
+    """ Run evaluations of a network in a separate process, so that training does not need to wait for them. |br|
+    The worker process has its own copy of the network.
+    When you :func:`submit` the current weights, they are copied to a shared memory buffer and the worker loads them from there before evaluating.
+    The results of the evaluations can be fetched with :func:`poll`.
+
+    Args:
+        network (torch.nn.Module): Network to evaluate (gets pickled to the worker process once)
+        evaluate (callable): Picklable function that receives the network, runs the evaluation and returns the results (eg. a dict of metrics)
+        device (torch.device or str, optional): Device to run the evaluation on; Default **cpu**
+        num_threads (int, optional): Number of threads the worker process can use for PyTorch operations; Default **PyTorch default**
+
+    Note:
+        The worker only ever evaluates the latest submitted weights.
+        If you submit new weights while it is still busy, those replace any weights that were submitted earlier and are still waiting.
+        The weights are evaluated with the tag of the corresponding :func:`submit` call,
+        so you can see which evaluations were skipped.
+
+    Note:
+        The ``evaluate`` function is called inside a :func:`torch.no_grad` context, with the network in evaluation mode.
+        In order to avoid recreating your dataloader for every evaluation, you can use a callable object that creates it the first time it gets called.
+
+    Example:
+        >>> class Evaluate:     # doctest: +SKIP
+        ...     def __init__(self, dataset):
+        ...         self.dataset = dataset
+        ...         self.loader = None
+        ...
+        ...     def __call__(self, network):
+        ...         if self.loader is None:
+        ...             self.loader = ln.data.DataLoader(self.dataset, batch_size=8, num_workers=2, collate_fn=ln.data.brambox_collate)
+        ...         post = ln.data.transform.Compose([...])
+        ...         dets, annos = [], []
+        ...         for data, anno in self.loader:
+        ...             dets.append(post(network(data)))
+        ...             annos.append(anno)
+        ...         return {'AP': compute_ap(dets, annos)}
+        >>> worker = ln.engine.EvaluationWorker(network, Evaluate(test_dataset), num_threads=4)  # doctest: +SKIP
+        >>> worker.submit(network, tag=1000)                                                       # doctest: +SKIP
+        >>> # Continue training...
+        >>> for tag, metrics in worker.poll():                                                     # doctest: +SKIP
+        ...     print(tag, metrics)
+    """
+    def __init__(self, network, evaluate, device='cpu', num_threads=None):
+        ctx = mp.get_context('spawn')
+        self.__state = {k: v.detach().to('cpu', copy=True).share_memory_() for k, v in network.state_dict().items()}
+        self.__tag = ctx.Value('q', 0)
+        self.__seq = ctx.Value('q', 0)
+        self.__lock = ctx.Lock()
+        self.__requests = ctx.Queue()
+        self.__results = ctx.Queue()
+        self.submitted = 0
+        self.finished = 0
+        self.__last_seq = 0
+
+        self.process = ctx.Process(
+            target=_work,
+            args=(network, evaluate, self.__state, self.__tag, self.__seq, self.__lock, self.__requests, self.__results, device, num_threads),
+            name='lightnet-evaluation',
+            daemon=True,
+        )
+        self.process.start()
+
+    def submit(self, network, tag):
+        """ Copy the current weights of the network to the worker and request an evaluation. |br|
+        This function does not wait for the evaluation, but only for copying the weights to shared memory.
+
+        Args:
+            network (torch.nn.Module or dict): Network (or its state dict) to evaluate
+            tag (int): Number to identify the results (eg. the batch number)
+        """
+        if not self.process.is_alive():
+            raise RuntimeError('Evaluation worker is not running')
+
+        state = network.state_dict() if isinstance(network, torch.nn.Module) else network
+        with self.__lock:
+            for key, value in state.items():
+                self.__state[key].copy_(value.detach())
+            self.__tag.value = tag
+            self.submitted += 1
+            self.__seq.value = self.submitted
+
+        self.__requests.put(True)
+
+    def poll(self, timeout=None):
+        """ Get the results of all finished evaluations.
+
+        Args:
+            timeout (number, optional): Wait this many seconds for a first result if none is available; Default **do not wait**
+
+        Returns:
+            list: (tag, results) tuples of the finished evaluations
+
+        Raises:
+            RuntimeError: If an evaluation failed in the worker process
+        """
+        results = []
+        block = timeout is not None
+        while True:
+            try:
+                seq, tag, result, error = self.__results.get(block=block, timeout=timeout)
+            except queue.Empty:
+                break
+
+            block = False
+            self.finished += 1
+            self.__last_seq = seq
+            if error is not None:
+                raise RuntimeError(f'Evaluation {tag} failed in the worker process:\n{error}')
+            results.append((tag, result))
+
+        return results
+
+    def close(self, wait=True):
+        """ Stop the worker process.
+
+        Args:
+            wait (bool, optional): Wait for the pending evaluation to finish, instead of terminating the worker; Default **True**
+
+        Returns:
+            list: (tag, results) tuples of the evaluations that finished and were not yet polled
+
+        Raises:
+            RuntimeError: If an evaluation failed in the worker process (the worker gets terminated in that case)
+        """
+        if not self.process.is_alive():
+            return self.poll()
+
+        if wait:
+            self.__requests.put(None)
+            results = []
+            try:
+                while self.process.is_alive() or not self.__results.empty():
+                    results.extend(self.poll(timeout=0.1))
+            finally:
+                if self.process.is_alive():
+                    self.process.terminate()
+                self.process.join()
+            return results
+        else:
+            self.process.terminate()
+            self.process.join()
+            return self.poll()
+
+    @property
+    def busy(self):
+        """ Whether the latest submitted weights are not evaluated yet (or their results are not polled yet). """
+        return self.__last_seq < self.submitted
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(alive={self.process.is_alive()}, submitted={self.submitted}, finished={self.finished})'
+
+
+def _work(network, evaluate, state, tag, seq, lock, requests, results, device, num_threads):
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    network.to(device).eval()
+
+    stop = False
+    while not stop:
+        if requests.get() is None:
+            break
+
+        # Only evaluate the latest weights
+        while True:
+            try:
+                if requests.get_nowait() is None:
+                    stop = True
+            except queue.Empty:
+                break
+
+        with lock:
+            network.load_state_dict(state)
+            current_tag = tag.value
+            current_seq = seq.value
+
+        try:
+            with torch.no_grad():
+                results.put((current_seq, current_tag, evaluate(network), None))
+        except Exception:
+            results.put((current_seq, current_tag, None, traceback.format_exc()))
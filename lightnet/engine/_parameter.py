@@ -5,7 +5,7 @@
 import copy
 import logging
 import importlib.util
-from collections import Iterable
+from collections.abc import Iterable
 import torch
 
 __all__ = ['HyperParameters']
@@ -288,12 +288,13 @@ class HyperParameters:
         else:
             raise TypeError(f'Unkown type for configuration variable {variable} [{type(params).__name__}]. This variable should be a dictionary or lightnet.engine.HyperParameters object.')
 
-    def save(self, filename):
+    def save(self, filename, checkpointer=None):
         """ Serialize all the hyperparameters to a pickle file. |br|
         The network, optimizers and schedulers objects are serialized using their ``state_dict()`` functions.
 
         Args:
             filename (str or path): File to store the hyperparameters
+            checkpointer (lightnet.engine.AsyncCheckpointer, optional): Write the file in the background with this checkpointer; Default **None**
 
         Note:
             This function will first check if the existing attributes have a `state_dict()` function,
@@ -308,7 +309,10 @@ class HyperParameters:
                 else:
                     state[k] = v
 
-        torch.save(state, filename)
+        if checkpointer is not None:
+            checkpointer.save(state, filename)
+        else:
+            torch.save(state, filename)
 
     def load(self, filename, strict=True):
         """ Load the hyperparameters from a serialized pickle file.
@@ -0,0 +1,117 @@
+#
+#   Timing the phases of a training loop
+#   Copyright EAVISE
+#
+import collections
+import time
+import numpy as np
+
+__all__ = ['PhaseTimer']
+
+
+class PhaseTimer:
+    """ Lap timer that measures how long each phase of a training loop takes. |br|
+    Every call to :func:`lap` attributes the time since the previous lap to a phase.
+    These times are summed per batch and :func:`end_batch` adds the totals of each phase to a rolling window,
+    from which you can compute statistics.
+
+    Args:
+        window (int, optional): Number of batches to keep statistics for; Default **100**
+        percentiles (list, optional): Percentiles to compute; Default **(50, 90, 99)**
+
+    Example:
+        >>> import time
+        >>> timer = ln.engine.PhaseTimer(window=10)
+        >>> timer.mark()
+        >>> for _ in range(5):
+        ...     time.sleep(0.01)
+        ...     timer.lap('data')
+        ...     time.sleep(0.02)
+        ...     timer.lap('forward')
+        ...     timer.end_batch(images=8)
+        >>> stats = timer.stats()
+        >>> sorted(stats.keys())
+        ['batch', 'data', 'forward', 'images_per_second']
+        >>> sorted(stats['data'].keys())
+        ['mean', 'p50', 'p90', 'p99']
+
+    Note:
+        The timings are measured on the host.
+        When running on a GPU, asynchronously launched kernels only get accounted for in the phase that waits for them (eg. when calling ``loss.item()``).
+    """
+    def __init__(self, window=100, percentiles=(50, 90, 99)):
+        self.window = window
+        self.percentiles = tuple(percentiles)
+        self.reset()
+
+    def reset(self):
+        """ Remove all measurements. """
+        self.times = collections.OrderedDict()
+        self.images = collections.deque(maxlen=self.window)
+        self.batch_times = collections.deque(maxlen=self.window)
+        self.__current = collections.OrderedDict()
+        self.__last = None
+        self.__batch_start = None
+
+    def mark(self):
+        """ Start timing from now on, without attributing the elapsed time to any phase. """
+        self.__last = time.perf_counter()
+        if self.__batch_start is None:
+            self.__batch_start = self.__last
+
+    def lap(self, phase):
+        """ Attribute the time since the previous lap (or mark) to a phase.
+
+        Args:
+            phase (str): Name of the phase
+        """
+        now = time.perf_counter()
+        if self.__last is not None:
+            self.__current[phase] = self.__current.get(phase, 0) + now - self.__last
+        if self.__batch_start is None:
+            self.__batch_start = now
+        self.__last = now
+
+    def end_batch(self, images=None):
+        """ Add the phase times of the current batch to the rolling window.
+
+        Args:
+            images (int, optional): Number of images in this batch, used to compute the throughput; Default **None**
+        """
+        now = time.perf_counter()
+        for phase in list(self.times) + [p for p in self.__current if p not in self.times]:
+            if phase not in self.times:
+                self.times[phase] = collections.deque(maxlen=self.window)
+            self.times[phase].append(self.__current.get(phase, 0))
+
+        self.batch_times.append(now - self.__batch_start if self.__batch_start is not None else 0)
+        self.images.append(images or 0)
+        self.__current = collections.OrderedDict()
+        self.__batch_start = now
+
+    def stats(self):
+        """ Compute statistics over the rolling window.
+
+        Return:
+            dict: Mean and percentiles in seconds for each phase and the entire batch, and the throughput in images per second
+        """
+        stats = collections.OrderedDict()
+        for phase, times in list(self.times.items()) + [('batch', self.batch_times)]:
+            if len(times) == 0:
+                continue
+            times = np.asarray(times)
+            stats[phase] = {'mean': float(times.mean())}
+            for p, value in zip(self.percentiles, np.percentile(times, self.percentiles)):
+                stats[phase][f'p{p}'] = float(value)
+
+        total = sum(self.batch_times)
+        stats['images_per_second'] = sum(self.images) / total if total > 0 else 0.0
+        return stats
+
+    def __str__(self):
+        stats = self.stats()
+        phases = ', '.join(f'{phase} {1000 * value["mean"]:.1f}ms' for phase, value in stats.items() if phase != 'images_per_second')
+        return f'{phases} ({stats["images_per_second"]:.1f} img/s)'
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(window={self.window}, percentiles={self.percentiles})'
@@ -0,0 +1,8 @@
+"""
+Lightnet Inference Module |br|
+This module contains tools to run your trained networks on new data.
+"""
+
+from ._predictor import *
+from ._stream import *
+from ._tiling import *
@@ -0,0 +1,255 @@
+#
+#   Dynamic batching predictor
+#   Copyright EAVISE
+#
+import asyncio
+import collections
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+import torch
+from ._tiling import _image_size
+
+__all__ = ['Predictor']
+log = logging.getLogger(__name__)
+
+_Request = collections.namedtuple('_Request', ['image', 'name', 'future', 'submitted'])
+
+
+class Predictor:
+    """ Run a network on images that arrive one by one, by grouping them in batches. |br|
+    Every image that gets submitted is added to a queue.
+    A background thread takes the images from that queue and groups them in batches,
+    until either ``max_batch_size`` images are waiting or the first image has been waiting for ``max_latency`` seconds.
+    The batch is then pre-processed, run through the network and post-processed, after which the results are split per image again.
+
+    Args:
+        network (torch.nn.Module): Network to run
+        pre (callable): Pre-processing that transforms a single image in a CHW tensor (eg. a :class:`~lightnet.data.transform.Compose` with Letterbox and ToTensor)
+        post (callable): Post-processing that transforms the network output of a batch into a brambox dataframe or bounding box tensor
+        max_batch_size (int, optional): Maximum number of images in a batch; Default **8**
+        max_latency (float, optional): Maximum time in seconds to wait for more images, before running an incomplete batch; Default **0.01**
+        device (torch.device or str, optional): Device to run the network on; Default **device of the network parameters**
+
+    Note:
+        The ``post`` transform works on a batch, so the `image` column of the dataframe (or first column of the tensor) contains the index of the image in the batch.
+        In order to reverse a :class:`~lightnet.data.transform.Letterbox` for images with different sizes,
+        you can pass the :func:`image_size` method of the predictor as the `image_size` argument of :class:`~lightnet.data.transform.ReverseLetterbox`
+        (see the example below).
+
+        Afterwards, the results are split per image.
+        The `image` column of the dataframes is set to the name of the request and the first column of bounding box tensors is set to zero.
+
+    Note:
+        Pre-processed images with different shapes are run in separate batches.
+
+    Example:
+        >>> import numpy as np
+        >>> net = ln.models.TinyYoloV2(20).eval()
+        >>> pre = ln.data.transform.Compose([
+        ...     ln.data.transform.Letterbox((416, 416)),
+        ...     lambda img: torch.from_numpy(img).permute(2, 0, 1).float() / 255,
+        ... ])
+        >>> post = ln.data.transform.Compose([
+        ...     ln.data.transform.GetDarknetBoxes(0.5, net.stride, net.anchors),
+        ...     ln.data.transform.NMS(0.5),
+        ...     ln.data.transform.TensorToBrambox(),
+        ... ])
+        >>> with ln.inference.Predictor(net, pre, post, max_batch_size=4) as predictor:
+        ...     predictor.post.append(ln.data.transform.ReverseLetterbox((416, 416), predictor.image_size))
+        ...     image = np.random.randint(0, 256, (480, 640, 3), dtype=np.uint8)
+        ...     # Blocking call
+        ...     detections = predictor.predict(image, name='image1')
+        ...     # Future (eg. from different threads)
+        ...     future = predictor.submit(image, name='image2')
+        ...     detections = future.result()
+        >>> # Awaitable from asyncio code
+        >>> async def handle(image):            # doctest: +SKIP
+        ...     return await predictor.apredict(image)
+    """
+    def __init__(self, network, pre, post, max_batch_size=8, max_latency=0.01, device=None):
+        self.network = network
+        self.pre = pre
+        self.post = post
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.device = device if device is not None else next(network.parameters()).device
+        self.num_batches = 0
+        self.num_images = 0
+
+        self.__queue = queue.Queue()
+        self.__local = threading.local()
+        self.__closed = False
+        self.__lock = threading.Lock()
+        self.__thread = threading.Thread(target=self.__work, name='lightnet-predictor', daemon=True)
+        self.__thread.start()
+
+    def submit(self, image, name=None):
+        """ Queue an image to run through the network. |br|
+        This function is thread-safe.
+
+        Args:
+            image: Image to run through the network (any type that your pre-processing accepts)
+            name (optional): Name for the `image` column of the results; Default **0**
+
+        Returns:
+            concurrent.futures.Future: Future that will contain the results for this image
+        """
+        future = Future()
+        with self.__lock:
+            if self.__closed:
+                raise RuntimeError('Predictor is closed')
+            self.__queue.put(_Request(image, 0 if name is None else name, future, time.perf_counter()))
+        return future
+
+    def predict(self, image, name=None, timeout=None):
+        """ Run an image through the network and wait for the results. |br|
+        This function is thread-safe.
+
+        Args:
+            image: Image to run through the network (any type that your pre-processing accepts)
+            name (optional): Name for the `image` column of the results; Default **0**
+            timeout (float, optional): Maximum time to wait in seconds; Default **wait forever**
+
+        Returns:
+            pandas.DataFrame or torch.Tensor: Results for this image
+        """
+        return self.submit(image, name).result(timeout)
+
+    async def apredict(self, image, name=None):
+        """ Asyncio version of :func:`predict`.
+
+        Args:
+            image: Image to run through the network (any type that your pre-processing accepts)
+            name (optional): Name for the `image` column of the results; Default **0**
+
+        Returns:
+            pandas.DataFrame or torch.Tensor: Results for this image
+        """
+        return await asyncio.wrap_future(self.submit(image, name))
+
+    def image_size(self, index):
+        """ Get the (width, height) of an image in the batch that is currently being post-processed. |br|
+        This function can only be called from within the ``post`` transform.
+
+        Args:
+            index (int): Index of the image in the batch
+
+        Returns:
+            tuple: Width and height of the original image
+        """
+        return _image_size(self.__local.batch[int(index)].image)
+
+    def close(self, wait=True):
+        """ Stop the background thread.
+
+        Args:
+            wait (bool, optional): Process the images that are still in the queue, instead of cancelling them; Default **True**
+        """
+        with self.__lock:
+            if self.__closed:
+                return
+            self.__closed = True
+
+        if not wait:
+            while True:
+                try:
+                    self.__queue.get_nowait().future.cancel()
+                except queue.Empty:
+                    break
+
+        self.__queue.put(None)
+        self.__thread.join()
+
+    @property
+    def mean_batch_size(self):
+        """ Average number of images per batch so far. """
+        return self.num_images / self.num_batches if self.num_batches else 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(max_batch_size={self.max_batch_size}, max_latency={self.max_latency}, device={self.device})'
+
+    def __work(self):
+        stop = False
+        while not stop:
+            request = self.__queue.get()
+            if request is None:
+                break
+
+            # Gather batch
+            batch = [request]
+            deadline = request.submitted + self.max_latency
+            while len(batch) < self.max_batch_size:
+                try:
+                    request = self.__queue.get(timeout=max(deadline - time.perf_counter(), 0))
+                except queue.Empty:
+                    break
+                if request is None:
+                    stop = True
+                    break
+                batch.append(request)
+
+            batch = [r for r in batch if r.future.set_running_or_notify_cancel()]
+            if len(batch):
+                self.__run(batch)
+
+    def __run(self, requests):
+        # Pre-process per request, so that one bad image does not fail the other requests
+        groups = collections.defaultdict(list)
+        for r in requests:
+            try:
+                tensor = self.pre(r.image)
+            except Exception as err:
+                log.debug(f'Pre-processing of request [{r.name}] failed: {err}')
+                r.future.set_exception(err)
+                continue
+
+            # Group images with the same shape
+            groups[tensor.shape].append((r, tensor))
+
+        for group in groups.values():
+            batch = [r for r, _ in group]
+            try:
+                data = torch.stack([t for _, t in group]).to(self.device)
+                with torch.no_grad():
+                    output = self.network(data)
+
+                self.__local.batch = batch
+                try:
+                    output = self.post(output)
+                finally:
+                    self.__local.batch = None
+
+                results = _split(output, len(batch))
+            except Exception as err:
+                log.debug(f'Prediction of batch failed: {err}')
+                for r in batch:
+                    r.future.set_exception(err)
+                continue
+
+            self.num_batches += 1
+            self.num_images += len(batch)
+            for r, result in zip(batch, results):
+                if isinstance(result, torch.Tensor):
+                    result[:, 0] = 0
+                else:
+                    result['image'] = r.name
+                r.future.set_result(result)
+
+
+def _split(output, num):
+    """ Split a batched brambox dataframe or bounding box tensor per image. """
+    if isinstance(output, torch.Tensor):
+        index = output[:, 0].long()
+        return [output[index == i] for i in range(num)]
+
+    index = output['image'].astype(int).values
+    return [output[index == i].reset_index(drop=True) for i in range(num)]
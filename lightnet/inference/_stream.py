@@ -0,0 +1,359 @@
+#
+#   Pipelined inference on video streams
+#   Copyright EAVISE
+#
+import collections
+import copy
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+import torch
+from ..data._imports import cv2
+from ._predictor import _split
+from ._tiling import _image_size
+
+__all__ = ['StreamPipeline', 'read_frames']
+log = logging.getLogger(__name__)
+
+_STAGES = ('decode', 'pre', 'network', 'post', 'total')
+_IMAGE_EXTENSIONS = ('.bmp', '.jpeg', '.jpg', '.png', '.tif', '.tiff', '.webp')
+
+
+class _Stop(Exception):
+    """ Raised inside the stage threads when the pipeline gets closed. """
+
+
+class _Error:
+    """ Wrapper to pass an exception of a stage on to the next stages. """
+    def __init__(self, err):
+        self.err = err
+
+
+class StreamPipeline:
+    """ Run a network on a stream of frames (eg. a video or camera feed), with the different stages running concurrently. |br|
+    Instead of decoding, pre-processing, running the network and post-processing every frame one after another,
+    each stage runs in its own thread and passes its results to the next stage through a bounded queue:
+
+    - **decode**: Get the next frame from the input iterator
+    - **pre**: Pre-process the frames with a pool of ``workers`` threads
+    - **network**: Group the pre-processed frames in batches of ``batch_size`` and run them through the network
+    - **post**: Post-process the network output and split it per frame
+
+    The queues between the stages hold at most ``queue_size`` items, so a slow stage blocks the stages before it
+    (and eventually the decoding of new frames), instead of letting the number of frames in memory grow.
+    The results are always yielded in the order of the input frames.
+
+    Args:
+        network (torch.nn.Module): Network to run
+        pre (callable): Pre-processing that transforms a single frame in a CHW tensor (eg. a :class:`~lightnet.data.transform.Compose` with Letterbox and ToTensor)
+        post (callable): Post-processing that transforms the network output of a batch into a brambox dataframe or bounding box tensor
+        batch_size (int, optional): Number of frames to run through the network at once; Default **1**
+        workers (int, optional): Number of pre-processing threads; Default **1**
+        queue_size (int, optional): Maximal number of items in each queue between two stages; Default **4**
+        device (torch.device or str, optional): Device to run the network on; Default **device of the network parameters**
+
+    Note:
+        The ``post`` transform works on a batch, so the `image` column of the dataframe (or first column of the tensor) contains the index of the frame in the batch.
+        You can pass the :func:`image_size` method of the pipeline as the `image_size` argument of :class:`~lightnet.data.transform.ReverseLetterbox`,
+        if the size of the frames is not known beforehand.
+
+        Afterwards, the results are split per frame and the `image` column (or first column of the tensor) is set to the index of the frame in the stream.
+
+    Note:
+        The stages run in threads and not in processes.
+        This works well, because decoding with OpenCV, most numpy functions and PyTorch release the GIL while they are busy.
+        If your pre-processing is pure Python code, increasing the number of ``workers`` will not help much.
+
+    Warning:
+        Many transforms store the parameters of the current image on the object (eg. :class:`~lightnet.data.transform.Letterbox`),
+        so the ``pre`` transform cannot safely run on multiple frames at once.
+        If ``workers`` is larger than one, each worker thread therefore gets its own deep copy of ``pre`` for every stream.
+        This also means that any state the worker copies gather (eg. profiling statistics) is not visible on the original ``pre`` object.
+
+    Example:
+        >>> import numpy as np
+        >>> net = ln.models.TinyYoloV2(20).eval()
+        >>> pre = ln.data.transform.Compose([
+        ...     ln.data.transform.Letterbox((416, 416)),
+        ...     lambda img: torch.from_numpy(img).permute(2, 0, 1).float() / 255,
+        ... ])
+        >>> post = ln.data.transform.Compose([
+        ...     ln.data.transform.GetDarknetBoxes(0.5, net.stride, net.anchors),
+        ...     ln.data.transform.NMS(0.5),
+        ...     ln.data.transform.TensorToBrambox(),
+        ...     ln.data.transform.ReverseLetterbox((416, 416), (640, 480)),
+        ... ])
+        >>> pipeline = ln.inference.StreamPipeline(net, pre, post, batch_size=2)
+        >>> frames = (np.random.randint(0, 256, (480, 640, 3), dtype=np.uint8) for _ in range(5))
+        >>> for frame, detections in pipeline(frames):
+        ...     pass
+        >>> sorted(pipeline.statistics())
+        ['decode', 'network', 'post', 'pre', 'total']
+
+        Frames can also be read from a video file, camera or folder of images.
+
+        >>> for frame, detections in pipeline(ln.inference.read_frames('video.mp4')):     # doctest: +SKIP
+        ...     pass
+    """
+    def __init__(self, network, pre, post, batch_size=1, workers=1, queue_size=4, device=None):
+        self.network = network
+        self.pre = pre
+        self.post = post
+        self.batch_size = batch_size
+        self.workers = workers
+        self.queue_size = queue_size
+        self.device = device if device is not None else next(network.parameters()).device
+        self.latency = {stage: collections.deque(maxlen=1000) for stage in _STAGES}
+        self.__local = threading.local()
+
+    def __call__(self, frames):
+        """ Run the pipeline on a stream of frames.
+
+        Args:
+            frames (iterable): Frames to run through the network (any type that your pre-processing accepts)
+
+        Yields:
+            tuple: (frame, detections) for every frame, in the order of the input frames
+        """
+        for values in self.latency.values():
+            values.clear()
+        self.__count = 0
+
+        stop = threading.Event()
+        pre_queue = queue.Queue(self.queue_size)
+        post_queue = queue.Queue(self.queue_size)
+        out_queue = queue.Queue(self.queue_size)
+        pool = ThreadPoolExecutor(self.workers, thread_name_prefix='lightnet-stream-pre')
+        workers = threading.local()
+        threads = [
+            threading.Thread(target=self.__decode, args=(iter(frames), pool, workers, pre_queue, stop), name='lightnet-stream-decode', daemon=True),
+            threading.Thread(target=self.__infer, args=(pre_queue, post_queue, stop), name='lightnet-stream-network', daemon=True),
+            threading.Thread(target=self.__postprocess, args=(post_queue, out_queue, stop), name='lightnet-stream-post', daemon=True),
+        ]
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                item = _get(out_queue, stop)
+                if item is None:
+                    break
+                if isinstance(item, _Error):
+                    raise item.err
+
+                start, frame, result = item
+                self.latency['total'].append(time.perf_counter() - start)
+                yield frame, result
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+            pool.shutdown(cancel_futures=True)
+
+    def image_size(self, index):
+        """ Get the (width, height) of a frame in the batch that is currently being post-processed. |br|
+        This function can only be called from within the ``post`` transform.
+
+        Args:
+            index (int): Index of the frame in the batch
+
+        Returns:
+            tuple: Width and height of the frame
+        """
+        return _image_size(self.__local.batch[int(index)][1])
+
+    def statistics(self):
+        """ Latency of each stage over the last 1000 items of the current (or last) stream. |br|
+        The `decode` and `pre` latencies are measured per frame, the `network` and `post` latencies per batch.
+        The `total` latency goes from the start of decoding a frame until it gets yielded and thus includes the time waiting in the queues.
+
+        Returns:
+            dict: ``{stage: {'mean': ..., 'p50': ..., 'p99': ..., 'max': ...}}`` in seconds for each stage
+        """
+        stats = {}
+        for stage, values in self.latency.items():
+            values = np.asarray(values)
+            if len(values) == 0:
+                stats[stage] = {'mean': 0.0, 'p50': 0.0, 'p99': 0.0, 'max': 0.0}
+            else:
+                stats[stage] = {
+                    'mean': float(values.mean()),
+                    'p50': float(np.percentile(values, 50)),
+                    'p99': float(np.percentile(values, 99)),
+                    'max': float(values.max()),
+                }
+        return stats
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(batch_size={self.batch_size}, workers={self.workers}, queue_size={self.queue_size}, device={self.device})'
+
+    def __decode(self, frames, pool, workers, pre_queue, stop):
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    frame = next(frames)
+                except StopIteration:
+                    break
+                self.latency['decode'].append(time.perf_counter() - start)
+                _put(pre_queue, (start, frame, pool.submit(self.__preprocess, frame, workers)), stop)
+            _put(pre_queue, None, stop)
+        except _Stop:
+            pass
+        except BaseException as err:
+            _put_final(pre_queue, _Error(err), stop)
+
+    def __preprocess(self, frame, workers):
+        start = time.perf_counter()
+        pre = self.pre
+        if self.workers > 1:
+            # Transforms can keep state of the current frame, so each worker thread needs its own copy
+            pre = getattr(workers, 'pre', None)
+            if pre is None:
+                pre = workers.pre = copy.deepcopy(self.pre)
+
+        tensor = pre(frame)
+        self.latency['pre'].append(time.perf_counter() - start)
+        return tensor
+
+    def __infer(self, pre_queue, post_queue, stop):
+        try:
+            done = False
+            while not done:
+                batch = []
+                while len(batch) < self.batch_size:
+                    item = _get(pre_queue, stop)
+                    if item is None:
+                        done = True
+                        break
+                    if isinstance(item, _Error):
+                        raise item.err
+
+                    start, frame, future = item
+                    batch.append((start, frame, future.result()))
+
+                if len(batch) == 0:
+                    break
+
+                start = time.perf_counter()
+                data = torch.stack([tensor for _, _, tensor in batch]).to(self.device)
+                with torch.no_grad():
+                    output = self.network(data)
+                if isinstance(output, torch.Tensor) and output.is_cuda:
+                    torch.cuda.synchronize(output.device)
+                self.latency['network'].append(time.perf_counter() - start)
+
+                _put(post_queue, ([(s, f) for s, f, _ in batch], output), stop)
+            _put(post_queue, None, stop)
+        except _Stop:
+            pass
+        except BaseException as err:
+            _put_final(post_queue, _Error(err), stop)
+
+    def __postprocess(self, post_queue, out_queue, stop):
+        try:
+            while True:
+                item = _get(post_queue, stop)
+                if item is None:
+                    break
+                if isinstance(item, _Error):
+                    raise item.err
+
+                batch, output = item
+                start = time.perf_counter()
+                self.__local.batch = batch
+                try:
+                    output = self.post(output)
+                finally:
+                    self.__local.batch = None
+                results = _split(output, len(batch))
+                self.latency['post'].append(time.perf_counter() - start)
+
+                for (frame_start, frame), result in zip(batch, results):
+                    index = self.__count
+                    self.__count += 1
+                    if isinstance(result, torch.Tensor):
+                        result[:, 0] = index
+                    else:
+                        result['image'] = index
+                    _put(out_queue, (frame_start, frame, result), stop)
+            _put(out_queue, None, stop)
+        except _Stop:
+            pass
+        except BaseException as err:
+            _put_final(out_queue, _Error(err), stop)
+
+
+def read_frames(source, step=1, rgb=True):
+    """ Read frames from a video file, camera or folder of images with OpenCV. |br|
+    This is a generator, so frames only get decoded when they are needed, which makes it a good input for :class:`~lightnet.inference.StreamPipeline`.
+
+    Args:
+        source (int, str or pathlib.Path): Camera index, path to a video file or path to a folder of images (read in sorted order)
+        step (int, optional): Only return every `step`'th frame; Default **1**
+        rgb (bool, optional): Convert the frames from BGR to RGB; Default **True**
+
+    Yields:
+        numpy.ndarray: HWC uint8 frames
+    """
+    if cv2 is None:
+        raise ImportError('OpenCV is needed to read frames')
+
+    if not isinstance(source, int) and Path(source).is_dir():
+        files = sorted(f for f in Path(source).iterdir() if f.suffix.lower() in _IMAGE_EXTENSIONS)
+        for file in files[::step]:
+            frame = cv2.imread(str(file))
+            if frame is None:
+                raise IOError(f'Could not read image [{file}]')
+            yield cv2.cvtColor(frame, cv2.COLOR_BGR2RGB) if rgb else frame
+        return
+
+    capture = cv2.VideoCapture(source if isinstance(source, int) else str(source))
+    if not capture.isOpened():
+        raise IOError(f'Could not open video source [{source}]')
+
+    try:
+        index = 0
+        while True:
+            if index % step == 0:
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                yield cv2.cvtColor(frame, cv2.COLOR_BGR2RGB) if rgb else frame
+            elif not capture.grab():
+                break
+            index += 1
+    finally:
+        capture.release()
+
+
+def _get(q, stop):
+    """ Get an item from a queue, but stop waiting when the pipeline gets closed. """
+    while True:
+        try:
+            return q.get(timeout=0.05)
+        except queue.Empty:
+            if stop.is_set():
+                raise _Stop()
+
+
+def _put(q, item, stop):
+    """ Put an item in a bounded queue, but stop waiting when the pipeline gets closed. """
+    while True:
+        try:
+            return q.put(item, timeout=0.05)
+        except queue.Full:
+            if stop.is_set():
+                raise _Stop()
+
+
+def _put_final(q, item, stop):
+    """ Pass an error to the next stage, unless the pipeline is closed. """
+    try:
+        _put(q, item, stop)
+    except _Stop:
+        pass
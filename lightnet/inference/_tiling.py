@@ -0,0 +1,196 @@
+#
+#   Tiled inference on large images
+#   Copyright EAVISE
+#
+import logging
+import numpy as np
+import torch
+from ..data.transform import NMS
+from ..data._imports import Image
+
+__all__ = ['TiledInference', 'tile_positions']
+log = logging.getLogger(__name__)
+
+
+def tile_positions(size, tile_size, overlap):
+    """ Compute the start positions of overlapping tiles along one dimension. |br|
+    The tiles are spread evenly, so that the first tile starts at the beginning and the last tile ends at the end of the dimension.
+    Consecutive tiles overlap by at least ``overlap`` pixels.
+
+    Args:
+        size (int): Size of the dimension (eg. width of the image)
+        tile_size (int): Size of the tiles
+        overlap (int): Minimal overlap between consecutive tiles
+
+    Returns:
+        list: Start positions of the tiles
+
+    Example:
+        >>> ln.inference.tile_positions(1000, 416, 64)
+        [0, 292, 584]
+        >>> ln.inference.tile_positions(300, 416, 64)
+        [0]
+    """
+    if overlap >= tile_size:
+        raise ValueError(f'Overlap should be smaller than the tile size [{overlap}/{tile_size}]')
+    if size <= tile_size:
+        return [0]
+
+    num_tiles = -(-(size - overlap) // (tile_size - overlap))
+    step = (size - tile_size) / (num_tiles - 1)
+    return [round(i * step) for i in range(num_tiles)]
+
+
+class TiledInference:
+    """ Run a detection network on an image that is larger than the input dimension of the network. |br|
+    The image is split in overlapping tiles of the given size, which are run through the network in batches.
+    The detections of each tile are then moved to the coordinates of the full image
+    and duplicate detections of objects in the overlapping regions are removed with non-maximum suppression.
+
+    Only the tiles of the current batch are ever converted to tensors,
+    so the memory usage does not depend on the size of the image, as long as the image itself does not need to be loaded in memory.
+    Pass a :class:`numpy.memmap` (or an array loaded with ``np.load(..., mmap_mode='r')``) for huge images, and only the tiles get read from disk.
+
+    Args:
+        network (torch.nn.Module): Network to run
+        post (callable): Post-processing that converts the network output to a bounding box tensor (eg. :class:`~lightnet.data.transform.GetDarknetBoxes`)
+        tile_size (int or tuple): Width and height of the tiles, usually the input dimension of the network
+        overlap (int or tuple, optional): Minimal overlap in pixels between tiles in the horizontal and vertical direction; Default **tile_size // 4**
+        batch_size (int, optional): Number of tiles that are run through the network at once; Default **8**
+        nms (callable, optional): Transform to remove duplicate detections, which works on bounding box tensors; Default **NMS(0.5)**
+        edge_margin (int, optional): Remove detections that are closer than this many pixels to an inner edge of a tile (see Note); Default **None**
+        transform (callable, optional): Extra transform to run on the batch of tiles before the network (eg. normalization); Default **None**
+        fill_color (int or float, optional): Fill color for padding tiles that are larger than the image (if int, will be divided by 255); Default **0.5**
+
+    Returns:
+        torch.Tensor [Boxes x 7]: **[batch_num, x_tl, y_tl, x_br, y_br, confidence, class_id]** for every bounding box (batch_num is always 0)
+
+    Note:
+        The input image can be a :class:`PIL.Image.Image`, a HWC or HW :class:`numpy.ndarray` (OpenCV image or memory-mapped array)
+        or a CHW :class:`torch.Tensor`.
+        Integer images are divided by 255, in order to get the same values as with :class:`torchvision.transforms.ToTensor`.
+
+    Note:
+        Objects that are cut off by the border of a tile are often detected as a smaller box, which does not overlap enough with the full detection to get removed by NMS.
+        If your objects are smaller than the overlap, they are completely visible in a neighbouring tile,
+        and you can remove these partial detections with the ``edge_margin`` argument.
+        Detections near the borders of the image itself are always kept.
+
+    Example:
+        >>> import numpy as np
+        >>> net = ln.models.Yolt(20).eval()
+        >>> post = ln.data.transform.GetDarknetBoxes(0.5, net.stride, net.anchors)
+        >>> tiler = ln.inference.TiledInference(net, post, 416, overlap=96)
+        >>> image = np.random.randint(0, 256, (1000, 1500, 3), dtype=np.uint8)
+        >>> len(tiler.tiles(image))
+        15
+        >>> boxes = tiler(image)
+        >>> boxes.shape[1]
+        7
+    """
+    def __init__(self, network, post, tile_size, overlap=None, batch_size=8, nms=None, edge_margin=None, transform=None, fill_color=0.5):
+        self.network = network
+        self.post = post
+        self.tile_size = (tile_size, tile_size) if isinstance(tile_size, int) else tuple(tile_size)
+        if overlap is None:
+            overlap = (self.tile_size[0] // 4, self.tile_size[1] // 4)
+        self.overlap = (overlap, overlap) if isinstance(overlap, int) else tuple(overlap)
+        self.batch_size = batch_size
+        self.nms = nms if nms is not None else NMS(0.5)
+        self.edge_margin = edge_margin
+        self.transform = transform
+        self.fill_color = fill_color if isinstance(fill_color, float) else fill_color / 255
+
+    def tiles(self, image):
+        """ Compute the tiles of an image.
+
+        Args:
+            image (PIL.Image, numpy.ndarray or torch.Tensor): Image
+
+        Returns:
+            list: (x, y) top-left positions of the tiles
+        """
+        width, height = _image_size(image)
+        xs = tile_positions(width, self.tile_size[0], self.overlap[0])
+        ys = tile_positions(height, self.tile_size[1], self.overlap[1])
+        return [(x, y) for y in ys for x in xs]
+
+    def __call__(self, image):
+        width, height = _image_size(image)
+        if Image is not None and isinstance(image, Image.Image):
+            image = np.asarray(image)
+
+        device = next(self.network.parameters()).device
+        tiles = self.tiles(image)
+        log.debug(f'Running network on {len(tiles)} tiles of {self.tile_size[0]}x{self.tile_size[1]} for an image of {width}x{height}')
+
+        boxes = []
+        for start in range(0, len(tiles), self.batch_size):
+            positions = tiles[start:start+self.batch_size]
+            batch = torch.stack([self._crop(image, x, y) for x, y in positions]).to(device)
+            if self.transform is not None:
+                batch = self.transform(batch)
+
+            with torch.no_grad():
+                output = self.post(self.network(batch))
+            if output.numel() == 0:
+                continue
+
+            offset = torch.tensor(positions, dtype=output.dtype, device=output.device)[output[:, 0].long()]
+            if self.edge_margin is not None:
+                keep = self._inner(output, offset, width, height)
+                output, offset = output[keep], offset[keep]
+
+            output[:, 1:5] += offset.repeat(1, 2)
+            output[:, 0] = 0
+            boxes.append(output)
+
+        if len(boxes) == 0:
+            return torch.empty(0, 7, device=device)
+        return self.nms(torch.cat(boxes))
+
+    def _inner(self, boxes, offset, width, height):
+        """ Mask of the boxes that are not too close to an inner edge of their tile. """
+        margin = self.edge_margin
+        tw, th = self.tile_size
+        x, y = offset[:, 0], offset[:, 1]
+        keep = torch.ones(boxes.shape[0], dtype=torch.bool, device=boxes.device)
+        keep &= (boxes[:, 1] > margin) | (x <= 0)
+        keep &= (boxes[:, 2] > margin) | (y <= 0)
+        keep &= (boxes[:, 3] < tw - margin) | (x + tw >= width)
+        keep &= (boxes[:, 4] < th - margin) | (y + th >= height)
+        return keep
+
+    def _crop(self, image, x, y):
+        """ Crop a tile from the image and convert it to a CHW float tensor of the tile size. """
+        tw, th = self.tile_size
+        if isinstance(image, torch.Tensor):
+            tile = image[..., y:y+th, x:x+tw]
+            if tile.dim() == 2:
+                tile = tile[None]
+        else:
+            tile = torch.from_numpy(np.ascontiguousarray(image[y:y+th, x:x+tw]))
+            tile = tile[None] if tile.dim() == 2 else tile.permute(2, 0, 1)
+
+        if not tile.is_floating_point():
+            tile = tile.float().div_(255)
+
+        if tile.shape[1] != th or tile.shape[2] != tw:
+            padded = torch.full((tile.shape[0], th, tw), self.fill_color, dtype=tile.dtype)
+            padded[:, :tile.shape[1], :tile.shape[2]] = tile
+            tile = padded
+
+        return tile
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(tile_size={self.tile_size}, overlap={self.overlap}, batch_size={self.batch_size}, edge_margin={self.edge_margin})'
+
+
+def _image_size(image):
+    """ Width and height of an image. """
+    if Image is not None and isinstance(image, Image.Image):
+        return image.size
+    elif isinstance(image, torch.Tensor):
+        return image.shape[-1], image.shape[-2]
+    else:
+        return image.shape[1], image.shape[0]
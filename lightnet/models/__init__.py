@@ -4,11 +4,9 @@ This module contains networks that were recreated with this library.
 Take a look at the code to learn how to use this library, or just use these models if that is all you need.
 """
 
-# Lightnet
-from ._dataset_brambox import *
+import importlib
 
 # Darknet
-from ._dataset_darknet import *
 from ._network_darknet import *
 from ._network_darknet19 import *
 from ._network_darknet53 import *
@@ -38,3 +36,19 @@ from ._network_yolo_v2_upsample import *
 # Cornernet
 from ._network_cornernet import *
 from ._network_cornernet_squeeze import *
+
+# Datasets (lazy, because they depend on Pillow, brambox and torchvision)
+_lazy = {
+    'BramboxDataset': '._dataset_brambox',
+    'DarknetDataset': '._dataset_darknet',
+}
+
+
+def __getattr__(name):
+    if name in _lazy:
+        return getattr(importlib.import_module(_lazy[name], __name__), name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy))
@@ -6,6 +6,7 @@
 import os
 import copy
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 import numpy as np
 import lightnet.data as lnd
@@ -29,6 +30,7 @@ class BramboxDataset(lnd.Dataset):
         identify (function, optional): Lambda/function to get image based of annotation filename or image id; Default **replace/add .png extension to filename/id**
         transform (torchvision.transforms.Compose): Transformation pipeline
         anno_transform (torchvision.transforms.Compose): Annotation transformation pipeline
+        io_workers (int, optional): Number of threads to use for loading the images of a batch concurrently (see Note); Default **0**
 
     Note:
         If you only pass a ``transform`` pipeline, it will be called with both your image and annotations as a tuple.
@@ -37,8 +39,16 @@ class BramboxDataset(lnd.Dataset):
 
     Note:
         This dataset opens images with the Pillow library
+
+    Note:
+        When used with a :class:`~lightnet.data.DataLoader`, this dataset gets the indices of an entire batch at once (see :meth:`~lightnet.data.Dataset.__getitems__`).
+        If you set ``io_workers`` to a value higher than zero, the images of that batch will be read and decoded concurrently in a small thread pool.
+        This greatly speeds up data loading from slow (eg. network mounted) storage,
+        as Pillow releases the GIL when decoding images. |br|
+        The transformation pipelines are still run sequentially afterwards,
+        as most multi-transforms store state between the image and annotation transformations.
     """
-    def __init__(self, annotations, input_dimension=None, class_label_map=None, identify=None, transform=None, anno_transform=None):
+    def __init__(self, annotations, input_dimension=None, class_label_map=None, identify=None, transform=None, anno_transform=None, io_workers=0):
         if bb is None:
             raise ImportError('Brambox needs to be installed to use this dataset')
         super().__init__(input_dimension)
@@ -47,6 +57,8 @@ class BramboxDataset(lnd.Dataset):
         self.keys = self.annos.image.cat.categories
         self.transform = transform
         self.anno_transform = anno_transform
+        self.io_workers = io_workers
+        self.__io_pool = (None, None)
 
         if callable(identify):
             self.id = identify
@@ -75,11 +87,66 @@ class BramboxDataset(lnd.Dataset):
         if index >= len(self):
             raise IndexError(f'list index out of range [{index}/{len(self)-1}]')
 
-        # Load
-        img = Image.open(self.id(self.keys[index]))
+        img = self._load_image(index, decode=False)
         anno = bb.util.select_images(self.annos, [self.keys[index]])
+        return self._transform(img, anno)
+
+    def __getitems__(self, indices):
+        """ Get transformed images and annotations of multiple indices at once.
+        If ``io_workers`` is bigger than zero, the images get loaded concurrently.
+
+        Args:
+            indices (list): Indices or (input_dim, index) tuples of the items to fetch
+
+        Returns:
+            list: (transformed image, list of transformed brambox boxes) tuple for each index
+        """
+        if self.io_workers <= 0 or len(indices) <= 1:
+            return super().__getitems__(indices)
+
+        dims, idx = zip(*((None, i) if isinstance(i, int) else i for i in indices))
+        for i in idx:
+            if i >= len(self):
+                raise IndexError(f'list index out of range [{i}/{len(self)-1}]')
+
+        images = self._io_pool.map(self._load_image, idx)
+        items = []
+        for dim, i, img in zip(dims, idx, images):
+            anno = bb.util.select_images(self.annos, [self.keys[i]])
+            if dim is None:
+                items.append(self._transform(img, anno))
+            else:
+                self._input_dim = dim
+                try:
+                    items.append(self._transform(img, anno))
+                finally:
+                    del self._input_dim
+
+        return items
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_BramboxDataset__io_pool'] = (None, None)
+        return state
+
+    @property
+    def _io_pool(self):
+        """ Thread pool for loading images, which gets recreated in every (forked) dataloader worker process. """
+        pid, pool = self.__io_pool
+        if pid != os.getpid():
+            pool = ThreadPoolExecutor(self.io_workers, thread_name_prefix='lightnet_io')
+            self.__io_pool = (os.getpid(), pool)
+        return pool
+
+    def _load_image(self, index, decode=True):
+        """ Open the image of a certain index. """
+        img = Image.open(self.id(self.keys[index]))
+        if decode:
+            img.load()
+        return img
 
-        # Transform
+    def _transform(self, img, anno):
+        """ Run the image and annotations through the transformation pipelines. """
         if self.transform is not None and self.anno_transform is None:
             (img, anno) = self.transform((img, anno))
         elif self.transform is not None:
@@ -33,16 +33,17 @@ class DarknetDataset(BramboxDataset):
         hue (Number, optional): Determines hue shift; Default **0.1**
         saturation (Number, optional): Determines saturation shift; Default **1.5**
         value (Number, optional): Determines value (exposure) shift; Default **1.5**
+        io_workers (int, optional): Number of threads to use for loading the images of a batch concurrently; Default **0**
 
     Returns:
         tuple: image_tensor, list of brambox boxes
     """
-    def __init__(self, data_file, class_label_map, augment=True, input_dimension=(416, 416), jitter=.3, flip=.5, hue=.1, saturation=1.5, value=1.5):
+    def __init__(self, data_file, class_label_map, augment=True, input_dimension=(416, 416), jitter=.3, flip=.5, hue=.1, saturation=1.5, value=1.5, io_workers=0):
         if bb is None:
             raise ImportError('Brambox needs to be installed to use this dataset')
 
         def identify(name):
-            return self.img_paths[self.anno_paths.get_loc(name)]
+            return img_lookup[name]
 
         def get_image_dimensions(name):
             with Image.open(identify(name)) as img:
@@ -52,6 +53,7 @@ class DarknetDataset(BramboxDataset):
         with open(data_file, 'r') as f:
             self.img_paths = f.read().splitlines()
         self.anno_paths = [os.path.splitext(p)[0]+'.txt' for p in self.img_paths]
+        img_lookup = dict(zip(self.anno_paths, self.img_paths))
 
         # Load data
         annos = bb.io.load(
@@ -75,4 +77,4 @@ class DarknetDataset(BramboxDataset):
             img_tf = lnd.transform.Compose([lb, it])
             anno_tf = lnd.transform.Compose([lb])
 
-        super().__init__(annos, input_dimension, class_label_map, identify, img_tf, anno_tf)
+        super().__init__(annos, input_dimension, class_label_map, identify, img_tf, anno_tf, io_workers)
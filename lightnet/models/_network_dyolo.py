@@ -4,7 +4,8 @@
 #
 
 import functools
-from collections import OrderedDict, Iterable
+from collections import OrderedDict
+from collections.abc import Iterable
 import torch
 import torch.nn as nn
 import lightnet.network as lnn
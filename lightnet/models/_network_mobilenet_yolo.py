@@ -3,7 +3,8 @@
 #   Copyright EAVISE
 #
 
-from collections import OrderedDict, Iterable
+from collections import OrderedDict
+from collections.abc import Iterable
 import functools
 import torch
 import torch.nn as nn
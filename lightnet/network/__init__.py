@@ -4,6 +4,25 @@ This module contains classes and functions to create deep neural network with py
 It is mostly targeted at Object detection networks, but contains the necessary tools to build any CNN type network.
 """
 
+import importlib
 from . import layer
 from . import loss
 from . import module
+
+# Tools that depend on heavier parts of PyTorch (or lightnet.data) are only imported when they are first used
+_lazy = {
+    'NetworkProfile': '._profile',
+    'profile': '._profile',
+    'QuantizedNetwork': '._quantize',
+    'quantize': '._quantize',
+}
+
+
+def __getattr__(name):
+    if name in _lazy:
+        return getattr(importlib.import_module(_lazy[name], __name__), name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy))
@@ -0,0 +1,339 @@
+#
+#   Per-layer network profiler
+#   Copyright EAVISE
+#
+import json
+import logging
+import time
+import torch
+import torch.nn as nn
+from torch.utils.flop_counter import FlopCounterMode
+from .module import Lightnet
+
+__all__ = ['NetworkProfile', 'profile']
+log = logging.getLogger(__name__)
+
+
+class NetworkProfile:
+    """ Result of :func:`~lightnet.network.profile`. |br|
+    This class contains one record per layer, in the order in which the layers were first executed.
+    Each record is a dictionary with the following keys:
+
+    - ``name``: Qualified name of the layer (see :meth:`torch.nn.Module.named_modules`)
+    - ``type``: Class name of the layer
+    - ``calls``: Number of times the layer runs in one forward pass
+    - ``time``: Mean time per forward pass in seconds (summed over all calls)
+    - ``time_min``: Minimal time per forward pass in seconds
+    - ``flops``: Floating point operations per forward pass (one multiply-accumulate counts as 2 FLOPs)
+    - ``params``: Number of parameters
+    - ``output_shape``: Shape of the output tensor, or list of shapes for layers with multiple outputs
+    - ``activation_bytes``: Size of the output tensors in bytes (0 for in-place layers, whose outputs reuse the memory of their input)
+
+    Args:
+        layers (list): Per-layer records
+        total (dict): Totals for the whole network (``time``, ``time_min``, ``flops``, ``params``, ``activation_bytes``)
+        meta (dict, optional): Information about the run (eg. input shape, device, number of iterations); Default **empty**
+
+    Note:
+        The ``total`` time is measured for the complete forward pass and is thus slightly larger than the sum of the layer times,
+        as it includes the code that runs in between the layers (eg. concatenations in the ``forward`` function of the network).
+    """
+    columns = ('name', 'type', 'calls', 'time', 'flops', 'params', 'output_shape', 'activation_bytes')
+
+    def __init__(self, layers, total, meta=None):
+        self.layers = layers
+        self.total = total
+        self.meta = meta if meta is not None else {}
+
+    def __len__(self):
+        return len(self.layers)
+
+    def __iter__(self):
+        return iter(self.layers)
+
+    def __getitem__(self, name):
+        for layer in self.layers:
+            if layer['name'] == name:
+                return layer
+        raise KeyError(name)
+
+    def table(self, sort=None, top=None):
+        """ Create a human readable table.
+
+        Args:
+            sort (str, optional): Key to sort the layers by, in descending order (eg. 'time', 'flops', 'activation_bytes'); Default **execution order**
+            top (int, optional): Only show the first `top` layers; Default **all layers**
+
+        Returns:
+            str: Table with one row per layer and the totals at the bottom
+        """
+        layers = self.layers
+        if sort is not None:
+            layers = sorted(layers, key=lambda layer: layer[sort], reverse=True)
+        if top is not None:
+            layers = layers[:top]
+
+        total_time = self.total['time'] or 1
+        header = ('Layer', 'Type', 'Time (ms)', '%', 'GFLOPs', 'Params', 'Output', 'Activation (MB)')
+        rows = [
+            (
+                layer['name'],
+                layer['type'] if layer['calls'] == 1 else f'{layer["type"]} (x{layer["calls"]})',
+                f'{layer["time"] * 1000:.3f}',
+                f'{100 * layer["time"] / total_time:.1f}',
+                f'{layer["flops"] / 1e9:.3f}',
+                f'{layer["params"]:,}',
+                _format_shape(layer['output_shape']),
+                f'{layer["activation_bytes"] / 2**20:.2f}',
+            )
+            for layer in layers
+        ]
+        total = (
+            'Total', '',
+            f'{self.total["time"] * 1000:.3f}', '100.0',
+            f'{self.total["flops"] / 1e9:.3f}',
+            f'{self.total["params"]:,}',
+            '',
+            f'{self.total["activation_bytes"] / 2**20:.2f}',
+        )
+
+        widths = [max(len(row[i]) for row in [header, total, *rows]) for i in range(len(header))]
+        align = ['<', '<', '>', '>', '>', '>', '<', '>']
+
+        def fmt(row):
+            return '  '.join(f'{value:{a}{w}}' for value, a, w in zip(row, align, widths)).rstrip()
+
+        line = '-' * len(fmt(header))
+        return '\n'.join([fmt(header), line, *(fmt(row) for row in rows), line, fmt(total)])
+
+    def to_dict(self):
+        """ Convert the profile to a dictionary with ``meta``, ``total`` and ``layers`` keys. """
+        return {'meta': self.meta, 'total': self.total, 'layers': self.layers}
+
+    def to_json(self, path=None, indent=2):
+        """ Serialize the profile to JSON. |br|
+        The layers are stored in execution order with a fixed set of keys, so that the files of different model variants can easily be diffed.
+
+        Args:
+            path (str or pathlib.Path, optional): File to write the JSON to; Default **return the JSON as a string**
+            indent (int, optional): Indentation of the JSON; Default **2**
+
+        Returns:
+            str or None: JSON string if no path was given
+        """
+        data = json.dumps(self.to_dict(), indent=indent)
+        if path is None:
+            return data
+
+        with open(path, 'w') as f:
+            f.write(data)
+
+    @classmethod
+    def from_json(cls, path):
+        """ Load a profile that was saved with :func:`to_json`.
+
+        Args:
+            path (str or pathlib.Path): JSON file
+
+        Returns:
+            lightnet.network.NetworkProfile: Profile
+        """
+        with open(path, 'r') as f:
+            data = json.load(f)
+        return cls(data['layers'], data['total'], data.get('meta'))
+
+    def __str__(self):
+        return self.table()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(layers={len(self.layers)}, time={self.total["time"] * 1000:.3f}ms, flops={self.total["flops"]})'
+
+
+def profile(network, example, warmup=5, iterations=20, layers=None):
+    """ Measure the latency, FLOPs, parameters and activation memory of each layer of a network. |br|
+    This function attaches forward hooks to the layers and runs the network for a number of warm-up and timed iterations.
+    FLOPs are counted in a separate forward pass with :class:`torch.utils.flop_counter.FlopCounterMode`.
+
+    Args:
+        network (torch.nn.Module): Network to profile
+        example (torch.Tensor): Example input, which determines the device and input size that gets profiled
+        warmup (int, optional): Number of forward passes before timing; Default **5**
+        iterations (int, optional): Number of timed forward passes; Default **20**
+        layers (list, optional): Names of the modules to profile (see :meth:`torch.nn.Module.named_modules`); Default **layers from** :func:`~lightnet.network.module.Lightnet.layer_loop`
+
+    Returns:
+        lightnet.network.NetworkProfile: Profile with one record per layer
+
+    Note:
+        If the network is not a :class:`~lightnet.network.module.Lightnet` network, the leaf modules are profiled by default.
+        When profiling modules that contain each other, the time, FLOPs and activation bytes of the outer module include those of the inner ones.
+
+    Note:
+        On CUDA, the hooks synchronize the device before and after every layer, in order to get accurate timings.
+        This removes the overlap between consecutive kernels, so the total time will be slightly higher than without profiling.
+
+    Example:
+        >>> net = ln.models.TinyYoloV2(20)
+        >>> prof = ln.network.profile(net, torch.rand(1, 3, 416, 416), warmup=1, iterations=2)
+        >>> len(prof) == len(list(net.layer_loop()))
+        True
+        >>> prof['layers.1_convbatch']['output_shape']
+        [1, 16, 416, 416]
+        >>> print(prof.table(sort='time', top=3))     # doctest: +SKIP
+        Layer                Type             Time (ms)     %  GFLOPs     Params  Output            Activation (MB)
+        ---------------------------------------------------------------------------------------------------------
+        layers.8_convbatch   Conv2dBatchReLU     12.046  24.8   1.595  1,180,160  [1, 512, 13, 13]             0.33
+        layers.13_convbatch  Conv2dBatchReLU      8.931  18.3   1.595  1,180,160  [1, 512, 13, 13]             0.33
+        ...
+    """
+    names = {module: name for name, module in network.named_modules()}
+    if layers is not None:
+        modules = dict(network.named_modules())
+        missing = [name for name in layers if name not in modules]
+        if len(missing):
+            raise KeyError(f'Unknown layers: {missing}')
+        targets = [(name, modules[name]) for name in layers]
+    elif isinstance(network, Lightnet):
+        targets = [(names[module], module) for module in network.layer_loop()]
+    else:
+        targets = [(name, module) for name, module in network.named_modules() if len(module._modules) == 0]
+
+    records = {}
+    for name, module in targets:
+        records[name] = {
+            'name': name,
+            'type': type(module).__name__,
+            'calls': 0,
+            'time': [],
+            'flops': 0,
+            'params': sum(p.numel() for p in module.parameters()),
+            'output_shape': None,
+            'activation_bytes': 0,
+        }
+    order = []
+
+    cuda = example.is_cuda
+    state = {'timing': False, 'counter': None, 'start': {}, 'flops': {}, 'iteration': {}}
+
+    def pre_hook(name, module, args):
+        if cuda:
+            torch.cuda.synchronize(example.device)
+        if state['counter'] is not None:
+            state['flops'][name] = state['counter'].get_total_flops()
+        state['start'][name] = time.perf_counter()
+
+    def hook(name, module, args, output):
+        if cuda:
+            torch.cuda.synchronize(example.device)
+        elapsed = time.perf_counter() - state['start'][name]
+        record = records[name]
+
+        if state['timing']:
+            state['iteration'][name] = state['iteration'].get(name, 0) + elapsed
+        elif state['counter'] is not None:
+            if record['calls'] == 0:
+                order.append(name)
+                record['output_shape'] = _shape(output)
+            record['calls'] += 1
+            record['flops'] += state['counter'].get_total_flops() - state['flops'][name]
+            inputs = {t.untyped_storage().data_ptr() for t in _tensors(args)}
+            record['activation_bytes'] += sum(t.nbytes for t in _tensors(output) if t.untyped_storage().data_ptr() not in inputs)
+
+    handles = []
+    for name, module in targets:
+        handles.append(module.register_forward_pre_hook(lambda m, a, name=name: pre_hook(name, m, a)))
+        handles.append(module.register_forward_hook(lambda m, a, o, name=name: hook(name, m, a, o)))
+
+    training = network.training
+    totals = []
+    try:
+        network.eval()
+        with torch.no_grad():
+            # Count FLOPs, shapes and bytes
+            counter = FlopCounterMode(display=False)
+            state['counter'] = counter
+            with counter:
+                network(example)
+            state['counter'] = None
+            total_flops = counter.get_total_flops()
+
+            for _ in range(warmup):
+                network(example)
+
+            state['timing'] = True
+            for _ in range(iterations):
+                state['iteration'] = {}
+                if cuda:
+                    torch.cuda.synchronize(example.device)
+                start = time.perf_counter()
+                network(example)
+                if cuda:
+                    torch.cuda.synchronize(example.device)
+                totals.append(time.perf_counter() - start)
+                for name, elapsed in state['iteration'].items():
+                    records[name]['time'].append(elapsed)
+    finally:
+        network.train(training)
+        for handle in handles:
+            handle.remove()
+
+    unused = [name for name in records if records[name]['calls'] == 0]
+    if len(unused):
+        log.debug(f'Layers that did not run: {unused}')
+
+    layers = []
+    for name in order:
+        record = records[name]
+        times = record.pop('time')
+        record['time'] = sum(times) / len(times) if len(times) else 0.0
+        record['time_min'] = min(times) if len(times) else 0.0
+        layers.append(record)
+
+    total = {
+        'time': sum(totals) / len(totals) if len(totals) else 0.0,
+        'time_min': min(totals) if len(totals) else 0.0,
+        'flops': total_flops,
+        'params': sum(p.numel() for p in network.parameters()),
+        'activation_bytes': sum(layer['activation_bytes'] for layer in layers),
+    }
+    meta = {
+        'network': type(network).__name__,
+        'input_shape': list(example.shape),
+        'dtype': str(example.dtype).replace('torch.', ''),
+        'device': str(example.device),
+        'warmup': warmup,
+        'iterations': iterations,
+        'torch': torch.__version__,
+    }
+    return NetworkProfile(layers, total, meta)
+
+
+def _tensors(x):
+    """ Flatten tensors in nested lists, tuples and dicts. """
+    if isinstance(x, torch.Tensor):
+        return [x]
+    elif isinstance(x, dict):
+        return [t for v in x.values() for t in _tensors(v)]
+    elif isinstance(x, (list, tuple)):
+        return [t for v in x for t in _tensors(v)]
+    return []
+
+
+def _shape(x):
+    """ JSON serializable shape of a tensor or nested outputs. """
+    if isinstance(x, torch.Tensor):
+        return list(x.shape)
+    elif isinstance(x, dict):
+        return {k: _shape(v) for k, v in x.items()}
+    elif isinstance(x, (list, tuple)):
+        return [_shape(v) for v in x]
+    return None
+
+
+def _format_shape(shape):
+    """ Compact string for (nested) shapes. """
+    if isinstance(shape, dict):
+        return '{' + ', '.join(f'{k}: {_format_shape(v)}' for k, v in shape.items()) + '}'
+    elif isinstance(shape, list) and len(shape) and not isinstance(shape[0], int):
+        return '(' + ', '.join(_format_shape(s) for s in shape) + ')'
+    return str(shape)
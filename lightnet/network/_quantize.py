@@ -0,0 +1,268 @@
+#
+#   Post-training static quantization
+#   Copyright EAVISE
+#
+import copy
+import logging
+import itertools
+import torch
+import torch.nn as nn
+import torch.ao.quantization as tq
+import torch.ao.nn.quantized as nnq
+from ..data import Dataset, DataLoader, brambox_collate
+from .layer import InvertedBottleneck, ParallelCat, ParallelSum, Residual
+
+__all__ = ['QuantizedNetwork', 'quantize']
+log = logging.getLogger(__name__)
+
+
+class QuantizedNetwork(nn.Module):
+    """ Wrapper around a network, which quantizes the input and dequantizes the output(s). |br|
+    This module gets created by :func:`~lightnet.network.quantize` and you should probably not create it yourself.
+    Attributes that do not exist on this wrapper (eg. ``anchors``, ``stride``, ``num_classes``) are looked up on the wrapped network,
+    so that you can use it as a drop-in replacement with the post-processing of the network.
+
+    Args:
+        network (nn.Module): Network to wrap
+    """
+    def __init__(self, network):
+        super().__init__()
+        self.quant = tq.QuantStub()
+        self.network = network
+        self.dequant = tq.DeQuantStub()
+
+    def forward(self, x):
+        return self.__dequantize(self.network(self.quant(x)))
+
+    def __dequantize(self, x):
+        if isinstance(x, torch.Tensor):
+            return self.dequant(x)
+        elif isinstance(x, dict):
+            return {k: self.__dequantize(v) for k, v in x.items()}
+        elif isinstance(x, (list, tuple)):
+            return type(x)(self.__dequantize(v) for v in x)
+        return x
+
+    def __getattr__(self, name):
+        try:
+            return super().__getattr__(name)
+        except AttributeError:
+            return getattr(super().__getattr__('network'), name)
+
+
+def quantize(network, data, num_batches=None, backend='x86', float_modules=(), inplace=False):
+    """ Create an int8 version of a network with post-training static quantization. |br|
+    This function performs the following steps:
+
+    1. Fuse every (Conv2d, BatchNorm2d, ReLU) and (Conv2d, BatchNorm2d) sequence.
+    2. Replace the additions and concatenations of :class:`~lightnet.network.layer.Residual`, :class:`~lightnet.network.layer.ParallelSum`,
+       :class:`~lightnet.network.layer.ParallelCat` and :class:`~lightnet.network.layer.InvertedBottleneck` with quantizable versions
+       and run the ``float_modules`` in floating point, by surrounding them with dequant/quant stubs.
+       Layers that only rearrange values, like :class:`~lightnet.network.layer.Reorg`, run directly on the quantized tensors and are kept as is.
+    3. Add quant/dequant stubs at the input and output(s) of the network (see :class:`~lightnet.network.QuantizedNetwork`).
+    4. Calibrate the quantization parameters of the activations by running the network on the data.
+    5. Convert the network to an int8 network.
+
+    Args:
+        network (nn.Module): Network to quantize
+        data (lightnet.data.Dataset or iterable): Dataset or iterable of input tensors (or tuples with an input tensor as first element) to calibrate the network
+        num_batches (int, optional): Maximum number of batches to use for calibration; Default **all data**
+        backend (str, optional): Quantized engine to use (eg. 'x86', 'fbgemm', 'qnnpack'); Default **'x86'**
+        float_modules (tuple, optional): Module types that do not support quantized tensors and should be run in floating point; Default **()**
+        inplace (bool, optional): Whether to modify the network in place, instead of quantizing a copy; Default **False**
+
+    Returns:
+        lightnet.network.QuantizedNetwork: Quantized network
+
+    Note:
+        If you pass a :class:`lightnet.data.Dataset`, it gets wrapped in a :class:`lightnet.data.DataLoader` with a batch size of 8
+        and the :func:`~lightnet.data.brambox_collate` function.
+
+    Note:
+        Concatenations (``torch.cat``) that are performed directly in the ``forward`` of a network (eg. :class:`~lightnet.models.TinyYoloV3`)
+        cannot be replaced and use the quantization parameters of their first input.
+
+    Note:
+        The global ``torch.backends.quantized.engine`` is set to ``backend`` while quantizing and gets restored afterwards.
+        If your default engine differs from the ``backend``, you should set it yourself before running the quantized network.
+
+    Warning:
+        The quantized operators only run on CPU.
+
+    Example:
+        >>> net = ln.models.TinyYoloV2(20)
+        >>> calibration = [torch.rand(2, 3, 416, 416) for _ in range(2)]
+        >>> qnet = ln.network.quantize(net, calibration)
+        >>> qnet(torch.rand(1, 3, 416, 416)).shape
+        torch.Size([1, 125, 13, 13])
+        >>> qnet.anchors == net.anchors
+        True
+    """
+    if not inplace:
+        network = copy.deepcopy(network)
+    network = network.to('cpu').eval()
+
+    if backend not in torch.backends.quantized.supported_engines:
+        raise ValueError(f'Quantized engine [{backend}] is not supported, choose one of {torch.backends.quantized.supported_engines}')
+    engine = torch.backends.quantized.engine
+    torch.backends.quantized.engine = backend
+    try:
+        return _quantize(network, data, num_batches, backend, tuple(float_modules))
+    finally:
+        torch.backends.quantized.engine = engine
+
+
+def _quantize(network, data, num_batches, backend, float_modules):
+    """ Fuse, calibrate and convert a network with the quantized engine set to the backend. """
+    _fuse(network)
+    _replace(network, float_modules)
+    for module in network.modules():
+        if isinstance(module, (nn.ReLU, nn.LeakyReLU)):
+            module.inplace = False      # Not supported by quantized operators
+    model = QuantizedNetwork(network).eval()
+    model.qconfig = tq.get_default_qconfig(backend)
+    tq.prepare(model, inplace=True)
+
+    # Calibrate
+    if isinstance(data, Dataset):
+        data = DataLoader(data, batch_size=8, collate_fn=brambox_collate)
+    if num_batches is not None:
+        data = itertools.islice(data, num_batches)
+
+    count = 0
+    with torch.no_grad():
+        for batch in data:
+            if isinstance(batch, (list, tuple)):
+                batch = batch[0]
+            model(batch)
+            count += 1
+    if count == 0:
+        raise ValueError('No calibration data')
+    log.info(f'Calibrated quantization parameters on {count} batches')
+
+    tq.convert(model, inplace=True)
+    return model
+
+
+def _fuse(network):
+    """ Fuse Conv2d+BatchNorm2d(+ReLU) sequences in every Sequential. """
+    for module in network.modules():
+        if not isinstance(module, nn.Sequential):
+            continue
+
+        names = list(module._modules.keys())
+        groups = []
+        idx = 0
+        while idx < len(names) - 1:
+            conv, bn = module._modules[names[idx]], module._modules[names[idx+1]]
+            if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+                if idx + 2 < len(names) and type(module._modules[names[idx+2]]) is nn.ReLU:
+                    groups.append(names[idx:idx+3])
+                    idx += 3
+                else:
+                    groups.append(names[idx:idx+2])
+                    idx += 2
+            else:
+                idx += 1
+
+        if len(groups):
+            tq.fuse_modules(module, groups, inplace=True)
+
+
+def _replace(module, float_modules):
+    """ Recursively replace modules with their quantizable counterparts. """
+    for name, child in module.named_children():
+        if float_modules and isinstance(child, float_modules):
+            setattr(module, name, _FloatModule(child))
+            continue
+
+        _replace(child, float_modules)
+        if isinstance(child, Residual):
+            setattr(module, name, _QuantizableResidual(child))
+        elif isinstance(child, ParallelCat):
+            setattr(module, name, _QuantizableParallelCat(child))
+        elif isinstance(child, ParallelSum):
+            setattr(module, name, _QuantizableParallelSum(child))
+        elif isinstance(child, InvertedBottleneck):
+            setattr(module, name, _QuantizableInvertedBottleneck(child))
+
+
+class _FloatModule(nn.Module):
+    """ Run a module in floating point. """
+    def __init__(self, module):
+        super().__init__()
+        self.dequant = tq.DeQuantStub()
+        self.module = module
+        self.quant = tq.QuantStub()
+        self.module.qconfig = None
+
+    def forward(self, x):
+        return self.quant(self.module(self.dequant(x)))
+
+
+class _QuantizableResidual(nn.Module):
+    def __init__(self, module):
+        super().__init__()
+        self.module = module
+        self.functional = nnq.FloatFunctional()
+
+    def forward(self, x):
+        y = x
+        for name, module in self.module.named_children():
+            if name not in ('skip', 'post'):
+                y = module(y)
+
+        if self.module.skip is not None:
+            x = self.module.skip(x)
+
+        z = self.functional.add(x, y)
+        if self.module.post is not None:
+            z = self.module.post(z)
+
+        return z
+
+
+class _QuantizableParallelCat(nn.Module):
+    def __init__(self, module):
+        super().__init__()
+        self.module = module
+        self.functional = nnq.FloatFunctional()
+
+    def forward(self, x):
+        output = self.functional.cat([module(x) for name, module in self.module.named_children() if name != 'post'], dim=1)
+        if self.module.post is not None:
+            output = self.module.post(output)
+
+        return output
+
+
+class _QuantizableParallelSum(nn.Module):
+    def __init__(self, module):
+        super().__init__()
+        self.module = module
+        branches = sum(name != 'post' for name in self.module._modules)
+        self.functional = nn.ModuleList(nnq.FloatFunctional() for _ in range(branches - 1))
+
+    def forward(self, x):
+        outputs = [module(x) for name, module in self.module.named_children() if name != 'post']
+        output = outputs[0]
+        for functional, y in zip(self.functional, outputs[1:]):
+            output = functional.add(output, y)
+
+        if self.module.post is not None:
+            output = self.module.post(output)
+
+        return output
+
+
+class _QuantizableInvertedBottleneck(nn.Module):
+    def __init__(self, module):
+        super().__init__()
+        self.module = module
+        self.functional = nnq.FloatFunctional()
+
+    def forward(self, x):
+        if self.module.residual_connect:
+            return self.functional.add(x, self.module.layers(x))
+        else:
+            return self.module.layers(x)
@@ -4,6 +4,7 @@
 #
 
 from collections import OrderedDict
+import torch
 import torch.nn as nn
 from ._darknet import Conv2dBatchReLU
 from ._util import ParallelSum
@@ -27,7 +28,7 @@ class TopPool(nn.Module):
         torch.Size([1, 3, 10, 10])
     """
     def forward(self, x):
-        return x.flip(2).cummax(2)[0].flip(2)
+        return _cummax(x.flip(2), 2).flip(2)
 
 
 class BottomPool(nn.Module):
@@ -46,7 +47,7 @@ class BottomPool(nn.Module):
         torch.Size([1, 3, 10, 10])
     """
     def forward(self, x):
-        return x.cummax(2)[0]
+        return _cummax(x, 2)
 
 
 class LeftPool(nn.Module):
@@ -65,7 +66,7 @@ class LeftPool(nn.Module):
         torch.Size([1, 3, 10, 10])
     """
     def forward(self, x):
-        return x.flip(3).cummax(3)[0].flip(3)
+        return _cummax(x.flip(3), 3).flip(3)
 
 
 class RightPool(nn.Module):
@@ -84,7 +85,7 @@ class RightPool(nn.Module):
         torch.Size([1, 3, 10, 10])
     """
     def forward(self, x):
-        return x.cummax(3)[0]
+        return _cummax(x, 3)
 
 
 class CornerPool(nn.Module):
@@ -154,3 +155,11 @@ class CornerPool(nn.Module):
 
     def forward(self, x):
         return self.layers(x)
+
+
+def _cummax(x, dim):
+    """ Cumulative maximum that keeps the channels_last memory format of the input. """
+    output = x.cummax(dim)[0]
+    if x.is_contiguous(memory_format=torch.channels_last) and not x.is_contiguous():
+        output = output.contiguous(memory_format=torch.channels_last)
+    return output
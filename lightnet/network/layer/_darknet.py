@@ -129,6 +129,11 @@ class PaddedMaxPool2d(nn.Module):
         return f'kernel_size={self.kernel_size}, stride={self.stride}, padding={self.padding}, dilation={self.dilation}'
 
     def forward(self, x):
+        if x.is_quantized:
+            # Replicate padding is not implemented for quantized tensors,
+            # but max pooling does not create new values, so we can requantize with the same parameters.
+            return torch.quantize_per_tensor(self.forward(x.dequantize()), x.q_scale(), x.q_zero_point(), x.dtype)
+
         x = F.max_pool2d(F.pad(x, self.padding, mode='replicate'), self.kernel_size, self.stride, 0, self.dilation)
         return x
 
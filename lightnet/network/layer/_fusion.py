@@ -203,8 +203,14 @@ class Fusion(nn.Module):
             if channels % 2 != 0:
                 raise ValueError(f'Number of input channels is not divisible by 2 [{channels}]')
 
-            r = self.regular(x[:, :channels//2])
-            f = self.fusion(x[:, channels//2:])
+            # Slicing channels of a channels_last tensor results in a tensor that is neither NCHW nor NHWC contiguous
+            regular, fusion = x[:, :channels//2], x[:, channels//2:]
+            if x.is_contiguous(memory_format=torch.channels_last) and not x.is_contiguous():
+                regular = regular.contiguous(memory_format=torch.channels_last)
+                fusion = fusion.contiguous(memory_format=torch.channels_last)
+
+            r = self.regular(regular)
+            f = self.fusion(fusion)
             x = torch.cat((r, f), 1)
 
         if self.fuse is not None:
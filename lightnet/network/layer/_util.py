@@ -367,7 +367,12 @@ class ParallelSum(nn.Sequential):
             self.post = post
 
     def forward(self, x):
-        output = torch.sum(torch.stack([module(x) for name, module in self.named_children() if name != 'post']), dim=0)
+        # Summing one by one keeps the memory format of the branches (eg. channels_last)
+        outputs = [module(x) for name, module in self.named_children() if name != 'post']
+        output = outputs[0]
+        for y in outputs[1:]:
+            output = output + y
+
         if self.post is not None:
             output = self.post(output)
 
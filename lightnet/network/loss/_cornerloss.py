@@ -2,16 +2,13 @@
 #   Darknet RegionLoss
 #   Copyright EAVISE
 #
+import collections
 import logging
 import math
 import numpy as np
 import torch
 import torch.nn as nn
-
-try:
-    import pandas as pd
-except ModuleNotFoundError:
-    pd = None
+from ._util import BufferPool, loss_precision, loss_dtype
 
 __all__ = ['CornerLoss']
 log = logging.getLogger(__name__)
@@ -34,7 +31,17 @@ class CornerLoss(nn.modules.loss._Loss):
         push_scale (float, optional): Scale factor for the push part of the embedding loss (push different classes from each other); Default **1**
         offset_scale (float, optional): Scale factor for the corner offset loss; Default **1**
         inter_scale (float, optional): Scale factor for the loss computed on the intermediate feature map; Default **1**
+
+    Note:
+        The target tensors are kept in a :class:`~lightnet.network.loss._util.BufferPool` and reused for every batch with the same shape.
+        This means the tensors returned by :meth:`build_targets` get overwritten by the next call.
+
+    Note:
+        This loss can be used with mixed precision training (:class:`torch.autocast`).
+        It disables autocasting and computes the loss with the network output cast to (at least) fp32.
     """
+    _max_kernels = 64      # Maximum number of cached gaussian kernels
+
     def __init__(self, stride=4, gaussian_iou=0.3, heatmap_scale=1, pull_scale=1, push_scale=1, offset_scale=1, inter_scale=1):
         super().__init__()
         log.experimental(f'"{self.__class__.__name__}" is still in development. Use at your own risk!')
@@ -49,6 +56,8 @@ class CornerLoss(nn.modules.loss._Loss):
 
         self.eps = 1e-4
         self.l1 = nn.SmoothL1Loss()
+        self._target_buffers = BufferPool()
+        self._gaussian_kernels = collections.OrderedDict()
 
         self.loss_total = torch.tensor(0.0)
         self.loss_heatmap = torch.tensor(0.0)
@@ -80,6 +89,7 @@ class CornerLoss(nn.modules.loss._Loss):
         repr_str += f'heatmap_scale={self.heatmap_scale}, pull_scale={self.pull_scale}, push_scale={self.push_scale}, offset_scale={self.offset_scale}, inter_scale={self.inter_scale}'
         return repr_str
 
+    @loss_precision
     def forward(self, output, target):
         """ Compute Corner loss.
 
@@ -95,6 +105,8 @@ class CornerLoss(nn.modules.loss._Loss):
 
         # Parameters
         device = output.device
+        dtype = loss_dtype(output)
+        output = output.to(dtype)
         nB, nC, nH, nW = output.shape
         nClasses = (nC // 2) - 3
 
@@ -106,17 +118,14 @@ class CornerLoss(nn.modules.loss._Loss):
 
         # Split intermediate
         if intermediate is not None:
-            intermediate = intermediate.view(nB, 2, -1, nH, nW)                             # BATCH, TLBR, NUM_CLASSES+3, H, W
+            intermediate = intermediate.to(dtype).view(nB, 2, -1, nH, nW)                   # BATCH, TLBR, NUM_CLASSES+3, H, W
             inter_heatmaps = intermediate[:, :, :-3].sigmoid().clamp(min=1e-4, max=1-1e-4)  # BATCH, TLBR, NUM_CLASSES,   H, W
             inter_embeddings = intermediate[:, :, -3].permute(1, 0, 2, 3)                   # TLBR, BATCH,                H, W
             inter_offsets = intermediate[:, :, -2:]                                         # BATCH, TLBR, XY,            H, W
 
         # Get ground truth tensors
-        gt_heatmaps, gt_embeddings, gt_offsets, gt_mask = self.build_targets(target, nB, nClasses, nH, nW)
-        gt_heatmaps = gt_heatmaps.to(device)
-        gt_embeddings = gt_embeddings.to(device)
-        gt_offsets = gt_offsets.to(device)
-        gt_mask = gt_mask[:, :, None, ...].expand_as(gt_offsets).to(device)
+        gt_heatmaps, gt_embeddings, gt_offsets, gt_mask = self.build_targets(target, nB, nClasses, nH, nW, device, dtype)
+        gt_mask = gt_mask[:, :, None, ...].expand_as(gt_offsets)
         nGT = gt_mask.sum().item()
 
         # Losses
@@ -137,8 +146,8 @@ class CornerLoss(nn.modules.loss._Loss):
                     + self.inter_scale * self.l1(inter_offsets[gt_mask], gt_offsets[gt_mask])
                 )
             else:
-                self.loss_embedding = torch.tensor(0.0)
-                self.loss_offset = torch.tensor(0.0)
+                self.loss_embedding = torch.tensor(0.0, dtype=dtype, device=device)
+                self.loss_offset = torch.tensor(0.0, dtype=dtype, device=device)
 
             self.loss_total = (self.loss_heatmap + self.loss_embedding + self.loss_offset) / (1 + self.inter_scale)
         else:
@@ -147,84 +156,107 @@ class CornerLoss(nn.modules.loss._Loss):
                 self.loss_embedding = self.pushpull_loss(out_embeddings, gt_embeddings)
                 self.loss_offset = self.offset_scale * self.l1(out_offsets[gt_mask], gt_offsets[gt_mask])
             else:
-                self.loss_embedding = torch.tensor(0.0)
-                self.loss_offset = torch.tensor(0.0)
+                self.loss_embedding = torch.tensor(0.0, dtype=dtype, device=device)
+                self.loss_offset = torch.tensor(0.0, dtype=dtype, device=device)
 
             self.loss_total = self.loss_heatmap + self.loss_embedding + self.loss_offset
 
         # Loss
         return self.loss_total
 
-    def build_targets(self, ground_truth, nB, nC, nH, nW):
-        """ Convert ground truths to network output tensors """
-        heatmaps = torch.zeros(nB, 2, nC, nH, nW, requires_grad=False)
-        offsets = torch.zeros(nB, 2, 2, nH, nW, requires_grad=False)
-        mask = torch.zeros(nB, 2, nH, nW, dtype=torch.bool, requires_grad=False)
-        embedding = list()
-
-        for b, gt_batch in ground_truth.groupby('batch_number', sort=False):
-            # GT tensors
-            class_id = torch.from_numpy(gt_batch.class_id.values).long()
-            size = torch.from_numpy(gt_batch[['width', 'height']].values).float() / self.stride
-            coords = torch.empty((gt_batch.shape[0], 4), requires_grad=False)
-            coords[:, 0:2] = torch.from_numpy(gt_batch[['x_top_left', 'y_top_left']].values).float() / self.stride
-            coords[:, 2:4] = coords[:, 0:2] + size
-            coords_idx = coords.long()
-            coords_idx[:, 0:3:2].clamp_(max=nW-1)
-            coords_idx[:, 1:4:2].clamp_(max=nH-1)
-
-            # Heatmaps
-            if self.gaussian_iou:
-                radii = gaussian_radius(size[:, 0], size[:, 1], self.gaussian_iou)
-                coords0 = (coords_idx - radii[:, None]).clamp(min=0)
-                coords1 = (coords_idx + radii[:, None] + 1)
-                coords1[:, 0:3:2].clamp_(max=nW)
-                coords1[:, 1:4:2].clamp_(max=nH)
-                for idx, r in enumerate(radii):
-                    g = create_gaussian(r, (r+0.5)/3)
-
-                    sxtl = slice(coords0[idx, 0], coords1[idx, 0])
-                    gxtl = slice(0, sxtl.stop - sxtl.start)
-                    sytl = slice(coords0[idx, 1], coords1[idx, 1])
-                    gytl = slice(0, sytl.stop - sytl.start)
-
-                    sxbr = slice(coords0[idx, 2], coords1[idx, 2])
-                    gxbr = slice(0, sxbr.stop - sxbr.start)
-                    sybr = slice(coords0[idx, 3], coords1[idx, 3])
-                    gybr = slice(0, sybr.stop - sybr.start)
-
-                    heatmaps[b, 0, class_id[idx], sytl, sxtl] = torch.max(
-                        g[gytl, gxtl],
-                        heatmaps[b, 0, class_id[idx], sytl, sxtl]
-                    )
-
-                    heatmaps[b, 1, class_id[idx], sybr, sxbr] = torch.max(
-                        g[gybr, gxbr],
-                        heatmaps[b, 1, class_id[idx], sybr, sxbr]
-                    )
-            else:
-                heatmaps[b, 0, class_id, coords_idx[:, 1], coords_idx[:, 0]] = 1
-                heatmaps[b, 1, class_id, coords_idx[:, 3], coords_idx[:, 2]] = 1
+    def build_targets(self, ground_truth, nB, nC, nH, nW, device=None, dtype=torch.float):
+        """ Convert ground truths to network output tensors.
+        The targets of all images in the batch are built at once, on the given device.
+        """
+        heatmaps = self._target_buffers.zeros('heatmaps', (nB, 2, nC, nH, nW), dtype=dtype, device=device)
+        offsets = self._target_buffers.zeros('offsets', (nB, 2, 2, nH, nW), dtype=dtype, device=device)
+        mask = self._target_buffers.zeros('mask', (nB, 2, nH, nW), dtype=torch.bool, device=device)
+        if len(ground_truth) == 0:
+            return heatmaps, torch.empty((0, 2), dtype=torch.long, device=device), offsets, mask
+
+        # GT tensors
+        gt = ground_truth[['batch_number', 'class_id', 'x_top_left', 'y_top_left', 'width', 'height']].values.astype(np.float32)
+        gt = torch.from_numpy(gt).to(device, dtype)
+        b = gt[:, 0].long()
+        class_id = gt[:, 1].long()
+        size = gt[:, 4:6] / self.stride
+        coords = torch.empty((gt.shape[0], 4), dtype=dtype, device=device)
+        coords[:, 0:2] = gt[:, 2:4] / self.stride
+        coords[:, 2:4] = coords[:, 0:2] + size
+        coords_idx = coords.long()
+        coords_idx[:, 0:3:2].clamp_(max=nW-1)
+        coords_idx[:, 1:4:2].clamp_(max=nH-1)
+
+        # Heatmaps
+        if self.gaussian_iou:
+            radii = gaussian_radius(size[:, 0], size[:, 1], self.gaussian_iou)
+            self._render_gaussians(heatmaps, b, class_id, coords_idx, radii)
+        else:
+            heatmaps[b, 0, class_id, coords_idx[:, 1], coords_idx[:, 0]] = 1
+            heatmaps[b, 1, class_id, coords_idx[:, 3], coords_idx[:, 2]] = 1
 
-            # Mask
-            mask[b, 0, coords_idx[:, 1], coords_idx[:, 0]] = True
-            mask[b, 1, coords_idx[:, 3], coords_idx[:, 2]] = True
+        # Mask
+        mask[b, 0, coords_idx[:, 1], coords_idx[:, 0]] = True
+        mask[b, 1, coords_idx[:, 3], coords_idx[:, 2]] = True
 
-            # Embeddings
-            embedding.append((b * nW * nH) + (coords_idx[:, 1:4:2] * nW) + coords_idx[:, 0:3:2])
+        # Embeddings
+        embedding = (b[:, None] * nW * nH) + (coords_idx[:, 1:4:2] * nW) + coords_idx[:, 0:3:2]
 
-            # Offsets
-            off = (coords - coords_idx).transpose(0, 1).contiguous()
-            offsets[b, 0, :, coords_idx[:, 1], coords_idx[:, 0]] = off[0:2]
-            offsets[b, 1, :, coords_idx[:, 3], coords_idx[:, 2]] = off[2:4]
+        # Offsets
+        off = coords - coords_idx
+        offsets[b, 0, 0, coords_idx[:, 1], coords_idx[:, 0]] = off[:, 0]
+        offsets[b, 0, 1, coords_idx[:, 1], coords_idx[:, 0]] = off[:, 1]
+        offsets[b, 1, 0, coords_idx[:, 3], coords_idx[:, 2]] = off[:, 2]
+        offsets[b, 1, 1, coords_idx[:, 3], coords_idx[:, 2]] = off[:, 3]
 
         return (
             heatmaps,
-            torch.cat(embedding, dim=0),
+            embedding,
             offsets,
             mask
         )
 
+    def _render_gaussians(self, heatmaps, b, class_id, coords_idx, radii):
+        """ Splat a gaussian around every top-left and bottom-right corner in the heatmaps.
+        The corners are grouped per radius, so that every group is rendered with a single scatter-max of kernels of its own size.
+        """
+        nB, _, nC, nH, nW = heatmaps.shape
+        device = heatmaps.device
+
+        # Corners: [TL..., BR...]
+        corner_radii = torch.cat([radii, radii])
+        corner_index = (torch.cat([b, b]) * 2 + torch.cat([torch.zeros_like(b), torch.ones_like(b)])) * nC + torch.cat([class_id, class_id])
+        corner_x = torch.cat([coords_idx[:, 0], coords_idx[:, 2]])
+        corner_y = torch.cat([coords_idx[:, 1], coords_idx[:, 3]])
+
+        unique, inverse = corner_radii.unique(return_inverse=True)
+        for i, r in enumerate(unique.tolist()):
+            group = inverse == i
+            kernel = self._get_gaussian_kernel(r, heatmaps.dtype, device)
+
+            # Heatmap indices of every kernel value
+            delta = torch.arange(-r, r+1, device=device)
+            x = corner_x[group, None, None] + delta[None, None, :]
+            y = corner_y[group, None, None] + delta[None, :, None]
+            valid = (x >= 0) & (x < nW) & (y >= 0) & (y < nH)
+            index = corner_index[group, None, None] * (nH * nW) + y * nW + x
+
+            heatmaps.view(-1).scatter_reduce_(0, index[valid], kernel.expand_as(index)[valid], 'amax')
+
+    def _get_gaussian_kernel(self, radius, dtype, device):
+        """ Get the gaussian kernel of a certain radius.
+        The kernels are cached per radius, dtype and device and the least recently used ones get discarded once there are more than ``_max_kernels``.
+        """
+        key = (radius, dtype, device)
+        kernel = self._gaussian_kernels.pop(key, None)
+        if kernel is None:
+            kernel = create_gaussian(radius, (radius+0.5)/3).to(device, dtype)
+            while len(self._gaussian_kernels) >= self._max_kernels:
+                self._gaussian_kernels.popitem(last=False)
+
+        self._gaussian_kernels[key] = kernel
+        return kernel
+
     def focal_loss(self, pred, gt):
         p_mask = gt.eq(1)
         n_mask = ~p_mask
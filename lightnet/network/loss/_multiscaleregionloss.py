@@ -5,6 +5,8 @@
 
 import torch
 from . import RegionLoss
+from ._regionloss import bbox_wh_ious
+from ._util import BufferPool, loss_precision, loss_dtype
 
 __all__ = ['MultiScaleRegionLoss']
 
@@ -28,10 +30,14 @@ class MultiScaleRegionLoss(RegionLoss):
         All parameters are the same as :class:`~lightnet.network.loss.RegionLoss`, except for `anchors` and `stride`. |br|
         These 2 parameters need separate values for each different network output scale and thus need to be lists of the original parameter.
 
+    Note:
+        The ground truth is parsed once for all scales and each box gets assigned to its best matching anchor over all scales, like in Darknet.
+        The other scales only use that box to ignore the confidence loss of matching predictions. |br|
+        This loss does not modify its anchors or stride during the forward pass, so it can safely be used with data-parallel replicas.
+
     Warning:
         This loss function is not entirely equivalent to the Darknet implementation! |br|
-        We just execute the regular :class:`~lightnet.network.loss.RegionLoss` at multiple scales (different strides and anchors),
-        and as such did not implement overlapping class labels.
+        We did not implement overlapping class labels.
     """
     def __init__(self, num_classes, anchors, stride, **kwargs):
         super().__init__(num_classes, anchors[0], stride=stride[0], **kwargs)
@@ -40,6 +46,7 @@ class MultiScaleRegionLoss(RegionLoss):
             raise IndexError('length of anchors and stride should be equal (number of output scales)')
         self._anchors = torch.tensor(anchors, dtype=torch.float, requires_grad=False)
         self._stride = stride
+        self._target_buffers = BufferPool(2 * len(stride))
 
     def extra_repr(self):
         repr_str = f'classes={self.num_classes}, stride={self.stride}, threshold={self.thresh}, seen={self.seen.item()}\n'
@@ -54,31 +61,42 @@ class MultiScaleRegionLoss(RegionLoss):
             start = False
         return repr_str
 
+    @loss_precision
     def forward(self, output, target, seen=None):
+        nB = output[0].shape[0]
+        nH, nW = output[0].shape[-2:]
         device = output[0].device
-        loss_total = torch.tensor(0.0, device=device)
-        loss_conf = torch.tensor(0.0, device=device)
-        loss_coord = torch.tensor(0.0, device=device)
-        loss_class = torch.tensor(0.0, device=device)
+        dtype = loss_dtype(output[0])
         if seen is not None:
             self.seen = torch.tensor(seen)
+        elif self.training:
+            self.seen += nB
 
-        # Run loss at different scales and sum resulting loss values
-        for i, out in enumerate(output):
-            self.anchors = self._anchors[i]
-            self.num_anchors = self.anchors.shape[0]
-            self.anchor_step = self.anchors.shape[1]
-            self.stride = self._stride[i]
+        # Parse ground truth once for all scales
+        gt = self._parse_ground_truth(target, nB, nW*self._stride[0], nH*self._stride[0], device)
 
-            super().forward(out, target)
-            loss_total += self.loss_total
-            loss_conf += self.loss_conf
-            loss_coord += self.loss_coord
-            loss_class += self.loss_class
+        # Find best anchor over all scales, by comparing the anchors in pixels
+        gt_boxes = gt[0].to(dtype)
+        anchors = self._anchors.to(device, dtype)
+        nS, nA = anchors.shape[:2]
+        stride = torch.tensor(self._stride, dtype=dtype, device=device)
+        anchor_boxes = torch.cat([torch.zeros(nS*nA, 2, dtype=dtype, device=device), (anchors[..., :2] * stride[:, None, None]).view(-1, 2)], 1)
+        best = bbox_wh_ious(gt_boxes.view(-1, 4), anchor_boxes).argmax(1).view(gt_boxes.shape[:2])
+        best_scale = best // nA
+        best_anchor = best % nA
+
+        # Compute loss at different scales and sum resulting loss values
+        loss_coord, loss_conf, loss_class = 0, 0, 0
+        for i, out in enumerate(output):
+            gt_anchors = best_anchor.masked_fill(best_scale != i, -1)
+            coord, conf, cls = self._compute_loss(out, gt, anchors[i], self._stride[i], gt_anchors)
+            loss_coord += coord
+            loss_conf += conf
+            loss_class += cls
 
         # Overwrite loss values with avg
-        self.loss_total = loss_total / len(output)
-        self.loss_conf = loss_conf / len(output)
         self.loss_coord = loss_coord / len(output)
+        self.loss_conf = loss_conf / len(output)
         self.loss_class = loss_class / len(output)
+        self.loss_total = self.loss_coord + self.loss_conf + self.loss_class
         return self.loss_total
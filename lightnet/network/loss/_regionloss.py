@@ -8,18 +8,14 @@ import math
 import numpy as np
 import torch
 import torch.nn as nn
-from distutils.version import LooseVersion
+from ._util import BufferPool, loss_precision, loss_dtype
+from ..._lazy import lazy_import
 
-try:
-    import pandas as pd
-except ModuleNotFoundError:
-    pd = None
+pd = lazy_import('pandas')
 
 
 __all__ = ['RegionLoss']
 log = logging.getLogger(__name__)
-torchversion = LooseVersion(torch.__version__)
-version120 = LooseVersion("1.2.0")
 
 
 class RegionLoss(nn.modules.loss._Loss):
@@ -36,6 +32,15 @@ class RegionLoss(nn.modules.loss._Loss):
         class_scale (optional, float): weight of categorical predictions; Default **1.0**
         thresh (optional, float): minimum iou between a predicted box and ground truth for them to be considered matching; Default **0.6**
         coord_prefill (optional, int): This parameter controls for how many training samples the network will prefill the target coordinates, biassing the network to predict the center at **.5,.5**; Default **12800**
+
+    Note:
+        The target tensors are kept in a :class:`~lightnet.network.loss._util.BufferPool` and reused for every batch with the same shape.
+        This means the tensors returned by :meth:`build_targets` get overwritten by the next call.
+
+    Note:
+        This loss can be used with mixed precision training (:class:`torch.autocast`).
+        It disables autocasting and computes the loss with the network output cast to (at least) fp32,
+        as the targets and loss computations are numerically sensitive.
     """
     def __init__(self, num_classes, anchors, stride=32, seen=0, coord_scale=1.0, noobject_scale=1.0, object_scale=5.0, class_scale=1.0, thresh=0.6, coord_prefill=12800):
         super().__init__()
@@ -55,6 +60,7 @@ class RegionLoss(nn.modules.loss._Loss):
 
         self.mse = nn.MSELoss(reduction='sum')
         self.cel = nn.CrossEntropyLoss(reduction='sum')
+        self._target_buffers = BufferPool()
 
         self.loss_total = torch.tensor(0.0)
         self.loss_conf = torch.tensor(0.0)
@@ -89,6 +95,7 @@ class RegionLoss(nn.modules.loss._Loss):
             repr_str += f'[{a[0]:.5g}, {a[1]:.5g}] '
         return repr_str
 
+    @loss_precision
     def forward(self, output, target, seen=None):
         """ Compute Region loss.
 
@@ -120,18 +127,43 @@ class RegionLoss(nn.modules.loss._Loss):
             This allows you to have annotations that will not influence the loss in any way,
             as opposed to having them removed and counting them as false detections.
         """
+        nB = output.shape[0]
+        nH, nW = output.shape[-2:]
+        if seen is not None:
+            self.seen = torch.tensor(seen)
+        elif self.training:
+            self.seen += nB
+
+        gt = self._parse_ground_truth(target, nB, nW*self.stride, nH*self.stride, output.device)
+        self.loss_coord, self.loss_conf, self.loss_class = self._compute_loss(output, gt, self.anchors, self.stride)
+        self.loss_total = self.loss_coord + self.loss_conf + self.loss_class
+        return self.loss_total
+
+    def _compute_loss(self, output, gt, anchors, stride, gt_anchors=None):
+        """ Compute the coordinate, confidence and class loss of one output scale.
+        This method does not modify the state of the loss, so that it can be used for multiple scales.
+
+        Args:
+            output (torch.Tensor): Network output of this scale
+            gt (tuple): Padded ground truth tensors (see ``_parse_ground_truth``)
+            anchors (torch.Tensor): Anchors of this scale
+            stride (int): Stride of this scale
+            gt_anchors (torch.Tensor, optional): Anchor index of each ground truth box [nB, nT] (-1 for boxes that are not assigned to this scale); Default **best matching anchor of this scale**
+
+        Returns:
+            tuple: coordinate, confidence and class loss
+        """
         # Parameters
         nB = output.data.size(0)
-        nA = self.num_anchors
+        nA = anchors.shape[0]
         nC = self.num_classes
         nH = output.data.size(2)
         nW = output.data.size(3)
         nPixels = nH * nW
         device = output.device
-        if seen is not None:
-            self.seen = torch.tensor(seen)
-        elif self.training:
-            self.seen += nB
+        dtype = loss_dtype(output)
+        output = output.to(dtype)
+        anchors = anchors.to(device, dtype)
 
         # Get x,y,w,h,conf,cls
         output = output.view(nB, nA, -1, nPixels)
@@ -140,125 +172,157 @@ class RegionLoss(nn.modules.loss._Loss):
         coord[:, :, 2:4] = output[:, :, 2:4]            # tw,th
         conf = output[:, :, 4].sigmoid()
         if nC > 1:
-            cls = output[:, :, 5:].contiguous().view(nB*nA, nC, nPixels).transpose(1, 2).contiguous().view(-1, nC)
+            cls = output[:, :, 5:].transpose(2, 3).reshape(-1, nC)     # Single copy for both NCHW and NHWC output
 
         # Create prediction boxes
-        pred_boxes = torch.FloatTensor(nB*nA*nPixels, 4)
-        lin_x = torch.linspace(0, nW-1, nW).repeat(nH, 1).view(nPixels).to(device)
-        lin_y = torch.linspace(0, nH-1, nH).view(nH, 1).repeat(1, nW).view(nPixels).to(device)
-        anchor_w = self.anchors[:, 0].contiguous().view(nA, 1).to(device)
-        anchor_h = self.anchors[:, 1].contiguous().view(nA, 1).to(device)
-
-        pred_boxes[:, 0] = (coord[:, :, 0].detach() + lin_x).view(-1)
-        pred_boxes[:, 1] = (coord[:, :, 1].detach() + lin_y).view(-1)
-        pred_boxes[:, 2] = (coord[:, :, 2].detach().exp() * anchor_w).view(-1)
-        pred_boxes[:, 3] = (coord[:, :, 3].detach().exp() * anchor_h).view(-1)
-        pred_boxes = pred_boxes.cpu()
+        lin_x = torch.linspace(0, nW-1, nW, dtype=dtype, device=device).repeat(nH, 1).view(nPixels)
+        lin_y = torch.linspace(0, nH-1, nH, dtype=dtype, device=device).view(nH, 1).repeat(1, nW).view(nPixels)
+        anchor_w = anchors[:, 0].contiguous().view(nA, 1)
+        anchor_h = anchors[:, 1].contiguous().view(nA, 1)
+
+        pred_boxes = torch.stack((
+            coord[:, :, 0].detach() + lin_x,
+            coord[:, :, 1].detach() + lin_y,
+            coord[:, :, 2].detach().exp() * anchor_w,
+            coord[:, :, 3].detach().exp() * anchor_h,
+        ), -1).view(-1, 4)
 
         # Get target values
-        coord_mask, conf_mask, cls_mask, tcoord, tconf, tcls = self.build_targets(pred_boxes, target, nB, nH, nW)
-        coord_mask = coord_mask.expand_as(tcoord).to(device).sqrt()
-        conf_mask = conf_mask.to(device).sqrt()
-        tcoord = tcoord.to(device)
-        tconf = tconf.to(device)
+        gt_boxes, gt_cls, gt_valid, gt_ignore = gt
+        coord_mask, conf_mask, cls_mask, tcoord, tconf, tcls = self._build_targets(
+            pred_boxes, gt_boxes.to(dtype) / stride, gt_cls, gt_valid, gt_ignore,
+            nB, nH, nW, anchors, gt_anchors,
+        )
+        coord_mask = coord_mask.expand_as(tcoord).sqrt()
+        conf_mask = conf_mask.sqrt()
         if nC > 1:
-            tcls = tcls[cls_mask].view(-1).long().to(device)
-            cls_mask = cls_mask.view(-1, 1).repeat(1, nC).to(device)
+            tcls = tcls[cls_mask].view(-1).long()
+            cls_mask = cls_mask.view(-1, 1).repeat(1, nC)
             cls = cls[cls_mask].view(-1, nC)
 
         # Compute losses
-        self.loss_coord = self.coord_scale * self.mse(coord*coord_mask, tcoord*coord_mask) / (2 * nB)
-        self.loss_conf = self.mse(conf*conf_mask, tconf*conf_mask) / (2 * nB)
-        if nC > 1:
-            if tcls.numel() > 0:
-                self.loss_class = self.class_scale * self.cel(cls, tcls) / nB
-            else:
-                self.loss_class = torch.tensor(0.0, device=device)
+        loss_coord = self.coord_scale * self.mse(coord*coord_mask, tcoord*coord_mask) / (2 * nB)
+        loss_conf = self.mse(conf*conf_mask, tconf*conf_mask) / (2 * nB)
+        if nC > 1 and tcls.numel() > 0:
+            loss_class = self.class_scale * self.cel(cls, tcls) / nB
         else:
-            self.loss_class = torch.tensor(0.0, device=device)
+            loss_class = torch.tensor(0.0, dtype=dtype, device=device)
 
-        self.loss_total = self.loss_coord + self.loss_conf + self.loss_class
-        return self.loss_total
+        return loss_coord, loss_conf, loss_class
 
     def build_targets(self, pred_boxes, ground_truth, nB, nH, nW):
-        """ Compare prediction boxes and targets, convert targets to network output tensors """
+        """ Compare prediction boxes and targets, convert targets to network output tensors.
+        The targets of all images in the batch are built at once, on the device of the prediction boxes.
+        """
+        gt, gt_cls, gt_valid, gt_ignore = self._parse_ground_truth(ground_truth, nB, nW*self.stride, nH*self.stride, pred_boxes.device)
+        anchors = self.anchors.to(pred_boxes.device, pred_boxes.dtype)
+        return self._build_targets(pred_boxes, gt.to(pred_boxes.dtype) / self.stride, gt_cls, gt_valid, gt_ignore, nB, nH, nW, anchors)
+
+    def _parse_ground_truth(self, ground_truth, nB, width, height, device):
+        """ Convert the ground truth to padded tensors, with the boxes in pixel coordinates of the network input.
+
+        Returns:
+            tuple: boxes [nB, nT, 4] as (xc, yc, w, h), class ids [nB, nT], valid mask [nB, nT] and ignore mask [nB, nT]
+        """
         if torch.is_tensor(ground_truth):
-            return self.__build_targets_tensor(pred_boxes, ground_truth, nB, nH, nW)
+            ground_truth = ground_truth.to(device)
+            boxes = ground_truth[..., 1:5] * torch.tensor([width, height, width, height], dtype=ground_truth.dtype, device=device)
+            cls = ground_truth[..., 0]
+            valid = cls >= 0
+            return boxes, cls, valid, torch.zeros_like(valid)
         elif pd is not None and isinstance(ground_truth, pd.DataFrame):
-            return self.__build_targets_brambox(pred_boxes, ground_truth, nB, nH, nW)
+            batch = ground_truth.batch_number.values.astype(np.int64)
+            index = ground_truth.groupby('batch_number', sort=False).cumcount().values
+            nT = int(index.max()) + 1 if len(index) > 0 else 0
+
+            data = np.zeros((nB, nT, 7), dtype=np.float32)
+            data[batch, index, 0] = ground_truth.x_top_left.values + ground_truth.width.values / 2
+            data[batch, index, 1] = ground_truth.y_top_left.values + ground_truth.height.values / 2
+            data[batch, index, 2] = ground_truth.width.values
+            data[batch, index, 3] = ground_truth.height.values
+            data[batch, index, 4] = ground_truth.class_id.values
+            data[batch, index, 5] = 1
+            data[batch, index, 6] = ground_truth.ignore.values
+
+            data = torch.from_numpy(data).to(device)
+            return data[..., :4], data[..., 4], data[..., 5] > 0, data[..., 6] > 0
         else:
             raise TypeError(f'Unkown ground truth format [{type(ground_truth)}]')
 
-    def __build_targets_tensor(self, pred_boxes, ground_truth, nB, nH, nW):
-        """ Compare prediction boxes and ground truths, convert ground truths to network output tensors """
+    def _build_targets(self, pred_boxes, gt, gt_cls, gt_valid, gt_ignore, nB, nH, nW, anchors, gt_anchors=None):
+        """ Build the target tensors from padded ground truth tensors (see ``_parse_ground_truth``), with the boxes in grid coordinates.
+        If ``gt_anchors`` is given, it contains the anchor index of each ground truth box (or -1 to only use the box for the confidence mask),
+        otherwise each box gets assigned to its best matching anchor.
+        """
         # Parameters
-        nT = ground_truth.size(1)
-        nA = self.num_anchors
-        nAnchors = nA*nH*nW
+        nA, anchor_step = anchors.shape
         nPixels = nH*nW
+        device = pred_boxes.device
+        dtype = pred_boxes.dtype
 
         # Tensors
-        coord_mask = torch.zeros(nB, nA, nH, nW, requires_grad=False)
-        conf_mask = torch.ones(nB, nA, nH, nW, requires_grad=False) * self.noobject_scale
-        if torchversion >= version120:
-            cls_mask = torch.zeros(nB, nA, nH, nW, dtype=torch.bool, requires_grad=False)
-        else:
-            cls_mask = torch.zeros(nB, nA, nH, nW, requires_grad=False).byte()
-        tcoord = torch.zeros(nB, nA, 4, nH, nW, requires_grad=False)
-        tconf = torch.zeros(nB, nA, nH, nW, requires_grad=False)
-        tcls = torch.zeros(nB, nA, nH, nW, requires_grad=False)
+        buffers = self._target_buffers
+        coord_mask = buffers.zeros('coord_mask', (nB, nA, nH, nW), dtype=dtype, device=device)
+        conf_mask = buffers.full('conf_mask', (nB, nA, nH, nW), self.noobject_scale, dtype=dtype, device=device)
+        cls_mask = buffers.zeros('cls_mask', (nB, nA, nH, nW), dtype=torch.bool, device=device)
+        tcoord = buffers.zeros('tcoord', (nB, nA, 4, nH, nW), dtype=dtype, device=device)
+        tconf = buffers.zeros('tconf', (nB, nA, nH, nW), dtype=dtype, device=device)
+        tcls = buffers.zeros('tcls', (nB, nA, nH, nW), dtype=dtype, device=device)
 
         if self.training and self.seen < self.coord_prefill:
             coord_mask.fill_(math.sqrt(.01 / self.coord_scale))
-            if self.anchor_step == 4:
-                tcoord[:, :, 0] = self.anchors[:, 2].contiguous().view(1, nA, 1, 1).repeat(nB, 1, 1, nPixels)
-                tcoord[:, :, 1] = self.anchors[:, 3].contiguous().view(1, nA, 1, 1).repeat(nB, 1, 1, nPixels)
+            if anchor_step == 4:
+                tcoord[:, :, 0] = anchors[:, 2].contiguous().view(1, nA, 1, 1)
+                tcoord[:, :, 1] = anchors[:, 3].contiguous().view(1, nA, 1, 1)
             else:
                 tcoord[:, :, 0].fill_(0.5)
                 tcoord[:, :, 1].fill_(0.5)
 
-        # Anchors
-        if self.anchor_step == 4:
-            anchors = self.anchors.clone()
-            anchors[:, :2] = 0
-        else:
-            anchors = torch.cat([torch.zeros_like(self.anchors), self.anchors], 1)
-
-        # Loop over GT
-        for b in range(nB):
-            gt = ground_truth[b][(ground_truth[b, :, 0] >= 0)[:, None].expand_as(ground_truth[b])].view(-1, 5)
-            if gt.numel() == 0:     # No gt for this image
-                continue
-
-            # Build up tensors
-            cur_pred_boxes = pred_boxes[b*nAnchors:(b+1)*nAnchors]
-            gt = gt[:, 1:]
-            gt[:, ::2] *= nW
-            gt[:, 1::2] *= nH
-
+        if gt.numel() > 0:
             # Set confidence mask of matching detections to 0
-            iou_gt_pred = bbox_ious(gt, cur_pred_boxes)
-            mask = (iou_gt_pred > self.thresh).sum(0) >= 1
-            conf_mask[b][mask.view_as(conf_mask[b])] = 0
-
-            # Find best anchor for each gt
-            iou_gt_anchors = bbox_wh_ious(gt, anchors)
-            _, best_anchors = iou_gt_anchors.max(1)
+            pred_boxes = pred_boxes.view(nB, nA*nPixels, 4)
+            max_iou = bbox_max_ious(gt, pred_boxes, gt_valid)
+            conf_mask[(max_iou > self.thresh).view_as(conf_mask)] = 0
+
+            # Find best anchor for each valid gt
+            if gt_anchors is None:
+                b, t = gt_valid.nonzero(as_tuple=True)
+                gt = gt[b, t]
+                if anchor_step == 4:
+                    anchor_boxes = anchors.clone()
+                    anchor_boxes[:, :2] = 0
+                else:
+                    anchor_boxes = torch.cat([torch.zeros_like(anchors), anchors], 1)
+                best_anchors = bbox_wh_ious(gt, anchor_boxes).argmax(1)
+            else:
+                b, t = (gt_valid & (gt_anchors >= 0)).nonzero(as_tuple=True)
+                gt = gt[b, t]
+                best_anchors = gt_anchors[b, t]
+            nGT = gt.shape[0]
 
             # Set masks and target values for each gt
-            nGT = gt.shape[0]
             gi = gt[:, 0].clamp(0, nW-1).long()
             gj = gt[:, 1].clamp(0, nH-1).long()
+            cell = best_anchors * nPixels + gj * nW + gi
+            iou = bbox_pair_ious(gt, pred_boxes[b, cell])
 
             conf_mask[b, best_anchors, gj, gi] = self.object_scale
-            tconf[b, best_anchors, gj, gi] = iou_gt_pred.view(nGT, nA, nH, nW)[torch.arange(nGT), best_anchors, gj, gi]
+            tconf[b, best_anchors, gj, gi] = iou
             coord_mask[b, best_anchors, gj, gi] = 2 - (gt[:, 2] * gt[:, 3]) / nPixels
-            tcoord[b, best_anchors, 0, gj, gi] = gt[:, 0] - gi.float()
-            tcoord[b, best_anchors, 1, gj, gi] = gt[:, 1] - gj.float()
-            tcoord[b, best_anchors, 2, gj, gi] = (gt[:, 2] / self.anchors[best_anchors, 0]).log()
-            tcoord[b, best_anchors, 3, gj, gi] = (gt[:, 3] / self.anchors[best_anchors, 1]).log()
-            cls_mask[b, best_anchors, gj, gi] = 1
-            tcls[b, best_anchors, gj, gi] = ground_truth[b, torch.arange(nGT), 0]
+            tcoord[b, best_anchors, 0, gj, gi] = gt[:, 0] - gi.to(dtype)
+            tcoord[b, best_anchors, 1, gj, gi] = gt[:, 1] - gj.to(dtype)
+            tcoord[b, best_anchors, 2, gj, gi] = (gt[:, 2] / anchors[best_anchors, 0]).log()
+            tcoord[b, best_anchors, 3, gj, gi] = (gt[:, 3] / anchors[best_anchors, 1]).log()
+            cls_mask[b, best_anchors, gj, gi] = True
+            tcls[b, best_anchors, gj, gi] = gt_cls[b, t].to(dtype)
+
+            # Set masks of ignored to zero
+            ignore = gt_ignore[b, t]
+            if nGT > 0 and ignore.any():
+                b, best_anchors, gj, gi = b[ignore], best_anchors[ignore], gj[ignore], gi[ignore]
+                conf_mask[b, best_anchors, gj, gi] = 0
+                coord_mask[b, best_anchors, gj, gi] = 0
+                cls_mask[b, best_anchors, gj, gi] = False
 
         return (
             coord_mask.view(nB, nA, 1, nPixels),
@@ -269,124 +333,94 @@ class RegionLoss(nn.modules.loss._Loss):
             tcls.view(nB, nA, nPixels)
         )
 
-    def __build_targets_brambox(self, pred_boxes, ground_truth, nB, nH, nW):
-        """ Compare prediction boxes and ground truths, convert ground truths to network output tensors """
-        # Parameters
-        nA = self.num_anchors
-        nAnchors = nA*nH*nW
-        nPixels = nH*nW
 
-        # Tensors
-        coord_mask = torch.zeros(nB, nA, nH, nW, requires_grad=False)
-        conf_mask = torch.ones(nB, nA, nH, nW, requires_grad=False) * self.noobject_scale
-        if torchversion >= version120:
-            cls_mask = torch.zeros(nB, nA, nH, nW, dtype=torch.bool, requires_grad=False)
-        else:
-            cls_mask = torch.zeros(nB, nA, nH, nW, requires_grad=False).byte()
-        tcoord = torch.zeros(nB, nA, 4, nH, nW, requires_grad=False)
-        tconf = torch.zeros(nB, nA, nH, nW, requires_grad=False)
-        tcls = torch.zeros(nB, nA, nH, nW, requires_grad=False)
+def bbox_ious(boxes1, boxes2):
+    """ Compute IOU between all boxes from ``boxes1`` with all boxes from ``boxes2``.
 
-        if self.training and self.seen < self.coord_prefill:
-            coord_mask.fill_(math.sqrt(.01 / self.coord_scale))
-            if self.anchor_step == 4:
-                tcoord[:, :, 0] = self.anchors[:, 2].contiguous().view(1, nA, 1, 1).repeat(nB, 1, 1, nPixels)
-                tcoord[:, :, 1] = self.anchors[:, 3].contiguous().view(1, nA, 1, 1).repeat(nB, 1, 1, nPixels)
-            else:
-                tcoord[:, :, 0].fill_(0.5)
-                tcoord[:, :, 1].fill_(0.5)
+    Args:
+        boxes1 (torch.Tensor): List of bounding boxes
+        boxes2 (torch.Tensor): List of bounding boxes
 
-        # Anchors
-        if self.anchor_step == 4:
-            anchors = self.anchors.clone()
-            anchors[:, :2] = 0
-        else:
-            anchors = torch.cat([torch.zeros_like(self.anchors), self.anchors], 1)
+    Returns:
+        torch.Tensor[len(boxes1) X len(boxes2)]: IOU values
 
-        # Loop over GT
-        for b, gt_filtered in ground_truth.groupby('batch_number', sort=False):
-            cur_pred_boxes = pred_boxes[b*nAnchors:(b+1)*nAnchors]
+    Note:
+        Tensor format: [[xc, yc, w, h],...] |br|
+        You can also pass batches of lists of bounding boxes ``[..., N, 4]`` and ``[..., M, 4]``, which results in a ``[..., N, M]`` IOU tensor.
+    """
+    b1x1, b1y1 = (boxes1[..., :2] - (boxes1[..., 2:4] / 2)).unsqueeze(-2).unbind(-1)
+    b1x2, b1y2 = (boxes1[..., :2] + (boxes1[..., 2:4] / 2)).unsqueeze(-2).unbind(-1)
+    b2x1, b2y1 = (boxes2[..., :2] - (boxes2[..., 2:4] / 2)).unsqueeze(-3).unbind(-1)
+    b2x2, b2y2 = (boxes2[..., :2] + (boxes2[..., 2:4] / 2)).unsqueeze(-3).unbind(-1)
 
-            # Create ground_truth tensor
-            gt = torch.empty((gt_filtered.shape[0], 4), requires_grad=False)
-            gt[:, 2] = torch.from_numpy(gt_filtered.width.values).float() / self.stride
-            gt[:, 3] = torch.from_numpy(gt_filtered.height.values).float() / self.stride
-            gt[:, 0] = torch.from_numpy(gt_filtered.x_top_left.values).float() / self.stride + (gt[:, 2] / 2)
-            gt[:, 1] = torch.from_numpy(gt_filtered.y_top_left.values).float() / self.stride + (gt[:, 3] / 2)
+    dx = (b1x2.min(b2x2) - b1x1.max(b2x1)).clamp(min=0)
+    dy = (b1y2.min(b2y2) - b1y1.max(b2y1)).clamp(min=0)
+    intersections = dx * dy
 
-            # Set confidence mask of matching detections to 0
-            iou_gt_pred = bbox_ious(gt, cur_pred_boxes)
-            mask = (iou_gt_pred > self.thresh).sum(0) >= 1
-            conf_mask[b][mask.view_as(conf_mask[b])] = 0
+    areas1 = (b1x2 - b1x1) * (b1y2 - b1y1)
+    areas2 = (b2x2 - b2x1) * (b2y2 - b2y1)
+    unions = (areas1 + areas2) - intersections
 
-            # Find best anchor for each gt
-            iou_gt_anchors = bbox_wh_ious(gt, anchors)
-            _, best_anchors = iou_gt_anchors.max(1)
+    return intersections / unions
 
-            # Set masks and target values for each gt
-            nGT = gt.shape[0]
-            gi = gt[:, 0].clamp(0, nW-1).long()
-            gj = gt[:, 1].clamp(0, nH-1).long()
 
-            conf_mask[b, best_anchors, gj, gi] = self.object_scale
-            tconf[b, best_anchors, gj, gi] = iou_gt_pred.view(nGT, nA, nH, nW)[torch.arange(nGT), best_anchors, gj, gi]
-            coord_mask[b, best_anchors, gj, gi] = 2 - (gt[:, 2] * gt[:, 3]) / nPixels
-            tcoord[b, best_anchors, 0, gj, gi] = gt[:, 0] - gi.float()
-            tcoord[b, best_anchors, 1, gj, gi] = gt[:, 1] - gj.float()
-            tcoord[b, best_anchors, 2, gj, gi] = (gt[:, 2] / self.anchors[best_anchors, 0]).log()
-            tcoord[b, best_anchors, 3, gj, gi] = (gt[:, 3] / self.anchors[best_anchors, 1]).log()
-            cls_mask[b, best_anchors, gj, gi] = 1
-            tcls[b, best_anchors, gj, gi] = torch.from_numpy(gt_filtered.class_id.values).float()
+def bbox_max_ious(boxes1, boxes2, mask1=None, max_elements=2**20):
+    """ Compute the maximal IOU of each box from ``boxes2`` with any of the boxes from ``boxes1``. |br|
+    This gives the same result as ``bbox_ious(boxes1, boxes2).max(-2)``, but computes the IOU matrix in chunks of ``boxes2``,
+    so that the memory usage stays bounded for large numbers of boxes.
 
-            # Set masks of ignored to zero
-            if gt_filtered.ignore.any():
-                if torchversion >= version120:
-                    ignore_mask = torch.from_numpy(gt_filtered.ignore.values)
-                else:
-                    ignore_mask = torch.from_numpy(gt_filtered.ignore.values.astype(np.uint8))
-                gi = gi[ignore_mask]
-                gj = gj[ignore_mask]
-                best_anchors = best_anchors[ignore_mask]
+    Args:
+        boxes1 (torch.Tensor): List of bounding boxes [..., N, 4]
+        boxes2 (torch.Tensor): List of bounding boxes [..., M, 4]
+        mask1 (torch.Tensor, optional): Boolean mask [..., N] of the boxes in ``boxes1`` to consider; Default **all boxes**
+        max_elements (int, optional): Maximal number of elements of the intermediate IOU tensors; Default **2^20**
 
-                conf_mask[b, best_anchors, gj, gi] = 0
-                coord_mask[b, best_anchors, gj, gi] = 0
-                cls_mask[b, best_anchors, gj, gi] = 0
+    Returns:
+        torch.Tensor[..., M]: Maximal IOU values (zero if there are no boxes in ``boxes1``)
 
-        return (
-            coord_mask.view(nB, nA, 1, nPixels),
-            conf_mask.view(nB, nA, nPixels),
-            cls_mask.view(nB, nA, nPixels),
-            tcoord.view(nB, nA, 4, nPixels),
-            tconf.view(nB, nA, nPixels),
-            tcls.view(nB, nA, nPixels)
-        )
+    Note:
+        Tensor format: [[xc, yc, w, h],...]
+    """
+    num_boxes1 = boxes1.shape[-2]
+    max_iou = boxes2.new_zeros(boxes2.shape[:-1])
+    if num_boxes1 == 0:
+        return max_iou
 
+    chunk_size = max(1, max_elements // max(1, boxes1[..., 0].numel()))
+    for start in range(0, boxes2.shape[-2], chunk_size):
+        ious = bbox_ious(boxes1, boxes2[..., start:start+chunk_size, :])
+        if mask1 is not None:
+            ious.masked_fill_(~mask1[..., None], 0)
+        max_iou[..., start:start+chunk_size] = ious.max(-2)[0]
 
-def bbox_ious(boxes1, boxes2):
-    """ Compute IOU between all boxes from ``boxes1`` with all boxes from ``boxes2``.
+    return max_iou
+
+
+def bbox_pair_ious(boxes1, boxes2):
+    """ Compute IOU between each pair of boxes from ``boxes1`` and ``boxes2``.
 
     Args:
-        boxes1 (torch.Tensor): List of bounding boxes
-        boxes2 (torch.Tensor): List of bounding boxes
+        boxes1 (torch.Tensor): List of bounding boxes [..., 4]
+        boxes2 (torch.Tensor): List of bounding boxes with the same shape as ``boxes1``
 
     Returns:
-        torch.Tensor[len(boxes1) X len(boxes2)]: IOU values
+        torch.Tensor[...]: IOU values
 
     Note:
         Tensor format: [[xc, yc, w, h],...]
     """
-    b1x1, b1y1 = (boxes1[:, :2] - (boxes1[:, 2:4] / 2)).split(1, 1)
-    b1x2, b1y2 = (boxes1[:, :2] + (boxes1[:, 2:4] / 2)).split(1, 1)
-    b2x1, b2y1 = (boxes2[:, :2] - (boxes2[:, 2:4] / 2)).split(1, 1)
-    b2x2, b2y2 = (boxes2[:, :2] + (boxes2[:, 2:4] / 2)).split(1, 1)
+    b1x1, b1y1 = (boxes1[..., :2] - (boxes1[..., 2:4] / 2)).unbind(-1)
+    b1x2, b1y2 = (boxes1[..., :2] + (boxes1[..., 2:4] / 2)).unbind(-1)
+    b2x1, b2y1 = (boxes2[..., :2] - (boxes2[..., 2:4] / 2)).unbind(-1)
+    b2x2, b2y2 = (boxes2[..., :2] + (boxes2[..., 2:4] / 2)).unbind(-1)
 
-    dx = (b1x2.min(b2x2.t()) - b1x1.max(b2x1.t())).clamp(min=0)
-    dy = (b1y2.min(b2y2.t()) - b1y1.max(b2y1.t())).clamp(min=0)
+    dx = (b1x2.min(b2x2) - b1x1.max(b2x1)).clamp(min=0)
+    dy = (b1y2.min(b2y2) - b1y1.max(b2y1)).clamp(min=0)
     intersections = dx * dy
 
     areas1 = (b1x2 - b1x1) * (b1y2 - b1y1)
     areas2 = (b2x2 - b2x1) * (b2y2 - b2y1)
-    unions = (areas1 + areas2.t()) - intersections
+    unions = (areas1 + areas2) - intersections
 
     return intersections / unions
 
@@ -0,0 +1,79 @@
+#
+#   Lightnet loss utilities
+#   Copyright EAVISE
+#
+import collections
+import functools
+import torch
+
+__all__ = []
+
+
+def loss_precision(forward):
+    """ Decorator for the ``forward`` method of loss functions, which disables autocasting for the device of the network output. |br|
+    The loss functions then cast the output to at least fp32 themselves (see :func:`loss_dtype`),
+    so that the targets and numerically sensitive operations like ``log`` and ``exp`` are computed in full precision.
+    """
+    @functools.wraps(forward)
+    def wrapper(self, output, *args, **kwargs):
+        device = output[0].device if isinstance(output, (list, tuple)) else output.device
+        with torch.autocast(device.type, enabled=False):
+            return forward(self, output, *args, **kwargs)
+
+    return wrapper
+
+
+def loss_dtype(tensor):
+    """ Get the dtype in which to compute a loss, which is the dtype of the tensor, but at least fp32. """
+    return torch.promote_types(tensor.dtype, torch.float32)
+
+
+class BufferPool:
+    """ Pool of tensors that get refilled instead of reallocated every time they are requested. |br|
+    Loss functions use this to reuse their target tensors,
+    as these usually have the same shape for every batch of a certain input resolution.
+
+    Args:
+        max_shapes (int, optional): Maximum number of different shapes to keep per buffer name; Default **2**
+
+    Note:
+        The buffers are kept per name, shape, dtype and device.
+        When a buffer is requested with a new shape and there are already ``max_shapes`` buffers with that name,
+        the least recently used one gets discarded.
+        This bounds the retained memory when the input resolution changes (eg. multi-scale training).
+
+    Warning:
+        A buffer gets overwritten the next time it is requested,
+        so you should not hold on to returned tensors across calls.
+    """
+    def __init__(self, max_shapes=2):
+        self.max_shapes = max_shapes
+        self.buffers = collections.OrderedDict()
+
+    def full(self, name, shape, fill_value, dtype=torch.float, device=None):
+        """ Get a buffer filled with a certain value. """
+        key = (name, tuple(shape), dtype, torch.device(device if device is not None else 'cpu'))
+        buffer = self.buffers.pop(key, None)
+
+        if buffer is None:
+            buffer = torch.empty(shape, dtype=dtype, device=device)
+            same_name = [k for k in self.buffers if k[0] == name]
+            for k in same_name[:max(0, len(same_name) - self.max_shapes + 1)]:
+                del self.buffers[k]
+
+        self.buffers[key] = buffer
+        return buffer.fill_(fill_value)
+
+    def zeros(self, name, shape, dtype=torch.float, device=None):
+        """ Get a buffer filled with zeros. """
+        return self.full(name, shape, 0, dtype, device)
+
+    def clear(self):
+        """ Release all buffers. """
+        self.buffers.clear()
+
+    def __len__(self):
+        return len(self.buffers)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(max_shapes={self.max_shapes}, buffers={len(self)})'
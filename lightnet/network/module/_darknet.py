@@ -36,13 +36,36 @@ class Darknet(Lightnet):
             Darknet weight files also contain the number of images the network has been trained on. |br|
             In Lightnet however, this is a parameter from the loss function and as such this value cannot be correctly set on that object.
             This value will thus be ignored by lightnet and when saving a darknet file, this value will be set to zero.
+
+        Note:
+            Darknet weight files are memory-mapped and copied layer by layer into the network, so the file is never loaded in memory as a whole. |br|
+            Before copying anything, the number of weights in the file is compared with the layers of the network (see :func:`check_darknet_weights`).
+            By default, darknet files are allowed to contain weights for only the first layers of the network (eg. pretrained backbone weights),
+            but you can pass ``strict=True`` to require an exact match.
         """
         if os.path.splitext(weights_file)[1] == '.pt':
             log.debug('Loading weights from pytorch file')
             super().load(weights_file, *args, **kwargs)
         else:
             log.debug('Loading weights from darknet file')
-            self._load_darknet_weights(weights_file)
+            self._load_darknet_weights(weights_file, kwargs.get('strict', False))
+
+    def check_darknet_weights(self, weights_file, strict=False):
+        """ Check whether a darknet weight file fits this network, by only reading the header and the file size. |br|
+        The file fits if it ends on a layer boundary, which means that it contains the weights of the first N layers that can be loaded.
+
+        Args:
+            weights_file (str): path to file
+            strict (bool, optional): Require the file to contain exactly the number of weights of the network; Default **False**
+
+        Returns:
+            int: Number of layers in the file
+
+        Raises:
+            ValueError: If the number of weights does not match the network
+        """
+        with self._unfused(restore=True):
+            return WeightLoader(weights_file).check(self.named_layer_loop(), strict)
 
     def save(self, weights_file, *args, **kwargs):
         """ This function will save the weights to a file.
@@ -60,8 +83,13 @@ class Darknet(Lightnet):
             log.debug('Saving weights to darknet file')
             self._save_darknet_weights(weights_file)
 
-    def _load_darknet_weights(self, weights_file):
+    def _load_darknet_weights(self, weights_file, strict=False):
+        with self._unfused():
+            self.__load_darknet_weights(weights_file, strict)
+
+    def __load_darknet_weights(self, weights_file, strict):
         weights = WeightLoader(weights_file)
+        weights.check(self.named_layer_loop(), strict)
         self.header = weights.header
 
         done_loading = False
@@ -84,18 +112,21 @@ class Darknet(Lightnet):
     def _save_darknet_weights(self, weights_file):
         weights = WeightSaver(self.header, 0)
 
-        for name, module in self.named_layer_loop():
-            try:
-                weights.save_layer(module)
-                log.debug(f'Layer saved: {name}')
-            except NotImplementedError:
-                log.debug(f'Layer skipped: {name} [{module.__class__.__name__}]')
+        with self._unfused(restore=True):
+            for name, module in self.named_layer_loop():
+                try:
+                    weights.save_layer(module)
+                    log.debug(f'Layer saved: {name}')
+                except NotImplementedError:
+                    log.debug(f'Layer skipped: {name} [{module.__class__.__name__}]')
 
-        weights.write_file(weights_file)
+            weights.write_file(weights_file)
 
 
 class WeightLoader:
-    """ Load darknet weight files into pytorch layers """
+    """ Load darknet weight files into pytorch layers.
+    The weights are memory-mapped and copied directly from the file into each layer.
+    """
     def __init__(self, filename):
         with open(filename, 'rb') as fp:
             self.header = np.fromfile(fp, count=3, dtype=np.int32).tolist()
@@ -112,63 +143,94 @@ class WeightLoader:
                 log.error('New weight file syntax! Loading of weights might not work properly. Please submit an issue with the weight file version number. [Run with DEBUG logging level]')
                 self.seen = int(np.fromfile(fp, count=1, dtype=np.int64)[0])
 
-            self.buf = np.fromfile(fp, dtype=np.float32)
+            offset = fp.tell()
+            size = (os.fstat(fp.fileno()).st_size - offset) // 4
+
+        # Copy-on-write mapping, so that torch.from_numpy gets a writeable array without copying the file
+        if size > 0:
+            self.buf = np.memmap(filename, dtype=np.float32, mode='c', offset=offset, shape=(size,))
+        else:
+            self.buf = np.empty(0, dtype=np.float32)
 
         self.start = 0
-        self.size = self.buf.size
+        self.size = size
+
+    @staticmethod
+    def layer_size(layer):
+        """ Number of weights a layer takes from the weights file """
+        if type(layer) is nn.Conv2d:
+            return layer.bias.numel() + layer.weight.numel()
+        elif type(layer) is Conv2dBatchReLU:
+            return 4 * layer.layers[1].bias.numel() + layer.layers[0].weight.numel()
+        elif type(layer) is nn.Linear:
+            return layer.bias.numel() + layer.weight.numel()
+        else:
+            raise NotImplementedError(f'The layer you are trying to load is not supported [{type(layer)}]')
+
+    def check(self, layers, strict=False):
+        """ Check that the remaining weights end on a layer boundary, without reading them.
+
+        Args:
+            layers (iterable): (name, layer) tuples that will be loaded
+            strict (bool, optional): Require the weights to exactly match all layers; Default **False**
+
+        Returns:
+            int: Number of layers that will be loaded
+        """
+        available = self.size - self.start
+        total, count, boundary = 0, 0, None
+        for name, layer in layers:
+            try:
+                total += self.layer_size(layer)
+            except NotImplementedError:
+                continue
+
+            if total <= available:
+                count += 1
+            elif boundary is None:
+                boundary = total - self.layer_size(layer)
+                if available != boundary:
+                    raise ValueError(f'Weight file does not end on a layer boundary, it stops in layer {name} [{available}/{total} weights]')
+
+        if strict and available != total:
+            raise ValueError(f'Number of weights in the file does not match the network [{available}/{total} weights]')
+        elif available > total:
+            log.warning(f'Weight file contains more weights than the network, the remaining weights will be ignored [{available}/{total} weights]')
+
+        return count
 
     def load_layer(self, layer):
         """ Load weights for a layer from the weights file """
-        if type(layer) == nn.Conv2d:
+        if type(layer) is nn.Conv2d:
             self._load_conv(layer)
-        elif type(layer) == Conv2dBatchReLU:
+        elif type(layer) is Conv2dBatchReLU:
             self._load_convbatch(layer)
-        elif type(layer) == nn.Linear:
+        elif type(layer) is nn.Linear:
             self._load_fc(layer)
         else:
             raise NotImplementedError(f'The layer you are trying to load is not supported [{type(layer)}]')
 
-    def _load_conv(self, model):
-        num_b = model.bias.numel()
-        model.bias.data.copy_(torch.from_numpy(self.buf[self.start:self.start+num_b])
-                                   .view_as(model.bias.data))
-        self.start += num_b
+    def _read(self, tensor):
+        """ Copy the next weights from the file into a tensor """
+        num = tensor.numel()
+        with torch.no_grad():
+            tensor.copy_(torch.from_numpy(self.buf[self.start:self.start+num]).view_as(tensor))
+        self.start += num
 
-        num_w = model.weight.numel()
-        model.weight.data.copy_(torch.from_numpy(self.buf[self.start:self.start+num_w])
-                                     .view_as(model.weight.data))
-        self.start += num_w
+    def _load_conv(self, model):
+        self._read(model.bias)
+        self._read(model.weight)
 
     def _load_convbatch(self, model):
-        num_b = model.layers[1].bias.numel()
-        model.layers[1].bias.data.copy_(torch.from_numpy(self.buf[self.start:self.start+num_b])
-                                             .view_as(model.layers[1].bias.data))
-        self.start += num_b
-        model.layers[1].weight.data.copy_(torch.from_numpy(self.buf[self.start:self.start+num_b])
-                                               .view_as(model.layers[1].weight.data))
-        self.start += num_b
-        model.layers[1].running_mean.copy_(torch.from_numpy(self.buf[self.start:self.start+num_b])
-                                                .view_as(model.layers[1].running_mean))
-        self.start += num_b
-        model.layers[1].running_var.copy_(torch.from_numpy(self.buf[self.start:self.start+num_b])
-                                               .view_as(model.layers[1].running_var))
-        self.start += num_b
-
-        num_w = model.layers[0].weight.numel()
-        model.layers[0].weight.data.copy_(torch.from_numpy(self.buf[self.start:self.start+num_w])
-                                               .view_as(model.layers[0].weight.data))
-        self.start += num_w
+        self._read(model.layers[1].bias)
+        self._read(model.layers[1].weight)
+        self._read(model.layers[1].running_mean)
+        self._read(model.layers[1].running_var)
+        self._read(model.layers[0].weight)
 
     def _load_fc(self, model):
-        num_b = model.bias.numel()
-        model.bias.data.copy_(torch.from_numpy(self.buf[self.start:self.start+num_b])
-                                   .view_as(model.bias.data))
-        self.start += num_b
-
-        num_w = model.weight.numel()
-        model.weight.data.copy_(torch.from_numpy(self.buf[self.start:self.start+num_w])
-                                     .view_as(model.weight.data))
-        self.start += num_w
+        self._read(model.bias)
+        self._read(model.weight)
 
 
 class WeightSaver:
@@ -197,11 +259,11 @@ class WeightSaver:
 
     def save_layer(self, layer):
         """ save weights for a layer """
-        if type(layer) == nn.Conv2d:
+        if type(layer) is nn.Conv2d:
             self._save_conv(layer)
-        elif type(layer) == Conv2dBatchReLU:
+        elif type(layer) is Conv2dBatchReLU:
             self._save_convbatch(layer)
-        elif type(layer) == nn.Linear:
+        elif type(layer) is nn.Linear:
             self._save_fc(layer)
         else:
             raise NotImplementedError(f'The layer you are trying to save is not supported [{type(layer)}]')
@@ -3,8 +3,10 @@
 #   Copyright EAVISE
 #
 
+import contextlib
 import inspect
 import logging
+import os
 import re
 from collections import OrderedDict
 import torch
@@ -24,6 +26,7 @@ class Lightnet(nn.Module):
     def __init__(self):
         super().__init__()
         self.layers = None
+        self._fused_layers = []
 
     def forward(self, x):
         log.debug('Running default forward function')
@@ -76,7 +79,217 @@ class Lightnet(nn.Module):
             else:
                 yield name, module
 
-    def load(self, weights_file, remap=None, strict=True):
+    @property
+    def fused(self):
+        """ Whether the batchnorm layers of this network are folded into their convolutions (see :func:`~lightnet.network.module.Lightnet.fuse`). """
+        return len(getattr(self, '_fused_layers', [])) > 0
+
+    def fuse(self):
+        """ Fold every :class:`~torch.nn.BatchNorm2d` that directly follows a :class:`~torch.nn.Conv2d` into the weights and bias of that convolution. |br|
+        In evaluation mode, a batchnorm is a fixed affine transformation per channel, which can be merged into the preceding convolution.
+        This removes the batchnorm computations and thus speeds up inference.
+
+        This function looks for (Conv2d, BatchNorm2d) pairs in every :class:`~torch.nn.Sequential` of the network
+        (eg. in :class:`~lightnet.network.layer.Conv2dBatchReLU`, :class:`~lightnet.network.layer.Conv2dDepthWise` or :class:`~lightnet.network.layer.InvertedBottleneck`)
+        and replaces the batchnorm with an :class:`~torch.nn.Identity`.
+
+        Returns:
+            Lightnet: self
+
+        Note:
+            The :func:`~lightnet.network.module.Lightnet.save` and :func:`~lightnet.network.module.Lightnet.load` functions of fused networks
+            temporarily unfuse the network, so that the weight files stay compatible with unfused networks.
+            The ``state_dict()`` of a fused network however does not contain any batchnorm parameters.
+
+        Note:
+            The original convolution parameters are kept in memory, so that unfusing can restore them exactly.
+
+        Warning:
+            Fusing uses the running statistics of the batchnorm layers and is thus only meant for inference.
+            You should :func:`~lightnet.network.module.Lightnet.unfuse` the network before training it again.
+
+        Example:
+            >>> net = ln.models.TinyYoloV2(20).eval()
+            >>> in_tensor = torch.rand(1, 3, 416, 416)
+            >>> out_tensor = net(in_tensor)
+            >>> _ = net.fuse()
+            >>> net.fused
+            True
+            >>> torch.allclose(out_tensor, net(in_tensor), atol=1e-4)
+            True
+            >>> _ = net.unfuse()
+        """
+        if self.fused:
+            return self
+        if self.training:
+            log.warning('Fusing batchnorm layers of a network in training mode, the fused network should only be used for inference')
+
+        fused = []
+        for module in self.modules():
+            if not isinstance(module, nn.Sequential):
+                continue
+
+            for idx in range(1, len(module)):
+                conv, bn = module[idx-1], module[idx]
+                if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d) and bn.track_running_stats:
+                    fused.append(_fuse_conv_bn(module, idx))
+
+        self._fused_layers = fused
+        log.debug(f'Fused {len(fused)} batchnorm layers')
+        return self
+
+    def unfuse(self):
+        """ Restore the batchnorm layers that were folded with :func:`~lightnet.network.module.Lightnet.fuse`. |br|
+        The convolutions get back their exact original parameters and the batchnorm layers are converted to the current device and dtype of the network.
+
+        Returns:
+            Lightnet: self
+
+        Note:
+            Any modification to the weights of the fused convolutions is discarded.
+        """
+        for record in reversed(getattr(self, '_fused_layers', [])):
+            _unfuse_conv_bn(*record)
+        self._fused_layers = []
+        return self
+
+    @contextlib.contextmanager
+    def _unfused(self, restore=False):
+        """ Context manager that temporarily unfuses the network.
+
+        Args:
+            restore (bool, optional): Restore the exact fused weights afterwards, instead of fusing again (use this if the weights are not modified); Default **False**
+        """
+        if not self.fused:
+            yield
+            return
+
+        fused = [(seq[idx-1].weight.detach().clone(), seq[idx-1].bias.detach().clone()) for seq, idx, *_ in self._fused_layers] if restore else None
+        self.unfuse()
+        try:
+            yield
+        finally:
+            self.fuse()
+            if fused is not None:
+                with torch.no_grad():
+                    for (seq, idx, *_), (weight, bias) in zip(self._fused_layers, fused):
+                        seq[idx-1].weight.copy_(weight)
+                        seq[idx-1].bias.copy_(bias)
+
+    @property
+    def channels_last(self):
+        """ Whether this network runs in the :attr:`torch.channels_last` memory format (see :func:`~lightnet.network.module.Lightnet.to_channels_last`). """
+        return getattr(self, '_channels_last_hook', None) is not None
+
+    def to_channels_last(self, example=None, strict=False):
+        """ Run this network in the :attr:`torch.channels_last` (NHWC) memory format. |br|
+        This function converts the weights of the network to channels_last
+        and makes sure every input of the network gets converted as well, before running the forward pass.
+        The convolutions then use NHWC kernels, which are usually faster on GPUs with tensor cores and on modern CPUs.
+
+        If you pass an example input, this function also checks that every layer keeps its output in channels_last
+        and logs the layers that fall back to the contiguous (NCHW) memory format.
+
+        Args:
+            example (torch.Tensor, optional): Example input to check the memory format of the layer outputs; Default **None**
+            strict (bool, optional): Raise an error instead of logging a warning if some layers fall back to NCHW; Default **False**
+
+        Returns:
+            Lightnet: self
+
+        Raises:
+            RuntimeError: If strict is **True** and some layers fall back to NCHW
+
+        Note:
+            The :class:`~lightnet.data.transform.GetDarknetBoxes` post-processing and the :class:`~lightnet.network.loss.RegionLoss`
+            directly work on channels_last output tensors, without converting them back to NCHW.
+
+        Example:
+            >>> net = ln.models.YoloV2(20).eval()
+            >>> _ = net.to_channels_last(torch.rand(1, 3, 416, 416), strict=True)
+            >>> net.channels_last
+            True
+            >>> out_tensor = net(torch.rand(1, 3, 416, 416))
+            >>> out_tensor.is_contiguous(memory_format=torch.channels_last)
+            True
+            >>> _ = net.to_contiguous_format()
+        """
+        self.to(memory_format=torch.channels_last)
+        if not self.channels_last:
+            self._channels_last_hook = self.register_forward_pre_hook(_channels_last_input)
+
+        if example is not None:
+            offenders = self.channels_last_offenders(example)
+            if len(offenders):
+                msg = f'The following layers do not keep their output in channels_last format: {", ".join(offenders)}'
+                if strict:
+                    raise RuntimeError(msg)
+                log.warning(msg)
+
+        return self
+
+    def to_contiguous_format(self):
+        """ Undo :func:`~lightnet.network.module.Lightnet.to_channels_last`.
+
+        Returns:
+            Lightnet: self
+        """
+        self.to(memory_format=torch.contiguous_format)
+        if self.channels_last:
+            self._channels_last_hook.remove()
+            self._channels_last_hook = None
+
+        return self
+
+    def channels_last_offenders(self, example):
+        """ Run an example input through the network and find the layers that convert channels_last input back to the contiguous (NCHW) memory format.
+
+        Args:
+            example (torch.Tensor): Example input
+
+        Returns:
+            list: Names and types of the offending layers (only the innermost module is reported, not the containers around it)
+
+        Note:
+            Layers that get input tensors which are both channels_last and contiguous (eg. feature maps of 1x1 pixels),
+            are allowed to return contiguous output, as it is impossible to know which memory format to use.
+            Use a sufficiently large example input to get a meaningful result.
+        """
+        offenders, excused = [], []
+
+        def check(name, module, inputs, outputs):
+            inputs = [t for t in _flatten(inputs) if t.dim() == 4]
+            outputs = [t for t in _flatten(outputs) if t.dim() == 4]
+            if len(inputs) == 0 or all(t.is_contiguous(memory_format=torch.channels_last) for t in outputs):
+                return
+
+            if all(t.is_contiguous(memory_format=torch.channels_last) and not t.is_contiguous() for t in inputs):
+                offenders.append((name, module))
+            elif all(t.is_contiguous(memory_format=torch.channels_last) for t in inputs):
+                excused.append(name)
+
+        handles = [
+            module.register_forward_hook(lambda m, i, o, name=name: check(name, m, i, o))
+            for name, module in self.named_modules() if module is not self
+        ]
+        training = self.training
+        try:
+            self.eval()
+            with torch.no_grad():
+                self(example.to(memory_format=torch.channels_last))
+        finally:
+            self.train(training)
+            for handle in handles:
+                handle.remove()
+
+        # Only keep the innermost modules and skip containers of layers that got ambiguous input
+        names = [name for name, _ in offenders] + excused
+        return [
+            f'{name} ({type(module).__name__})' for name, module in offenders
+            if not any(other.startswith(name + '.') for other in names)
+        ]
+
+    def load(self, weights_file, remap=None, strict=True, mmap=True, assign=False):
         """ This function will load the weights from a file.
         It also allows to load in a weights file with only a part of the weights in.
 
@@ -84,27 +297,45 @@ class Lightnet(nn.Module):
             weights_file (str): path to file
             remap (callable or list, optional): Remapping of the weights, see :func:`~lightnet.network.module.Lightnet.weight_remapping`; Default **None**
             strict (Boolean, optional): Whether the weight file should contain all layers of the model; Default **True**
+            mmap (Boolean, optional): Memory-map the file instead of reading it in memory first; Default **True**
+            assign (Boolean, optional): Use the (memory-mapped) tensors of the file as parameters, instead of copying them into the existing parameters; Default **False**
 
         Note:
             This function will load the weights to CPU,
             so you should use ``network.to(device)`` afterwards to send it to the device of your choice.
+
+        Note:
+            With ``mmap``, the tensors are only read from disk when they get copied into the network,
+            so loading does not need memory for a second copy of the weights.
+            Remapping only changes the keys of the state dictionary and thus does not read any data either. |br|
+            Files saved with the legacy (non-zip) serialization of PyTorch cannot be memory-mapped and are read normally.
+
+            With ``assign``, the parameters are not even copied and the pages of the file are only read when they are first used,
+            which makes loading almost instantaneous and allows multiple processes to share the same weights in the page cache.
+            This only happens if the network is on the CPU, is not in channels_last mode and the data types of the file match the network;
+            otherwise the weights are copied.
+
+        Warning:
+            When using ``mmap`` together with ``assign``, the parameters of the network are backed by the weights file.
+            Do not overwrite that file while the network is in use (eg. by saving to the same path), as this can crash your program.
         """
-        keys = self.state_dict().keys()
+        with self._unfused():
+            keys = self.state_dict().keys()
+            state = _load_state(weights_file, mmap)
 
-        if remap is not None:
-            state = self.weight_remapping(torch.load(weights_file, 'cpu'), remap)
-            remap = ' remapped'
-        else:
-            state = torch.load(weights_file, 'cpu')
-            remap = ''
+            if remap is not None:
+                state = self.weight_remapping(state, remap)
+                remap = ' remapped'
+            else:
+                remap = ''
 
-        log.info(f'Loading{remap} weights from file [{weights_file}]')
-        if not strict and state.keys() != keys:
-            log.warning('Modules not matching, performing partial update')
+            log.info(f'Loading{remap} weights from file [{weights_file}]')
+            if not strict and state.keys() != keys:
+                log.warning('Modules not matching, performing partial update')
 
-        self.load_state_dict(state, strict=strict)
+            self.load_state_dict(state, strict=strict, assign=assign and self._can_assign(state))
 
-    def load_pruned(self, weights_file, strict=True):
+    def load_pruned(self, weights_file, strict=True, mmap=True, assign=False):
         """ This function will load pruned weights from a file.
         It also allows to load a weights file,
         which contains less channels in a convolution than orginally defined in the network.
@@ -112,14 +343,19 @@ class Lightnet(nn.Module):
         Args:
             weights_file (str): path to file
             strict (Boolean, optional): Whether the weight file should contain all layers of the model; Default **True**
+            mmap (Boolean, optional): Memory-map the file instead of reading it in memory first; Default **True**
+            assign (Boolean, optional): Use the (memory-mapped) tensors of the file as parameters, instead of copying them; Default **False**
 
         Note:
             This function will load the weights to CPU,
             so you should use ``network.to(device)`` afterwards to send it to the device of your choice.
         """
+        if self.fused:
+            raise RuntimeError('Cannot load pruned weights in a fused network, unfuse it first')
+
         keys = set(self.state_dict().keys())
         log.info(f'Loading pruned weights from file [{weights_file}]')
-        state = torch.load(weights_file, 'cpu')
+        state = _load_state(weights_file, mmap)
 
         # Prune tensors
         for key, val in state.items():
@@ -158,24 +394,47 @@ class Lightnet(nn.Module):
         # Load weights
         if not strict and state.keys() != keys:
             log.warning('Modules not matching, performing partial update')
-        self.load_state_dict(state, strict=strict)
+        self.load_state_dict(state, strict=strict, assign=assign and self._can_assign(state))
 
-    def save(self, weights_file, remap=None):
+    def _can_assign(self, state):
+        """ Check whether the tensors of a state dictionary can replace the parameters and buffers without changing the network. """
+        if self.channels_last:
+            log.debug('Not assigning weights, because the network is in channels_last mode')
+            return False
+
+        for key, value in self.state_dict().items():
+            if value.device.type != 'cpu':
+                log.debug('Not assigning weights, because the network is not on the CPU')
+                return False
+            if key in state and state[key].dtype != value.dtype:
+                log.debug(f'Not assigning weights, because the data type of [{key}] does not match [{state[key].dtype}/{value.dtype}]')
+                return False
+
+        return True
+
+    def save(self, weights_file, remap=None, checkpointer=None):
         """ This function will save the weights to a file.
 
         Args:
             weights_file (str): path to file
             remap (callable or list, optional): Remapping of the weights, see :func:`~lightnet.network.module.Lightnet.weight_remapping`; Default **None**
+            checkpointer (lightnet.engine.AsyncCheckpointer, optional): Write the file in the background with this checkpointer; Default **None**
         """
-        if remap is not None:
-            state = self.weight_remapping(self.state_dict(), remap)
-            remap = ' remapped'
-        else:
-            state = self.state_dict()
-            remap = ''
+        # Fusing modifies the weights in place, so we save before refusing
+        with self._unfused(restore=True):
+            if remap is not None:
+                state = self.weight_remapping(self.state_dict(), remap)
+                remap = ' remapped'
+            else:
+                state = self.state_dict()
+                remap = ''
 
-        torch.save(state, weights_file)
-        log.info(f'Saved{remap} weights as {weights_file}')
+            if checkpointer is not None:
+                checkpointer.save(state, weights_file)
+                log.info(f'Saving{remap} weights as {weights_file} in the background')
+            else:
+                torch.save(state, weights_file)
+                log.info(f'Saved{remap} weights as {weights_file}')
 
     def __str__(self):
         """ Shorter version than default PyTorch one. """
@@ -234,3 +493,64 @@ class Lightnet(nn.Module):
                         break
 
         return new_weights
+
+
+def _fuse_conv_bn(sequential, idx):
+    """ Fold the batchnorm at ``sequential[idx]`` in the convolution before it and return the information needed to unfold it. """
+    conv, bn = sequential[idx-1], sequential[idx]
+
+    # Keep the original parameters, so that unfusing restores them exactly instead of recomputing them
+    bias = conv.bias.detach().clone() if conv.bias is not None else None
+    weight = conv.weight.detach().clone()
+
+    with torch.no_grad():
+        scale = bn.weight / torch.sqrt(bn.running_var + bn.eps) if bn.affine else torch.rsqrt(bn.running_var + bn.eps)
+        shift = bn.bias if bn.affine else torch.zeros_like(scale)
+
+        conv_bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+        conv.bias = nn.Parameter((conv_bias - bn.running_mean) * scale + shift)
+        conv.weight.mul_(scale.reshape(-1, 1, 1, 1))
+
+    sequential[idx] = nn.Identity()
+    return sequential, idx, bn, bias, weight
+
+
+def _unfuse_conv_bn(sequential, idx, bn, bias, weight):
+    """ Unfold a batchnorm that was folded with :func:`_fuse_conv_bn`. |br|
+    The stored modules are not registered in the network, so we convert them to the current device and dtype of the convolution.
+    """
+    conv = sequential[idx-1]
+    device, dtype = conv.weight.device, conv.weight.dtype
+
+    with torch.no_grad():
+        conv.weight.copy_(weight)
+    conv.bias = nn.Parameter(bias.to(device=device, dtype=dtype)) if bias is not None else None
+    sequential[idx] = bn.to(device=device, dtype=dtype)
+
+
+def _load_state(weights_file, mmap):
+    """ Load a state dictionary on the CPU, memory-mapping the file if possible. """
+    if mmap and isinstance(weights_file, (str, os.PathLike)):
+        try:
+            return torch.load(weights_file, 'cpu', mmap=True)
+        except RuntimeError as err:
+            log.debug(f'Could not memory-map weights file, loading it normally: {err}')
+
+    return torch.load(weights_file, 'cpu')
+
+
+def _channels_last_input(module, args):
+    """ Forward pre-hook that converts 4D input tensors to the channels_last memory format. """
+    return tuple(a.contiguous(memory_format=torch.channels_last) if isinstance(a, torch.Tensor) and a.dim() == 4 else a for a in args)
+
+
+def _flatten(x):
+    """ Yield all tensors in a (nested) structure of lists, tuples and dicts. """
+    if isinstance(x, torch.Tensor):
+        yield x
+    elif isinstance(x, dict):
+        for v in x.values():
+            yield from _flatten(v)
+    elif isinstance(x, (list, tuple)):
+        for v in x:
+            yield from _flatten(v)
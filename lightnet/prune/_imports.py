@@ -2,15 +2,15 @@
 #   Lightnet optional dependencies
 #   Copyright EAVISE
 #
+#   The dependencies are only imported when they are first used, which keeps ``import lightnet`` fast.
+#
 import logging
+from .._lazy import lazy_import
 
 __all__ = ['onnx', 'onnx_numpy_helper']
 log = logging.getLogger(__name__)
 
-try:
-    import onnx
-    from onnx import numpy_helper as onnx_numpy_helper
-except ModuleNotFoundError:
+onnx = lazy_import('onnx')
+onnx_numpy_helper = lazy_import('onnx.numpy_helper')
+if onnx is None:
     log.warning('onnx is not installed and thus no pruning functionality will work')
-    onnx = None
-    onnx_numpy_helper = None
@@ -2,7 +2,7 @@
 #   Combine multiple pruners
 #   Copyright EAVISE
 #
-import collections
+import collections.abc
 import logging
 
 __all__ = ['MultiPruner']
@@ -11,7 +11,7 @@ log = logging.getLogger(__name__)
 
 def flatten(x):
     """ Only works with lists of non-iterable data (eg. not strings) """
-    if isinstance(x, collections.Iterable):
+    if isinstance(x, collections.abc.Iterable):
         return [a for i in x for a in flatten(i)]
     else:
         return [x]
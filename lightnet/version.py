@@ -0,0 +1,5 @@
+#
+#   Lightnet version: Automatically generated version file
+#
+
+__version__ = "2.0.1"
@@ -0,0 +1,118 @@
+#
+#   Test lightnet datasets and dataloading
+#   Copyright EAVISE
+#
+
+import pytest
+import numpy as np
+from PIL import Image
+import torch
+import pandas as pd
+import brambox as bb
+import lightnet as ln
+import lightnet.data.transform as tf
+
+
+@pytest.fixture(scope='module')
+def image_folder(tmp_path_factory):
+    folder = tmp_path_factory.mktemp('images')
+    for i in range(6):
+        img = np.random.randint(256, size=(60 + 10*i, 80, 3), dtype='uint8')
+        Image.fromarray(img).save(folder / f'{i}.png')
+
+    annos = bb.util.from_dict({
+        'image': [str(i) for i in range(6)],
+        'class_label': ['a', 'b'] * 3,
+        'x_top_left': [10.0] * 6,
+        'y_top_left': [5.0] * 6,
+        'width': [20.0] * 6,
+        'height': [30.0] * 6,
+        'occluded': [0.0] * 6,
+        'truncated': [0.0] * 6,
+        'lost': [False] * 6,
+        'difficult': [False] * 6,
+        'ignore': [False] * 6,
+    })
+
+    return folder, annos
+
+
+def create_dataset(image_folder, io_workers):
+    folder, annos = image_folder
+    lb = tf.Letterbox(dimension=(64, 64))
+    dataset = ln.models.BramboxDataset(
+        annos.copy(),
+        input_dimension=(64, 64),
+        class_label_map=['a', 'b'],
+        identify=lambda name: str(folder / f'{name}.png'),
+        transform=tf.Compose([lb, tf.AnnoTransform(lambda a: a)]),
+        io_workers=io_workers,
+    )
+    lb.dataset = dataset
+    return dataset
+
+
+def test_getitems_threaded(image_folder):
+    sequential = create_dataset(image_folder, 0)
+    threaded = create_dataset(image_folder, 3)
+
+    indices = [((64, 64), i) for i in range(len(threaded))]
+    for (img_s, anno_s), (img_t, anno_t) in zip(sequential.__getitems__(indices), threaded.__getitems__(indices)):
+        np.testing.assert_array_equal(np.asarray(img_s), np.asarray(img_t))
+        pd.testing.assert_frame_equal(anno_s, anno_t)
+
+    with pytest.raises(IndexError):
+        threaded.__getitems__([0, len(threaded)])
+
+
+def test_getitems_dataloader(image_folder):
+    dataset = create_dataset(image_folder, 2)
+    dataset.transform.append(lambda img: torch.from_numpy(np.array(img)))
+    loader = ln.data.DataLoader(dataset, batch_size=3, collate_fn=ln.data.brambox_collate)
+
+    loader.change_input_dim(32, None)
+    for img, anno in loader:
+        assert img.shape == (3, 32, 32, 3)
+        assert anno.batch_number.max() <= 2
+
+
+def test_compose_profiling(image_folder):
+    dataset = create_dataset(image_folder, 0)
+    dataset.transform.append(lambda img: torch.from_numpy(np.array(img)))
+    dataset.transform.start_profiling(num_workers=2)
+    loader = ln.data.DataLoader(dataset, batch_size=2, num_workers=2, collate_fn=ln.data.brambox_collate)
+
+    for _ in loader:
+        pass
+
+    stats = dataset.transform.profiling_stats()
+    assert list(stats.keys()) == ['letterbox', 'annotransform', '<lambda>']
+    assert stats['letterbox']['calls'] == len(dataset)
+    assert stats['letterbox']['time'] > 0
+
+    workers = dataset.transform.profiling_stats(per_worker=True)
+    assert len(workers) == 3
+    assert workers[0]['letterbox']['calls'] == 0
+    assert workers[1]['letterbox']['calls'] + workers[2]['letterbox']['calls'] == len(dataset)
+
+    dataset.transform.reset_profiling()
+    assert dataset.transform.profiling_stats()['letterbox']['calls'] == 0
+    dataset.transform.stop_profiling()
+    assert dataset.transform.profiling_stats() == {}
+
+
+def test_compose_profiling_modified():
+    pipeline = ln.data.transform.Compose([lambda x: x + 1])
+    pipeline.start_profiling()
+    assert pipeline(1) == 2
+
+    # Changed pipeline disables profiling, until it is restarted
+    pipeline.append(lambda x: x * 2)
+    assert pipeline(1) == 4
+    pipeline.insert(0, lambda x: x - 1)
+    assert pipeline(1) == 2
+    assert pipeline.profiling_stats()['<lambda>']['calls'] == 1
+
+    pipeline.start_profiling()
+    assert pipeline(1) == 2
+    assert pipeline.profiling_stats()['<lambda>']['calls'] == 3
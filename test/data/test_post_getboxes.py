@@ -66,3 +66,31 @@ def test_getboxes_cuda(data, images, classes):
     assert (set(out[:, 0].unique().tolist()) <= set(range(images)))     # batch_num should be between 0-num_images
     assert (out[:, 5] > 0.5).all()                                      # confidence should be bigger than threshold
     assert (set(out[:, 6].unique().tolist()) <= set(range(classes)))    # class_id should be between 0-num_classes
+
+
+def test_getboxes_autocast():
+    network = ln.models.TinyYoloV2(20).eval()
+    post = ln.data.transform.GetDarknetBoxes(0.0, network.stride, network.anchors)
+    input_tensor = torch.rand(1, 3, 416, 416)
+
+    with torch.no_grad():
+        output = network(input_tensor)
+        boxes_fp32 = post(output.clone())
+        boxes_bf16 = post(output.bfloat16())
+        with torch.autocast('cpu', dtype=torch.bfloat16):
+            boxes_autocast = post(network(input_tensor))
+
+    assert boxes_bf16.dtype == torch.float32
+    assert boxes_autocast.dtype == torch.float32
+    torch.testing.assert_close(boxes_bf16[:, :5], boxes_fp32[:, :5], rtol=0.01, atol=0.5)
+    assert boxes_autocast.shape == boxes_fp32.shape
+
+
+def test_getboxes_channels_last():
+    network = ln.models.YoloV2(20)
+    post = ln.data.transform.GetDarknetBoxes(0.1, network.stride, network.anchors)
+    output = torch.randn(4, 125, 13, 13)
+
+    boxes = post(output.clone())
+    boxes_nhwc = post(output.to(memory_format=torch.channels_last))
+    torch.testing.assert_close(boxes_nhwc, boxes, rtol=1e-5, atol=1e-4)      # NHWC kernels round differently
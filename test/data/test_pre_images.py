@@ -159,6 +159,32 @@ def test_letterbox(image, grayscale):
     assert_image_content_equal(tf_np, None, tf_torch, np.testing.assert_allclose, atol=2)
 
 
+@pytest.mark.parametrize('grayscale', [True, False])
+def test_letterbox_out(image, grayscale):
+    img_np, img_pil, img_torch = image(400, 385, grayscale)
+    lb = tf.Letterbox(dimension=(250, 300), fill_color=50)
+    tf_np = lb(img_np)
+    tf_torch = lb(img_torch)
+
+    # Write in preallocated buffers
+    out_np = np.zeros((2, 300, 250) + img_np.shape[2:], dtype=img_np.dtype)
+    lb.out = out_np[1]
+    assert np.shares_memory(lb(img_np), out_np[1])
+    assert lb.out is None
+    np.testing.assert_array_equal(out_np[1], tf_np)
+
+    out_torch = torch.zeros((2, img_torch.shape[0], 300, 250))
+    lb.out = out_torch[1]
+    assert lb(img_torch).data_ptr() == out_torch[1].data_ptr()
+    assert lb.out is None
+    torch.testing.assert_close(out_torch[1], tf_torch)
+
+    # Wrong buffer
+    lb.out = np.zeros((300, 300) + img_np.shape[2:], dtype=img_np.dtype)
+    with pytest.raises(ValueError):
+        lb(img_np)
+
+
 @pytest.mark.parametrize('grayscale', [True, False])
 def test_pad(image, grayscale):
     img_np, img_pil, img_torch = image(400, 385, grayscale)
@@ -0,0 +1,281 @@
+#
+#   Test lightnet engine
+#   Copyright EAVISE
+#
+import pytest
+import torch
+import lightnet as ln
+
+
+class AmpEngine(ln.engine.Engine):
+    def start(self):
+        self.dtypes = []
+        self.steps = []
+
+    def process_batch(self, data):
+        output = self.network(data)
+        self.dtypes.append(output.dtype)
+        loss = output.float().mean() * self.loss_factor / self.batch_subdivisions
+        self.backward(loss)
+
+    def train_batch(self):
+        self.steps.append(self.step(self.optim))
+        self.optim.zero_grad()
+
+    def quit(self):
+        return self.batch >= 2
+
+
+def create_engine(**kwargs):
+    network = torch.nn.Linear(4, 2)
+    params = ln.engine.HyperParameters(
+        network=network,
+        optim=torch.optim.SGD(network.parameters(), lr=0.1),
+        batch_size=4,
+        mini_batch_size=2,
+        **kwargs,
+    )
+    return AmpEngine(params, [torch.rand(2, 4) for _ in range(4)], loss_factor=1)
+
+
+def test_engine_no_amp():
+    engine = create_engine()
+    engine()
+    assert engine.mixed_precision is False
+    assert engine.dtypes == [torch.float] * 4
+    assert engine.steps == [True, True]
+    assert engine.loss_scale == 1.0
+
+
+@pytest.mark.parametrize('dtype', [torch.bfloat16, torch.float16])
+def test_engine_amp(dtype):
+    engine = create_engine(mixed_precision=True, amp_dtype=dtype)
+    weight = engine.network.weight.detach().clone()
+    engine()
+
+    assert engine.dtypes == [dtype] * 4
+    assert engine.steps == [True, True]
+    assert engine.network.weight.dtype == torch.float
+    assert not torch.equal(weight, engine.network.weight)
+    assert engine.grad_scaler.is_enabled() == (dtype == torch.float16)
+    if dtype == torch.float16:
+        assert engine.loss_scale == 2.0 ** 16
+
+
+def test_engine_amp_overflow():
+    engine = create_engine(mixed_precision=True, amp_dtype=torch.float16)
+    engine.loss_factor = float('inf')
+    weight = engine.network.weight.detach().clone()
+    engine()
+
+    assert engine.steps == [False, False]
+    assert torch.equal(weight, engine.network.weight)
+    assert engine.loss_scale == 2.0 ** 14
+
+
+class IndexSet(ln.data.Dataset):
+    def __len__(self):
+        return 8
+
+    @ln.data.Dataset.resize_getitem
+    def __getitem__(self, index):
+        return torch.full((4,), float(index)), index
+
+
+class DistributedEngine(ln.engine.Engine):
+    def start(self):
+        self.indices = []
+        self.dims = []
+        self.main_hooks = 0
+
+    def process_batch(self, data):
+        data, index = data
+        self.indices.extend(index.tolist())
+        self.backward(self.network(data).mean())
+
+    def train_batch(self):
+        self.step(self.optim)
+        self.optim.zero_grad()
+        self.dims.append(self.dataloader.change_input_dim())
+
+    @ln.engine.Engine.epoch_end(main_only=True)
+    def count_main(self):
+        self.main_hooks += 1
+
+    def quit(self):
+        return self.epoch >= 2
+
+
+def _distributed_worker(rank, folder):
+    torch.manual_seed(rank)
+    network = torch.nn.Linear(4, 2)
+    params = ln.engine.HyperParameters(
+        network=network,
+        optim=torch.optim.SGD(network.parameters(), lr=0.1),
+        batch_size=2,
+    )
+    loader = ln.data.DataLoader(IndexSet((416, 416)), batch_size=2, shuffle=True)
+    engine = DistributedEngine(params, loader)
+
+    # Non-distributed loaders should not communicate with the other ranks
+    local = ln.data.DataLoader(IndexSet((416, 416)), batch_size=2, distributed=False)
+    if rank == 1:
+        assert local.change_input_dim(320, random_range=None) == (320, 320)
+
+    engine()
+    torch.save({
+        'indices': engine.indices,
+        'dims': engine.dims,
+        'main_hooks': engine.main_hooks,
+        'weight': engine.network.weight.detach(),
+    }, folder / f'{rank}.pt')
+
+
+def test_engine_distributed(tmp_path):
+    ln.engine.launch(_distributed_worker, 2, tmp_path)
+    r0, r1 = torch.load(tmp_path / '0.pt'), torch.load(tmp_path / '1.pt')
+
+    assert len(r0['indices']) == len(r1['indices']) == 8
+    assert sorted(r0['indices'][:4] + r1['indices'][:4]) == list(range(8))
+    assert sorted(r0['indices'][4:] + r1['indices'][4:]) == list(range(8))
+    assert r0['dims'] == r1['dims']
+    assert (r0['main_hooks'], r1['main_hooks']) == (2, 0)
+    torch.testing.assert_close(r0['weight'], r1['weight'])
+
+
+class UnsyncedEngine(DistributedEngine):
+    def step(self, *optimizers, max_grad_norm=None):
+        for optim in optimizers:
+            optim.step()
+        return True
+
+
+def _unsynced_worker(rank):
+    network = torch.nn.Linear(4, 2)
+    params = ln.engine.HyperParameters(
+        network=network,
+        optim=torch.optim.SGD(network.parameters(), lr=0.1),
+        batch_size=2,
+    )
+    UnsyncedEngine(params, ln.data.DataLoader(IndexSet((416, 416)), batch_size=2))()
+
+
+def test_engine_distributed_unsynced():
+    with pytest.raises(Exception, match='sync_gradients'):
+        ln.engine.launch(_unsynced_worker, 2)
+
+
+def test_async_checkpointer(tmp_path):
+    network = ln.models.TinyYoloV2(20)
+    with ln.engine.AsyncCheckpointer(max_in_flight=2) as checkpointer:
+        network.save(tmp_path / 'weights.pt', checkpointer=checkpointer)
+        expected = {k: v.clone() for k, v in network.state_dict().items()}
+        with torch.no_grad():
+            for p in network.parameters():
+                p.zero_()
+
+        checkpointer.flush()
+        assert checkpointer.in_flight == 0
+        assert sorted(p.name for p in tmp_path.iterdir()) == ['weights.pt']
+
+        network.load(tmp_path / 'weights.pt')
+        for k, v in network.state_dict().items():
+            assert torch.equal(v, expected[k])
+
+        checkpointer.save({}, tmp_path / 'missing' / 'weights.pt')
+        with pytest.raises(RuntimeError):
+            checkpointer.flush()
+
+
+def test_engine_checkpointer_flush(tmp_path):
+    class BackupEngine(AmpEngine):
+        def train_batch(self):
+            super().train_batch()
+            self.params.save(tmp_path / f'{self.batch}.state.pt', checkpointer=self.checkpointer)
+
+    engine = create_engine()
+    engine = BackupEngine(engine.params, engine.dataloader, loss_factor=1)
+    engine()
+    assert engine.checkpointer.in_flight == 0
+    assert torch.load(tmp_path / '2.state.pt')['batch'] == 2
+
+
+def test_engine_timer():
+    engine = create_engine(timer_log_interval=1)
+    engine.timer = ln.engine.PhaseTimer(window=1)
+    engine()
+
+    stats = engine.timer.stats()
+    assert list(stats.keys()) == ['hooks', 'data', 'process_batch', 'train_batch', 'batch', 'images_per_second']
+    assert len(engine.timer.batch_times) == 1
+    assert stats['batch']['mean'] >= stats['process_batch']['mean'] + stats['train_batch']['mean']
+    assert stats['images_per_second'] == pytest.approx(4 / stats['batch']['mean'])
+
+
+def _evaluate(network):
+    return network.weight.sum().item()
+
+
+def _fail(network):
+    raise ValueError('evaluation failed')
+
+
+def test_evaluation_worker():
+    network = torch.nn.Linear(4, 2)
+    worker = ln.engine.EvaluationWorker(network, _evaluate, num_threads=1)
+    worker.submit(network, tag=1)
+    results = worker.poll(timeout=60)
+    assert results == [(1, pytest.approx(network.weight.sum().item()))]
+    assert not worker.busy
+
+    with torch.no_grad():
+        network.weight.fill_(1)
+    worker.submit(network, tag=2)
+    assert worker.busy
+    assert worker.close() == [(2, 8.0)]
+    assert not worker.process.is_alive()
+
+    worker = ln.engine.EvaluationWorker(network, _fail)
+    worker.submit(network.state_dict(), tag=3)
+    with pytest.raises(RuntimeError, match='evaluation failed'):
+        worker.poll(timeout=60)
+    worker.close()
+
+
+def test_engine_evaluator():
+    class EvaluatedEngine(AmpEngine):
+        def train_batch(self):
+            super().train_batch()
+            self.evaluator.submit(self.network, self.batch)
+
+        def evaluated(self, tag, results):
+            self.evaluations.append(tag)
+
+    engine = create_engine()
+    engine = EvaluatedEngine(engine.params, engine.dataloader, loss_factor=1, evaluations=[])
+    engine.evaluator = ln.engine.EvaluationWorker(engine.network, _evaluate, num_threads=1)
+    engine()
+
+    assert not engine.evaluator.process.is_alive()
+    assert engine.evaluations[-1] == 2
+
+
+def test_engine_evaluator_error(tmp_path):
+    class FailingEngine(AmpEngine):
+        def train_batch(self):
+            super().train_batch()
+            self.evaluator.submit(self.network, self.batch)
+            self.checkpointer.save({}, tmp_path / 'missing' / 'weights.pt')
+            raise ValueError('training failed')
+
+        def evaluated(self, tag, results):
+            raise AssertionError('evaluated should not be called')
+
+    engine = create_engine()
+    engine = FailingEngine(engine.params, engine.dataloader, loss_factor=1)
+    engine.evaluator = ln.engine.EvaluationWorker(engine.network, _evaluate, num_threads=1)
+    with pytest.raises(ValueError, match='training failed'):
+        engine()
+
+    assert engine.checkpointer.in_flight == 0
+    assert not engine.evaluator.process.is_alive()
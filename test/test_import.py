@@ -0,0 +1,56 @@
+#
+#   Test lazy importing of lightnet
+#   Copyright EAVISE
+#
+
+import json
+import subprocess
+import sys
+from pathlib import Path
+import pytest
+import lightnet as ln
+from lightnet._lazy import LazyModule, lazy_import
+
+ROOT = Path(__file__).parents[1]
+HEAVY = ['brambox', 'cv2', 'onnx', 'pandas', 'PIL', 'torchvision']
+
+
+def run(code):
+    """ Run code in a fresh interpreter and return the JSON it prints. """
+    out = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def test_lazy_import():
+    module = lazy_import('colorsys')
+    assert isinstance(module, LazyModule)
+    assert 'not loaded' in repr(module)
+    assert module.rgb_to_hsv(1, 0, 0) == (0, 1, 1)
+    assert 'not loaded' not in repr(module)
+    assert lazy_import('lightnet_nonexisting_package') is None
+
+
+def test_lazy_attributes():
+    assert 'models' in dir(ln)
+    assert 'DarknetDataset' in dir(ln.models)
+    assert 'quantize' in dir(ln.network)
+    assert callable(ln.network.quantize)
+    with pytest.raises(AttributeError):
+        ln.nonexisting
+    with pytest.raises(AttributeError):
+        ln.models.nonexisting
+
+
+def test_model_only_imports():
+    modules = run(
+        'import sys, json; import lightnet as ln; ln.models.TinyYoloV2(20); '
+        'print(json.dumps(sorted(sys.modules)))'
+    )
+    loaded = [name for name in HEAVY + ['lightnet.data', 'lightnet.engine', 'lightnet.inference', 'lightnet.prune'] if name in modules]
+    assert loaded == []
+
+
+def test_import_models():
+    modules = run('import sys, json; import lightnet; lightnet.models.YoloV2; print(json.dumps(sorted(sys.modules)))')
+    loaded = [name for name in HEAVY if name in modules]
+    assert loaded == []
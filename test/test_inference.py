@@ -0,0 +1,295 @@
+#
+#   Test inference tools
+#   Copyright EAVISE
+#
+
+import asyncio
+import threading
+import time
+import numpy as np
+import pytest
+import torch
+import lightnet as ln
+
+
+class PeakNetwork(torch.nn.Module):
+    """ Fake network that returns its input. """
+    def __init__(self):
+        super().__init__()
+        self.dummy = torch.nn.Parameter(torch.zeros(1))
+
+    def forward(self, x):
+        return x
+
+
+def peak_boxes(output, size=5, right=False):
+    """ Fake post-processing that creates a box around (or to the right of) the brightest pixel of every tile, clipped to the tile. """
+    boxes = []
+    for b, tile in enumerate(output[:, 0]):
+        if tile.max() > 0.9:
+            y, x = divmod(tile.argmax().item(), tile.shape[1])
+            x1, x2 = (x, x+2*size) if right else (x-size, x+size)
+            boxes.append([b, max(x1, 0), max(y-size, 0), min(x2, tile.shape[1]), min(y+size, tile.shape[0]), tile.max().item(), 0])
+    return torch.tensor(boxes, dtype=torch.float).reshape(-1, 7)
+
+
+@pytest.mark.parametrize('size', [100, 416, 417, 1000, 4321])
+@pytest.mark.parametrize('overlap', [0, 64, 200])
+def test_tile_positions(size, overlap):
+    positions = ln.inference.tile_positions(size, 416, overlap)
+    assert positions[0] == 0
+    if size > 416:
+        assert positions[-1] == size - 416
+        assert all(b - a <= 416 - overlap for a, b in zip(positions, positions[1:]))
+
+
+def test_tiled_inference(tmp_path):
+    image = np.lib.format.open_memmap(tmp_path / 'image.npy', mode='w+', dtype=np.uint8, shape=(1000, 1500, 3))
+    image[700, 1200] = 255
+    image[10, 10] = 255
+    image.flush()
+    image = np.load(tmp_path / 'image.npy', mmap_mode='r')
+
+    tiler = ln.inference.TiledInference(PeakNetwork(), peak_boxes, 416, overlap=96, batch_size=4)
+    assert len(tiler.tiles(image)) == 15
+
+    boxes = tiler(image)
+    assert boxes.shape == (2, 7)
+    boxes = boxes[boxes[:, 1].argsort()]
+    torch.testing.assert_close(boxes[:, 1:5], torch.tensor([[5.0, 5, 15, 15], [1195, 695, 1205, 705]]))
+    assert (boxes[:, 0] == 0).all()
+
+    # Same result for tensors
+    tensor = torch.from_numpy(np.array(image)).permute(2, 0, 1).float() / 255
+    torch.testing.assert_close(tiler(tensor)[:, 1:5].sort(0)[0], boxes[:, 1:5])
+
+
+def test_tiled_inference_edge_margin():
+    image = np.zeros((416, 800, 3), dtype=np.uint8)
+    image[200, 410] = 255       # Near the right edge of the first tile
+
+    tiler = ln.inference.TiledInference(PeakNetwork(), lambda x: peak_boxes(x, 20, right=True), 416, overlap=96)
+    assert len(tiler(image)) == 2   # Cut-off box in first tile does not overlap enough
+    tiler.edge_margin = 4
+    boxes = tiler(image)
+    assert len(boxes) == 1
+    torch.testing.assert_close(boxes[0, 1:5], torch.tensor([410.0, 180, 450, 220]))
+
+
+def test_tiled_inference_small_image():
+    image = np.zeros((100, 200), dtype=np.uint8)
+    image[50, 50] = 255
+
+    tiler = ln.inference.TiledInference(PeakNetwork(), peak_boxes, (256, 128), fill_color=0)
+    assert tiler.tiles(image) == [(0, 0)]
+    torch.testing.assert_close(tiler(image)[0, 1:5], torch.tensor([45.0, 45, 55, 55]))
+
+
+def to_tensor(image):
+    return torch.from_numpy(image).permute(2, 0, 1).float() / 255
+
+
+@pytest.fixture(scope='module')
+def detector():
+    network = ln.models.TinyYoloV2(3).eval()
+    post = ln.data.transform.Compose([
+        ln.data.transform.GetDarknetBoxes(0.001, network.stride, network.anchors),
+        ln.data.transform.NMS(0.5),
+        ln.data.transform.TensorToBrambox(['a', 'b', 'c']),
+    ])
+    return network, post
+
+
+def test_predictor(detector):
+    network, post = detector
+    rng = np.random.default_rng(0)
+    images = [rng.integers(0, 256, (96, 96, 3), dtype=np.uint8) for _ in range(8)]
+    expected = post(network(torch.stack([to_tensor(img) for img in images])))
+
+    with ln.inference.Predictor(network, to_tensor, post, max_batch_size=4, max_latency=1) as predictor:
+        futures = [predictor.submit(img, name=f'img{i}') for i, img in enumerate(images)]
+        results = [f.result(timeout=30) for f in futures]
+
+    assert predictor.num_images == 8
+    assert predictor.num_batches == 2
+    for i, result in enumerate(results):
+        assert (result['image'] == f'img{i}').all()
+        exp = expected[expected['image'] == i].reset_index(drop=True)
+        np.testing.assert_allclose(result[['x_top_left', 'y_top_left', 'width', 'height', 'confidence']].values, exp[['x_top_left', 'y_top_left', 'width', 'height', 'confidence']].values, rtol=1e-4, atol=1e-3)
+
+    with pytest.raises(RuntimeError):
+        predictor.submit(images[0])
+
+
+def test_predictor_threads_asyncio(detector):
+    network, post = detector
+    image = np.zeros((64, 64, 3), dtype=np.uint8)
+
+    with ln.inference.Predictor(network, to_tensor, post, max_batch_size=16, max_latency=0.2) as predictor:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(8) as pool:
+            results = list(pool.map(lambda i: predictor.predict(image, name=i), range(16)))
+        assert [r['image'].unique().tolist() for r in results if len(r)] == [[i] for i, r in enumerate(results) if len(r)]
+        assert predictor.mean_batch_size > 1
+
+        async def main():
+            return await asyncio.gather(*(predictor.apredict(image, name=i) for i in range(4)))
+
+        results = asyncio.run(main())
+        assert len(results) == 4
+
+
+def test_predictor_errors(detector):
+    network, post = detector
+
+    with ln.inference.Predictor(network, to_tensor, post) as predictor:
+        with pytest.raises(RuntimeError):
+            predictor.predict(np.zeros((64, 64), dtype=np.uint8), timeout=30)   # Wrong number of channels
+        predictor.predict(np.zeros((64, 64, 3), dtype=np.uint8), timeout=30)     # Still works
+
+    # Bad request does not fail the other requests of the batch
+    def pre(img):
+        if img is None:
+            raise ValueError('Bad image')
+        return to_tensor(img)
+
+    with ln.inference.Predictor(network, pre, post, max_batch_size=3, max_latency=1) as predictor:
+        futures = [predictor.submit(img) for img in (np.zeros((64, 64, 3), dtype=np.uint8), None, np.zeros((64, 64, 3), dtype=np.uint8))]
+        with pytest.raises(ValueError):
+            futures[1].result(timeout=30)
+        assert futures[0].result(timeout=30) is not None
+        assert futures[2].result(timeout=30) is not None
+    assert predictor.num_batches == 1
+    assert predictor.num_images == 2
+
+    # Image size of original image
+    sizes = []
+
+    def record(output):
+        sizes.extend(predictor.image_size(i) for i in range(2))
+        return torch.empty(0, 7)
+
+    predictor = ln.inference.Predictor(network, lambda img: to_tensor(img[:64, :64]), record, max_batch_size=2, max_latency=1)
+    futures = [predictor.submit(np.zeros((100, 200, 3), dtype=np.uint8)), predictor.submit(np.zeros((64, 80, 3), dtype=np.uint8))]
+    futures[0].result(timeout=30)
+    predictor.close()
+    assert sizes == [(200, 100), (80, 64)]
+
+
+def peak_frames(num, pulled=None):
+    """ Synthetic stream where frame i has its brightest pixel at (10+i, 20). """
+    for i in range(num):
+        if pulled is not None:
+            pulled.append(i)
+        frame = np.zeros((64, 128, 3), dtype=np.uint8)
+        frame[20, 10+i] = 255
+        yield frame
+
+
+def stream_threads():
+    return [t for t in threading.enumerate() if t.name.startswith('lightnet-stream')]
+
+
+@pytest.mark.parametrize('batch_size', [1, 3])
+def test_stream_pipeline(batch_size):
+    rng = np.random.default_rng(0)
+    delays = rng.uniform(0, 0.01, 20)
+
+    def pre(frame):
+        time.sleep(delays[frame[20].argmax(0)[0] - 10])     # Pre-processing finishes out of order
+        return to_tensor(frame)
+
+    pipeline = ln.inference.StreamPipeline(PeakNetwork(), pre, peak_boxes, batch_size=batch_size, workers=4, queue_size=2)
+    results = list(pipeline(peak_frames(20)))
+
+    assert len(results) == 20
+    for i, (frame, boxes) in enumerate(results):
+        assert frame[20, 10+i, 0] == 255
+        assert boxes.shape == (1, 7)
+        assert boxes[0, 0] == i
+        torch.testing.assert_close(boxes[0, 1:5], torch.tensor([5.0 + i, 15, 15 + i, 25]))
+
+    stats = pipeline.statistics()
+    assert set(stats) == {'decode', 'pre', 'network', 'post', 'total'}
+    assert stats['total']['mean'] >= stats['pre']['mean'] > 0
+    assert len(pipeline.latency['network']) == -(-20 // batch_size)
+    assert len(stream_threads()) == 0
+
+
+def test_stream_pipeline_mixed_resolution():
+    rng = np.random.default_rng(0)
+    sizes = [(64, 128), (128, 64), (100, 100), (50, 200), (200, 30)] * 4
+    frames = [rng.integers(0, 256, (h, w, 3), dtype=np.uint8) for h, w in sizes]
+    letterbox = ln.data.transform.Letterbox((96, 96))
+    expected = [to_tensor(letterbox(frame)) for frame in frames]
+
+    class SlowLetterbox(ln.data.transform.Letterbox):
+        def _get_params(self, im_w, im_h):
+            super()._get_params(im_w, im_h)
+            time.sleep(0.002)   # Give other workers the chance to modify the parameters of a shared Letterbox
+
+    outputs = []
+
+    def post(output):
+        outputs.extend(output)
+        return torch.empty(0, 7)
+
+    pre = ln.data.transform.Compose([SlowLetterbox((96, 96)), to_tensor])
+    pipeline = ln.inference.StreamPipeline(PeakNetwork(), pre, post, workers=4, queue_size=8)
+    assert len(list(pipeline(iter(frames)))) == len(frames)
+    for output, exp in zip(outputs, expected):
+        torch.testing.assert_close(output, exp)
+
+
+def test_stream_pipeline_backpressure():
+    pulled = []
+    pipeline = ln.inference.StreamPipeline(PeakNetwork(), to_tensor, peak_boxes, workers=2, queue_size=2)
+    stream = pipeline(peak_frames(100, pulled))
+
+    next(stream)
+    time.sleep(0.5)
+    assert 1 < len(pulled) < 15     # Slow consumer blocks decoding
+
+    stream.close()
+    assert len(stream_threads()) == 0
+    assert len(pulled) < 15
+
+
+def test_stream_pipeline_errors():
+    def pre(frame):
+        if frame[20].argmax(0)[0] == 13:
+            raise ValueError('Broken frame')
+        return to_tensor(frame)
+
+    pipeline = ln.inference.StreamPipeline(PeakNetwork(), pre, peak_boxes)
+    results = []
+    with pytest.raises(ValueError):
+        for result in pipeline(peak_frames(10)):
+            results.append(result)
+    assert len(results) == 3
+    assert len(stream_threads()) == 0
+
+    def broken_source():
+        yield from peak_frames(2)
+        raise IOError('Camera disconnected')
+
+    with pytest.raises(IOError):
+        list(pipeline(broken_source()))
+
+
+def test_read_frames(tmp_path):
+    cv2 = pytest.importorskip('cv2')
+    for i, frame in enumerate(peak_frames(5)):
+        frame[..., 2] = 100         # BGR red
+        cv2.imwrite(str(tmp_path / f'{i:03d}.png'), frame)
+    (tmp_path / 'notes.txt').write_text('not an image')
+
+    frames = list(ln.inference.read_frames(tmp_path))
+    assert len(frames) == 5
+    assert frames[0].shape == (64, 128, 3)
+    assert (frames[0][..., 0] == 100).all()
+    assert [f[20, :, 2].argmax() for f in frames] == [10, 11, 12, 13, 14]
+    assert len(list(ln.inference.read_frames(tmp_path, step=2))) == 3
+
+    with pytest.raises(IOError):
+        next(ln.inference.read_frames(tmp_path / 'missing.mp4'))
@@ -0,0 +1,306 @@
+#
+#   Test loss functions
+#   Copyright EAVISE
+#
+
+import pytest
+import numpy as np
+import pandas as pd
+import torch
+import lightnet as ln
+
+anchors = [(1.08, 1.19), (3.42, 4.41), (6.63, 11.38), (9.42, 5.11), (16.62, 10.52)]
+num_classes = 3
+
+
+@pytest.fixture(scope='module')
+def ground_truth():
+    def _ground_truth(batch, size=416, ignore=False, seed=0):
+        rng = np.random.default_rng(seed)
+        rows = []
+        for b in range(batch):
+            for _ in range(rng.integers(0, 8)):
+                w, h = rng.uniform(10, 200, 2)
+                rows.append({
+                    'batch_number': b,
+                    'class_label': '',
+                    'class_id': int(rng.integers(num_classes)),
+                    'x_top_left': rng.uniform(0, size-w),
+                    'y_top_left': rng.uniform(0, size-h),
+                    'width': w,
+                    'height': h,
+                    'ignore': ignore and rng.random() < 0.3,
+                })
+        return pd.DataFrame(rows, columns=['batch_number', 'class_label', 'class_id', 'x_top_left', 'y_top_left', 'width', 'height', 'ignore'])
+    return _ground_truth
+
+
+def to_tensor(df, batch, size=416):
+    num_anno = max(df.groupby('batch_number').size().max(), 1) if len(df) else 1
+    target = torch.zeros(batch, num_anno, 5)
+    target[..., 0] = -1
+    for b, anno in df.groupby('batch_number'):
+        target[b, :len(anno), 0] = torch.tensor(anno.class_id.values)
+        target[b, :len(anno), 1] = torch.tensor((anno.x_top_left.values + anno.width.values / 2) / size)
+        target[b, :len(anno), 2] = torch.tensor((anno.y_top_left.values + anno.height.values / 2) / size)
+        target[b, :len(anno), 3] = torch.tensor(anno.width.values / size)
+        target[b, :len(anno), 4] = torch.tensor(anno.height.values / size)
+    return target
+
+
+@pytest.mark.parametrize('seen', [0, 20000])
+def test_regionloss_batch(ground_truth, seen):
+    """ Batched target building should give the same result as computing the loss per image. """
+    nB = 4
+    loss = ln.network.loss.RegionLoss(num_classes, anchors)
+    output = torch.randn(nB, len(anchors)*(5+num_classes), 13, 13)
+    gt = ground_truth(nB, ignore=True)
+
+    batch_loss = loss(output, gt, seen=seen) * nB
+    image_loss = sum(
+        loss(output[b:b+1], gt[gt.batch_number == b].assign(batch_number=0), seen=seen)
+        for b in range(nB)
+    )
+    torch.testing.assert_close(batch_loss, image_loss)
+
+
+def test_regionloss_tensor(ground_truth):
+    """ Brambox and tensor targets should result in the same loss. """
+    nB = 4
+    loss = ln.network.loss.RegionLoss(num_classes, anchors)
+    output = torch.randn(nB, len(anchors)*(5+num_classes), 13, 13)
+    gt = ground_truth(nB)
+
+    loss_df = loss(output, gt, seen=0)
+    loss_tensor = loss(output, to_tensor(gt, nB), seen=0)
+    torch.testing.assert_close(loss_df, loss_tensor)
+
+
+def test_regionloss_channels_last(ground_truth):
+    """ Channels_last output should give the same loss and keep its memory format in the gradient. """
+    nB = 4
+    loss = ln.network.loss.RegionLoss(num_classes, anchors)
+    output = torch.randn(nB, len(anchors)*(5+num_classes), 13, 13)
+    output_nhwc = output.to(memory_format=torch.channels_last).requires_grad_()
+    output.requires_grad_()
+    gt = ground_truth(nB, ignore=True)
+
+    loss_nchw = loss(output, gt, seen=0)
+    loss_nhwc = loss(output_nhwc, gt, seen=0)
+    torch.testing.assert_close(loss_nhwc, loss_nchw)
+
+    loss_nchw.backward()
+    loss_nhwc.backward()
+    torch.testing.assert_close(output_nhwc.grad, output.grad)
+    assert output_nhwc.grad.is_contiguous(memory_format=torch.channels_last)
+
+
+def test_regionloss_targets():
+    loss = ln.network.loss.RegionLoss(num_classes, anchors).eval()
+    pred_boxes = torch.zeros(2*len(anchors)*13*13, 4)
+    pred_boxes[:, 2:] = 1
+    gt = pd.DataFrame({
+        'batch_number': [1, 1],
+        'class_id': [2, 1],
+        'x_top_left': [100.0, 10.0],
+        'y_top_left': [50.0, 10.0],
+        'width': [32.0, 64.0],
+        'height': [64.0, 64.0],
+        'ignore': [False, True],
+    })
+    coord_mask, conf_mask, cls_mask, tcoord, tconf, tcls = loss.build_targets(pred_boxes, gt, 2, 13, 13)
+
+    # First box: center (116, 82) -> cell (3, 2), best anchor 0
+    cell = 2 * 13 + 3
+    assert cls_mask.sum() == 1
+    assert cls_mask[1, 0, cell]
+    assert tcls[1, 0, cell] == 2
+    assert conf_mask[1, 0, cell] == loss.object_scale
+    torch.testing.assert_close(tcoord[1, 0, :, cell], torch.tensor([
+        116/32 - 3,
+        82/32 - 2,
+        np.log(1 / 1.08),
+        np.log(2 / 1.19),
+    ], dtype=torch.float))
+    torch.testing.assert_close(coord_mask[1, 0, 0, cell], torch.tensor(2 - 2/169))
+
+    # Second box is ignored
+    assert conf_mask[1, :, 13 + 1].min() == 0
+    assert coord_mask[1, :, 0, 13 + 1].max() == 0
+
+    # Image without ground truth
+    assert (conf_mask[0] == loss.noobject_scale).all()
+    assert (coord_mask[0] == 0).all()
+
+
+@pytest.mark.cuda
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='CUDA not available')
+def test_regionloss_cuda(ground_truth):
+    nB = 4
+    loss = ln.network.loss.RegionLoss(num_classes, anchors)
+    output = torch.randn(nB, len(anchors)*(5+num_classes), 13, 13)
+    gt = ground_truth(nB, ignore=True)
+
+    loss_cpu = loss(output, gt, seen=0)
+    loss_cuda = loss(output.to('cuda'), gt, seen=0)
+    torch.testing.assert_close(loss_cpu, loss_cuda.cpu())
+
+
+def test_regionloss_buffers(ground_truth):
+    loss = ln.network.loss.RegionLoss(num_classes, anchors)
+    output = torch.randn(2, len(anchors)*(5+num_classes), 13, 13)
+    gt1 = ground_truth(2, seed=1)
+    gt2 = ground_truth(2, seed=2)
+
+    # Buffers get reused and refilled
+    loss1 = loss(output, gt1, seen=0)
+    ptrs = {key: buffer.data_ptr() for key, buffer in loss._target_buffers.buffers.items()}
+    loss(output, gt2, seen=0)
+    torch.testing.assert_close(loss(output, gt1, seen=0), loss1)
+    assert {key: buffer.data_ptr() for key, buffer in loss._target_buffers.buffers.items()} == ptrs
+    assert len(loss._target_buffers) == 6
+
+    # Bounded number of shapes
+    for size in (10, 11, 12):
+        loss(torch.randn(2, len(anchors)*(5+num_classes), size, size), gt1)
+    assert len(loss._target_buffers) == 6 * loss._target_buffers.max_shapes
+
+
+def test_cornerloss_heatmaps():
+    """ Check the batched gaussian rendering with a naive implementation. """
+    loss = ln.network.loss.CornerLoss(stride=4)
+    gt = pd.DataFrame({
+        'batch_number': [0, 0, 1, 1],
+        'class_id': [0, 1, 1, 1],
+        'x_top_left': [0.0, 40.0, 90.0, 100.0],
+        'y_top_left': [4.0, 30.0, 50.0, 60.0],
+        'width': [60.0, 20.0, 38.0, 20.0],
+        'height': [40.0, 80.0, 70.0, 60.0],
+    })
+    heatmaps, embedding, offsets, mask = loss.build_targets(gt, 2, 2, 32, 32)
+
+    expected = torch.zeros_like(heatmaps)
+    for row in gt.itertuples():
+        x1, y1 = int(row.x_top_left / 4), int(row.y_top_left / 4)
+        x2, y2 = min(int((row.x_top_left + row.width) / 4), 31), min(int((row.y_top_left + row.height) / 4), 31)
+        r = int(ln.network.loss._cornerloss.gaussian_radius(torch.tensor([row.width / 4]), torch.tensor([row.height / 4]), loss.gaussian_iou))
+        g = ln.network.loss._cornerloss.create_gaussian(r, (r+0.5)/3)
+        for corner, (cx, cy) in enumerate(((x1, y1), (x2, y2))):
+            for dy in range(-r, r+1):
+                for dx in range(-r, r+1):
+                    if 0 <= cy+dy < 32 and 0 <= cx+dx < 32:
+                        heat = expected[row.batch_number, corner, row.class_id, cy+dy, cx+dx]
+                        expected[row.batch_number, corner, row.class_id, cy+dy, cx+dx] = max(heat, g[dy+r, dx+r])
+
+    torch.testing.assert_close(heatmaps, expected)
+    assert embedding.shape == (4, 2)
+    assert mask.sum() == 8
+    assert offsets[0, 0, :, 1, 0].tolist() == pytest.approx([0, 0])
+    assert offsets[1, 1, :, 30, 31].tolist() == pytest.approx([1, 0])
+    assert offsets[1, 0, :, 12, 22].tolist() == pytest.approx([0.5, 0.5])
+
+    # Kernels are cached per radius and dtype, with a bounded cache
+    assert all(kernel.shape == (2*r+1, 2*r+1) for (r, _, _), kernel in loss._gaussian_kernels.items())
+    loss._max_kernels = 2
+    loss.build_targets(gt, 2, 2, 32, 32, dtype=torch.float64)
+    assert len(loss._gaussian_kernels) == 2
+    assert all(dtype == torch.float64 for (_, dtype, _) in loss._gaussian_kernels)
+
+
+def test_multiscaleregionloss(ground_truth):
+    ms_anchors = [[(3.625, 2.8125), (4.875, 6.1875), (11.65625, 10.1875)], [(1.875, 3.8125), (3.875, 2.8125), (3.6875, 7.4375)], [(1.25, 1.625), (2.0, 3.75), (4.125, 2.875)]]
+    strides = (32, 16, 8)
+    nB = 2
+    loss = ln.network.loss.MultiScaleRegionLoss(num_classes, ms_anchors, strides)
+    output = [torch.randn(nB, 3*(5+num_classes), 416 // s, 416 // s) for s in strides]
+    gt = pd.DataFrame({
+        'batch_number': [0, 0, 1, 1],
+        'class_id': [0, 1, 2, 0],
+        'x_top_left': [10.0, 200.0, 50.0, 300.0],
+        'y_top_left': [20.0, 150.0, 300.0, 30.0],
+        'width': [300.0, 40.0, 12.0, 60.0],
+        'height': [250.0, 80.0, 16.0, 120.0],
+        'ignore': [False] * 4,
+    })
+
+    # Every box is assigned to exactly one scale
+    assigned = []
+    build_targets = loss._build_targets
+
+    def count_targets(*args, **kwargs):
+        targets = build_targets(*args, **kwargs)
+        assigned.append(int(targets[2].sum()))
+        return targets
+
+    loss._build_targets = count_targets
+    loss(output, gt)
+    assert assigned == [1, 2, 1]
+
+    # Loss state does not change
+    assert loss.seen == nB
+    assert loss.stride == strides[0]
+    torch.testing.assert_close(loss.anchors, torch.tensor(ms_anchors[0]))
+
+    # Single scale is the same as RegionLoss
+    single = ln.network.loss.MultiScaleRegionLoss(num_classes, ms_anchors[:1], strides[:1])
+    region = ln.network.loss.RegionLoss(num_classes, ms_anchors[0], stride=strides[0])
+    gt = ground_truth(nB, ignore=True)
+    torch.testing.assert_close(single(output[:1], gt, seen=0), region(output[0], gt, seen=0))
+
+
+def test_loss_autocast(ground_truth):
+    """ Losses under bfloat16 autocast should match the fp32 loss. """
+    nB = 2
+    network = ln.models.TinyYoloV2(num_classes)
+    loss = ln.network.loss.RegionLoss(num_classes, network.anchors, network.stride)
+    input_tensor = torch.rand(nB, 3, 416, 416)
+    gt = ground_truth(nB)
+
+    output = network(input_tensor)
+    loss_fp32 = loss(output, gt, seen=0)
+
+    with torch.autocast('cpu', dtype=torch.bfloat16):
+        output = network(input_tensor)
+        loss_bf16 = loss(output, gt, seen=0)
+    assert output.dtype == torch.bfloat16
+    assert loss_bf16.dtype == torch.float32
+    assert loss._target_buffers.buffers[next(iter(loss._target_buffers.buffers))].dtype == torch.float32
+    torch.testing.assert_close(loss_bf16, loss_fp32, rtol=0.02, atol=0.1)
+
+    loss_bf16.backward()
+    assert all(p.grad is None or torch.isfinite(p.grad).all() for p in network.parameters())
+
+    # Same output in bfloat16 without autocast
+    torch.testing.assert_close(loss(output.detach(), gt, seen=0), loss(output.detach().float(), gt, seen=0))
+
+
+def test_cornerloss_autocast():
+    loss = ln.network.loss.CornerLoss(stride=4)
+    output = torch.randn(2, 2*(num_classes+3), 32, 32)
+    gt = pd.DataFrame({
+        'batch_number': [0, 1],
+        'class_id': [0, 2],
+        'x_top_left': [10.0, 40.0],
+        'y_top_left': [4.0, 30.0],
+        'width': [60.0, 20.0],
+        'height': [40.0, 80.0],
+    })
+
+    loss_fp32 = loss((output, output), gt)
+    with torch.autocast('cpu', dtype=torch.bfloat16):
+        loss_bf16 = loss((output.bfloat16(), output.bfloat16()), gt)
+    assert loss_bf16.dtype == torch.float32
+    torch.testing.assert_close(loss_bf16, loss_fp32, rtol=0.02, atol=0.1)
+
+
+def test_bbox_max_ious():
+    from lightnet.network.loss._regionloss import bbox_ious, bbox_max_ious, bbox_pair_ious
+    boxes1 = torch.rand(3, 7, 4) * torch.tensor([13, 13, 5, 5]) + torch.tensor([0, 0, 0.1, 0.1])
+    boxes2 = torch.rand(3, 50, 4) * torch.tensor([13, 13, 5, 5]) + torch.tensor([0, 0, 0.1, 0.1])
+    mask = torch.rand(3, 7) > 0.3
+
+    ious = bbox_ious(boxes1, boxes2)
+    torch.testing.assert_close(bbox_max_ious(boxes1, boxes2, max_elements=40), ious.max(-2)[0])
+    torch.testing.assert_close(bbox_max_ious(boxes1, boxes2, mask, max_elements=40), ious.masked_fill(~mask[..., None], 0).max(-2)[0])
+    torch.testing.assert_close(bbox_max_ious(boxes1[:, :0], boxes2), torch.zeros(3, 50))
+    torch.testing.assert_close(bbox_pair_ious(boxes1, boxes2[:, :7]), ious[:, range(7), range(7)])
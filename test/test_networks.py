@@ -4,6 +4,7 @@
 #
 
 import inspect
+import numpy as np
 import pytest
 import torch
 import lightnet as ln
@@ -165,6 +166,283 @@ def test_yolofusion_cuda(input_tensor):
         assert output_tensor.shape[3] == it.shape[3] // uut.stride
 
 
+# BatchNorm fusing
+def randomize_batchnorm(network):
+    for module in network.modules():
+        if isinstance(module, torch.nn.BatchNorm2d):
+            module.running_mean.uniform_(-1, 1)
+            module.running_var.uniform_(0.5, 2)
+            module.weight.data.uniform_(0.5, 2)
+            module.bias.data.uniform_(-1, 1)
+
+
+@pytest.mark.parametrize('network', ['MobilenetYolo', 'MobilenetV2', 'TinyYoloV3', 'YoloV2', 'CornernetSqueeze'])
+def test_fuse_cpu(network, input_tensor):
+    uut = getattr(ln.models, network)(20).eval()
+    randomize_batchnorm(uut)
+    state = {k: v.clone() for k, v in uut.state_dict().items()}
+    it = input_tensor(uut.inner_stride)
+    expected = uut(it)
+
+    uut.fuse()
+    assert uut.fused
+    assert len(uut._fused_layers) > 0
+    output = uut(it)
+    for o, e in zip(output if isinstance(output, (list, tuple)) else [output], expected if isinstance(expected, (list, tuple)) else [expected]):
+        torch.testing.assert_close(o, e, atol=1e-3, rtol=1e-3)
+
+    uut.unfuse()
+    assert not uut.fused
+    for k, v in uut.state_dict().items():
+        torch.testing.assert_close(v, state[k])
+
+
+def test_fuse_unfuse_dtype():
+    uut = ln.models.TinyYoloV2(20).eval()
+    randomize_batchnorm(uut)
+    state = {k: v.clone() for k, v in uut.state_dict().items()}
+
+    for _ in range(3):
+        uut.fuse()
+        uut.double()
+        uut.unfuse()
+        uut.float()
+
+    uut.fuse().double().unfuse()
+    for k, v in uut.state_dict().items():
+        expected = state[k].double() if state[k].is_floating_point() else state[k]
+        assert v.dtype == expected.dtype, k
+        assert torch.equal(v, expected), k
+
+    it = torch.rand(1, 3, 64, 64, dtype=torch.float64)
+    assert uut(it).dtype == torch.float64
+
+
+def test_fuse_save_load(tmp_path):
+    uut = ln.models.TinyYoloV2(20).eval()
+    randomize_batchnorm(uut)
+    uut.save(str(tmp_path / 'unfused.weights'))
+    state = {k: v.clone() for k, v in uut.state_dict().items()}
+
+    uut.fuse()
+    fused = {k: v.clone() for k, v in uut.state_dict().items()}
+    uut.save(str(tmp_path / 'fused.pt'))
+    uut.save(str(tmp_path / 'fused.weights'))
+    assert uut.fused
+    for k, v in uut.state_dict().items():
+        assert torch.equal(v, fused[k])
+
+    unfused = np.fromfile(tmp_path / 'unfused.weights', dtype=np.float32)
+    np.testing.assert_allclose(np.fromfile(tmp_path / 'fused.weights', dtype=np.float32), unfused, rtol=1e-5)
+
+    other = ln.models.TinyYoloV2(20).eval()
+    other.load(str(tmp_path / 'fused.pt'))
+    for k, v in other.state_dict().items():
+        torch.testing.assert_close(v, state[k])
+
+    other.fuse()
+    other.load(str(tmp_path / 'unfused.weights'))
+    assert other.fused
+    it = torch.rand(1, 3, 64, 64)
+    torch.testing.assert_close(other(it), uut(it))
+
+
+# Darknet weights
+def test_darknet_weights(tmp_path):
+    uut = ln.models.TinyYoloV2(20).eval()
+    randomize_batchnorm(uut)
+    uut.save(str(tmp_path / 'full.weights'))
+    layers = [layer for layer in uut.layer_loop() if type(layer) in (torch.nn.Conv2d, ln.network.layer.Conv2dBatchReLU)]
+    assert uut.check_darknet_weights(str(tmp_path / 'full.weights'), strict=True) == len(layers)
+
+    other = ln.models.TinyYoloV2(20).eval()
+    other.load(str(tmp_path / 'full.weights'), strict=True)
+    for k, v in other.state_dict().items():
+        torch.testing.assert_close(v, uut.state_dict()[k])
+
+    # Partial files
+    data = (tmp_path / 'full.weights').read_bytes()
+    header = 20
+    backbone = 4 * sum(ln.network.module._darknet.WeightLoader.layer_size(layer) for layer in layers[:3])
+    (tmp_path / 'backbone.weights').write_bytes(data[:header + backbone])
+    (tmp_path / 'broken.weights').write_bytes(data[:header + backbone + 40])
+
+    other = ln.models.TinyYoloV2(20).eval()
+    assert other.check_darknet_weights(str(tmp_path / 'backbone.weights')) == 3
+    with pytest.raises(ValueError):
+        other.load(str(tmp_path / 'backbone.weights'), strict=True)
+    other.load(str(tmp_path / 'backbone.weights'))
+    torch.testing.assert_close(other.layers[0].layers[0].weight, uut.layers[0].layers[0].weight)
+
+    state = {k: v.clone() for k, v in other.state_dict().items()}
+    with pytest.raises(ValueError):
+        other.load(str(tmp_path / 'broken.weights'))
+    for k, v in other.state_dict().items():
+        assert torch.equal(v, state[k])      # Nothing copied
+
+    # Fused networks
+    other.fuse()
+    fused = {k: v.clone() for k, v in other.state_dict().items()}
+    assert other.check_darknet_weights(str(tmp_path / 'full.weights'), strict=True) == len(layers)
+    assert other.check_darknet_weights(str(tmp_path / 'backbone.weights')) == 3
+    assert other.fused
+    for k, v in other.state_dict().items():
+        assert torch.equal(v, fused[k])
+
+
+def test_load_mmap(tmp_path):
+    uut = ln.models.TinyYoloV2(20).eval()
+    randomize_batchnorm(uut)
+    uut.save(str(tmp_path / 'weights.pt'))
+    torch.save(uut.state_dict(), tmp_path / 'legacy.pt', _use_new_zipfile_serialization=False)
+    it = torch.rand(1, 3, 64, 64)
+    expected = uut(it)
+
+    for kwargs in ({}, {'mmap': False}, {'assign': True}):
+        other = ln.models.TinyYoloV2(20).eval()
+        weight = other.layers[0].layers[0].weight
+        other.load(str(tmp_path / 'weights.pt'), **kwargs)
+        assert (other.layers[0].layers[0].weight is not weight) == kwargs.get('assign', False)
+        assert other.layers[0].layers[0].weight.requires_grad
+        torch.testing.assert_close(other(it), expected)
+
+    # Fallback for legacy files and weights are copied if assigning would change the network
+    other = ln.models.TinyYoloV2(20).eval().to_channels_last()
+    weight = other.layers[0].layers[0].weight
+    other.load(str(tmp_path / 'legacy.pt'), assign=True)
+    assert other.layers[0].layers[0].weight is weight
+    torch.testing.assert_close(other(it), expected)
+
+
+# Channels last
+@pytest.mark.parametrize('network', ['CornernetSqueeze', 'MobilenetYolo', 'TinyYoloV3', 'YoloFusion', 'YoloV2Upsample'])
+def test_channels_last_cpu(network, input_tensor):
+    uut = getattr(ln.models, network)(20).eval()
+    it = input_tensor(uut.inner_stride * 2, channels=4 if network == 'YoloFusion' else 3, batch=2)
+    expected = uut(it)
+
+    uut.to_channels_last(it, strict=True)
+    assert uut.channels_last
+    assert uut.channels_last_offenders(it) == []
+    output = uut(it)
+    for o, e in zip(output if isinstance(output, (list, tuple)) else [output], expected if isinstance(expected, (list, tuple)) else [expected]):
+        assert o.is_contiguous(memory_format=torch.channels_last)
+        torch.testing.assert_close(o, e, atol=1e-4, rtol=1e-4)
+
+    uut.to_contiguous_format()
+    assert not uut.channels_last
+    output = uut(it)
+    assert (output[0] if isinstance(output, (list, tuple)) else output).is_contiguous()
+
+
+def test_channels_last_offenders(input_tensor):
+    class NCHW(torch.nn.Module):
+        def forward(self, x):
+            return x.contiguous()
+
+    uut = ln.models.TinyYoloV2(20).eval()
+    setattr(uut.layers, '2_max', torch.nn.Sequential(uut.layers[1], NCHW()))
+    it = input_tensor(uut.inner_stride * 2)
+    assert uut.to_channels_last().channels_last_offenders(it) == ['layers.2_max.1 (NCHW)']
+    with pytest.raises(RuntimeError):
+        uut.to_channels_last(it, strict=True)
+
+
+# Quantization
+@pytest.mark.filterwarnings('ignore')
+@pytest.mark.parametrize('network', ['TinyYoloV2', 'YoloV2', 'TinyYoloV3', 'MobilenetYolo', 'MobilenetV2'])
+def test_quantize_cpu(network, input_tensor):
+    if 'x86' not in torch.backends.quantized.supported_engines:
+        pytest.skip('x86 quantized engine not available')
+
+    uut = getattr(ln.models, network)(20).eval()
+    randomize_batchnorm(uut)
+    calibration = [input_tensor(uut.inner_stride * 2, batch=2) for _ in range(2)]
+    quantized = ln.network.quantize(uut, calibration)
+    assert any(isinstance(m, torch.nn.BatchNorm2d) for m in uut.modules())     # Original network is not modified
+
+    it = input_tensor(uut.inner_stride * 2)
+    with torch.no_grad():
+        expected = uut(it)
+        output = quantized(it)
+
+    expected = expected if isinstance(expected, (list, tuple)) else [expected]
+    output = output if isinstance(output, (list, tuple)) else [output]
+    assert len(output) == len(expected)
+    for o, e in zip(output, expected):
+        assert not o.is_quantized
+        assert o.shape == e.shape
+        assert (o - e).norm() / e.norm() < 0.1
+
+    assert quantized.num_classes == 20
+    if hasattr(uut, 'anchors'):
+        assert quantized.anchors == uut.anchors
+
+
+@pytest.mark.filterwarnings('ignore')
+def test_quantize_engine(input_tensor):
+    engines = [e for e in ('qnnpack', 'x86') if e in torch.backends.quantized.supported_engines]
+    if len(engines) != 2:
+        pytest.skip('qnnpack and x86 quantized engines not available')
+
+    uut = ln.models.TinyYoloV2(20).eval()
+    engine = torch.backends.quantized.engine
+    backend = engines[0] if engine != engines[0] else engines[1]
+    ln.network.quantize(uut, [input_tensor(uut.inner_stride * 2)], backend=backend)
+    assert torch.backends.quantized.engine == engine
+
+    with pytest.raises(ValueError):
+        ln.network.quantize(uut, [], backend=backend)
+    assert torch.backends.quantized.engine == engine
+
+
+def test_quantize_reorg():
+    reorg = ln.network.layer.Reorg(2)
+    x = torch.rand(2, 8, 6, 6)
+    qx = torch.quantize_per_tensor(x, 0.01, 0, torch.quint8)
+    qy = reorg(qx)
+
+    assert qy.is_quantized
+    assert qy.q_scale() == qx.q_scale() and qy.q_zero_point() == qx.q_zero_point()
+    assert torch.equal(qy.dequantize(), reorg(qx.dequantize()))
+
+
+# Profiling
+def test_profile_cpu(input_tensor, tmp_path):
+    uut = ln.models.TinyYoloV2(20)
+    it = input_tensor(uut.inner_stride * 2)
+    prof = ln.network.profile(uut, it, warmup=1, iterations=2)
+    assert uut.training
+
+    names = {module: name for name, module in uut.named_modules()}
+    assert [layer['name'] for layer in prof] == [names[module] for module in uut.layer_loop()]
+    assert sum(layer['params'] for layer in prof) == prof.total['params'] == sum(p.numel() for p in uut.parameters())
+    assert sum(layer['flops'] for layer in prof) == prof.total['flops']
+    assert all(layer['calls'] == 1 and layer['time'] > 0 for layer in prof)
+
+    first = prof['layers.1_convbatch']
+    assert first['output_shape'] == [1, 16, 64, 64]
+    assert first['activation_bytes'] == 16 * 64 * 64 * 4
+    assert first['flops'] == 2 * 16 * 64 * 64 * 3 * 3 * 3
+    assert 'layers.1_convbatch' in prof.table()
+    assert len(prof.table(sort='flops', top=3).splitlines()) == 7
+
+    prof.to_json(tmp_path / 'profile.json')
+    loaded = ln.network.NetworkProfile.from_json(tmp_path / 'profile.json')
+    assert loaded.to_dict() == prof.to_dict()
+
+    # Custom layers and plain modules
+    prof = ln.network.profile(uut, it, warmup=0, iterations=1, layers=['layers.1_convbatch.layers.0', 'layers.2_max'])
+    assert [layer['type'] for layer in prof] == ['Conv2d', 'MaxPool2d']
+    with pytest.raises(KeyError):
+        ln.network.profile(uut, it, layers=['nonexisting'])
+
+    seq = torch.nn.Sequential(torch.nn.Conv2d(3, 4, 1), torch.nn.ReLU(inplace=True))
+    prof = ln.network.profile(seq, it, warmup=0, iterations=1)
+    assert [layer['name'] for layer in prof] == ['0', '1']
+    assert prof['1']['activation_bytes'] == 0      # In-place
+
+
 # All networks tested?
 def test_all_networks_tested():
     networks = [